@@ -1,24 +1,42 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
 from fastapi.responses import JSONResponse, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
 from PIL import Image
+import torch
 import uuid
 import os
 import json
 import asyncio
+import functools
+import secrets
+import time
 from typing import Optional, Dict, Any
 import logging
 from io import BytesIO
+from collections import OrderedDict
 
-import boto3
-from botocore.client import Config
-
-from model_loader import get_models
+from model_loader import get_models, get_draft_pipe, get_inpaint_pipe, tuned_config, model_pool
 from generate import generate_image
+from stages import stage, STAGE_UPLOAD
+from jobs import Job, JobRegistry, GenerationCancelled, DuplicateJobId
+from metrics import metrics
+from buckets import bucket_sizes
+from storage import upload_image_return_url, local_image_path, r2_enabled, s3_client, R2_BUCKET_NAME
+from job_queue import open_queue
+from profiling import profiling_requested, acquire_profile_slot, run_profiled, trace_path, trace_written
+from single_flight import SingleFlight, canonical_request_hash
+from memory_budget import MemoryPlanner, MemoryBudgetExceeded
+from model_pool import conditioning_for, DEFAULT_CONDITIONING
+from inference_executor import InferenceExecutor, slot_pipeline
+from metadata_store import open_metadata_store, input_hash, hashed_settings
 
 # Try to import enhanced features, fallback to basic if not available
 try:
-    from enhanced_generate import generate_image_advanced, generate_multiple_variations
+    from enhanced_generate import generate_image_advanced, generate_multiple_variations, is_draft, resolve_seed, warm_up_buckets
+    from cost_model import CostModel
+    from latent_cache import latent_cache
+    from regional import generate_masked_region, EmptyMaskError
+    from sweep import generate_style_sweep, make_grid, MAX_SWEEP_COMBINATIONS, SWEEP_MAX_BATCH
     ENHANCED_FEATURES = True
     print("✅ Enhanced features loaded successfully")
 except ImportError:
@@ -43,60 +61,295 @@ app.add_middleware(
 # Load models
 pipe, depth_estimator = get_models()
 
+# Warm up every resolution bucket so first requests don't pay per-shape warm-up cost
+if ENHANCED_FEATURES and os.getenv("WARMUP_BUCKETS", "1") == "1":
+    warm_up_buckets(pipe, depth_estimator)
+
+# Online latency model for deadline-aware requests, fed by measured stage timings
+cost_model = CostModel(pipe.device.type) if ENHANCED_FEATURES else None
+
+# Picks memory-saving options so each request stays under MEMORY_BUDGET_MB
+memory_planner = MemoryPlanner(pipe) if ENHANCED_FEATURES else None
+
+# Generation runs on dedicated worker slots (INFERENCE_SLOTS) so the event loop stays responsive
+inference_executor = InferenceExecutor(pipe.device.type)
+
+# In-flight jobs, cancellable by id or when the client disconnects
+job_registry = JobRegistry()
+DISCONNECT_POLL_SECONDS = float(os.getenv("DISCONNECT_POLL_SECONDS", "0.5"))
+
+# Identical concurrent requests share one job
+single_flight = SingleFlight()
+
+# Distributed mode: jobs go to a shared queue that worker nodes (queue_worker.py) render from
+JOB_QUEUE_URL = os.getenv("JOB_QUEUE_URL")  # e.g. sqlite:///shared/queue.db
+job_queue = open_queue(JOB_QUEUE_URL) if JOB_QUEUE_URL else None
+
+# Completed generations (input hash, settings, seed, timings, outputs) for history and reuse lookups
+metadata_store = open_metadata_store()
+
+# Records hold users' prompts and outputs: /generations needs this token in X-Metadata-Token (unset = closed)
+METADATA_API_TOKEN = os.getenv("METADATA_API_TOKEN")
+
+# Recent drafts kept for the upgrade path (draft_id -> prompt, input image, settings)
+DRAFT_CACHE_SIZE = int(os.getenv("DRAFT_CACHE_SIZE", "32"))
+_drafts: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+# Defaults for /generate/advanced; queued jobs get the same ones
+ADVANCED_SETTINGS = {
+    'steps': 20,
+    'guidanceScale': 7.5,
+    'strength': 0.8,
+    'seed': 0,
+    'enableUpscaling': False,
+    'preserveColors': False,
+    'enhanceLighting': True,
+    'style': 'Modern',
+    'roomType': 'Living Room'
+}
+
 # Ensure directories exist
 os.makedirs("images", exist_ok=True)
 os.makedirs("temp", exist_ok=True)
 
-# --- Cloudflare R2 configuration ---
-R2_ACCOUNT_ID = os.getenv("R2_ACCOUNT_ID")
-R2_ACCESS_KEY_ID = os.getenv("R2_ACCESS_KEY_ID")
-R2_SECRET_ACCESS_KEY = os.getenv("R2_SECRET_ACCESS_KEY")
-R2_BUCKET_NAME = os.getenv("R2_BUCKET_NAME")
-R2_PUBLIC_BASE_URL = os.getenv("R2_PUBLIC_BASE_URL")  # e.g. https://pub-xxxx.r2.dev
-
-_r2_enabled = all([R2_ACCOUNT_ID, R2_ACCESS_KEY_ID, R2_SECRET_ACCESS_KEY, R2_BUCKET_NAME])
-if _r2_enabled:
-    r2_endpoint = f"https://{R2_ACCOUNT_ID}.r2.cloudflarestorage.com"
-    s3_client = boto3.client(
-        "s3",
-        endpoint_url=r2_endpoint,
-        aws_access_key_id=R2_ACCESS_KEY_ID,
-        aws_secret_access_key=R2_SECRET_ACCESS_KEY,
-        config=Config(signature_version="s3v4"),
-        region_name="auto",
+def _pipe_for(settings: Dict[str, Any]):
+    """Pick the pipeline for the requested quality tier"""
+    if is_draft(settings):
+        return get_draft_pipe()
+    return pipe
+
+
+def _conditioning_response(settings: Dict[str, Any]) -> Optional[JSONResponse]:
+    """400 response if settings['conditioning'] names an unknown ControlNet type"""
+    try:
+        conditioning_for(settings)
+    except ValueError as e:
+        return JSONResponse({
+            "success": False,
+            "error": str(e)
+        }, status_code=400)
+    return None
+
+
+def _conditioned(fn, settings: Dict[str, Any]):
+    """Wrap a generation function so it runs on the ControlNet variant for settings['conditioning'].
+
+    The variant is loaded into the model pool on the inference worker if it isn't resident, and
+    its pipeline and annotator replace the pipe and depth_estimator arguments (third and fourth,
+    as in every generate_* function). A draft pipe with the consistency LoRA is swapped for the
+    variant's own draft copy, so drafts keep LCMScheduler and the adapter on every conditioning.
+    """
+    conditioning = conditioning_for(settings)
+    if conditioning == DEFAULT_CONDITIONING:
+        return fn
+
+    @functools.wraps(fn)
+    def run(first, second, target_pipe, _depth_estimator, *args, **kwargs):
+        with model_pool.acquire(conditioning) as variant:
+            variant_pipe = variant.pipe
+            if getattr(target_pipe, 'draft_adapter', None) is not None:
+                variant_pipe = variant.draft_pipe(target_pipe)
+            return fn(first, second, slot_pipeline(variant_pipe), variant.annotator, *args, **kwargs)
+    return run
+
+
+def _remember_draft(prompt: str, image: Image.Image, settings: Dict[str, Any], image_hash: str) -> str:
+    """Keep a draft's inputs so it can be re-rendered at full quality later"""
+    draft_id = str(uuid.uuid4())
+    _drafts[draft_id] = {"prompt": prompt, "image": image, "settings": settings, "input_hash": image_hash}
+    while len(_drafts) > DRAFT_CACHE_SIZE:
+        _drafts.popitem(last=False)
+    return draft_id
+
+def _request_hash(endpoint: str, image_bytes: bytes, prompt: str, settings: Dict[str, Any]) -> str:
+    """Hash of everything that determines a render (reuseExisting and profile excluded)"""
+    return canonical_request_hash(endpoint, image_bytes, prompt, hashed_settings(settings))
+
+
+def _record_generation(endpoint: str, job: Job, image_hash: str, prompt: Optional[str], settings: Dict[str, Any],
+                       outputs, input_size, timings: Optional[Dict[str, float]] = None,
+                       user_id: Optional[str] = None, request_hash: Optional[str] = None):
+    """Queue a metadata record for a completed generation (written in the background)"""
+    if metadata_store is None:
+        return
+    metadata_store.record(
+        job_id=job.job_id,
+        endpoint=endpoint,
+        input_hash=image_hash,
+        request_hash=request_hash,
+        user_id=user_id,
+        prompt=prompt,
+        settings=settings,
+        seed=settings.get('seed'),
+        outputs=outputs,
+        input_width=input_size[0],
+        input_height=input_size[1],
+        timings=timings or None,
+        stage_ms=round(sum(timings.values()) * 1000) if timings else None
     )
-else:
-    s3_client = None
 
 
-def _upload_image_return_url(image: Image.Image, key: str) -> str:
-    """Upload an image to R2 (if configured) and return a URL to access it.
+def _reused_response(settings: Dict[str, Any], request_hash: str) -> Optional[JSONResponse]:
+    """Output of an earlier identical render, for seeded requests that send reuseExisting"""
+    if metadata_store is None or not settings.get('reuseExisting') or not int(settings.get('seed', 0) or 0) > 0:
+        return None
+    previous = metadata_store.latest(request_hash)
+    if previous is None:
+        return None
+    logger.info(f"Reusing generation {previous['id']} (job {previous['job_id']}) for an identical request")
+    metrics.incr("generations_reused")
+    url = previous["outputs"][0]
+    return JSONResponse({
+        "success": True,
+        "output": [url, url],
+        "settings_used": previous["settings"],
+        "job_id": previous["job_id"],
+        "generation_id": previous["id"],
+        "timings": {},
+        "reused": True
+    })
+
 
-    Fallback: saves locally under images/ and returns the local file-serving endpoint.
+async def _run_inference(fn, *args, **kwargs):
+    """Run a blocking generation call on the next free inference slot"""
+    return await inference_executor.run(fn, *args, **kwargs)
+
+
+async def _execute_job(job: Job, work):
+    """Run work(job) to completion, recording the outcome in the registry and metrics"""
+    try:
+        result = await work(job)
+    except GenerationCancelled:
+        job_registry.finish(job, "cancelled")
+        metrics.incr("generations_cancelled")
+        metrics.incr("cancelled_steps_skipped", max(job.total_steps - job.step, 0))
+        raise
+    except Exception:
+        job_registry.finish(job, "failed")
+        metrics.incr("generations_failed")
+        raise
+    job_registry.finish(job, "completed")
+    metrics.incr("generations_completed")
+    return result
+
+
+async def _run_job(request: Request, job_id: Optional[str], work, flight_key: Optional[str] = None):
+    """Run work(job) as a cancellable job and wait for it. Returns (result, job, coalesced).
+
+    With a flight_key, identical concurrent requests attach to the one in-flight job instead
+    of starting their own. A request whose client disconnects detaches and gets
+    GenerationCancelled; the job itself is cancelled once its last subscriber is gone, so it
+    stops within one denoising step and never uploads an image nobody will fetch.
     """
-    if _r2_enabled and s3_client is not None:
-        buffer = BytesIO()
-        image.save(buffer, format="PNG")
-        buffer.seek(0)
-        s3_client.put_object(
-            Bucket=R2_BUCKET_NAME,
-            Key=key,
-            Body=buffer,
-            ContentType="image/png",
-        )
-        if R2_PUBLIC_BASE_URL:
-            return f"{R2_PUBLIC_BASE_URL.rstrip('/')}/{key}"
-        # Presigned fallback if no public base URL configured
-        return s3_client.generate_presigned_url(
-            ClientMethod="get_object",
-            Params={"Bucket": R2_BUCKET_NAME, "Key": key},
-            ExpiresIn=3600,
-        )
+    def start():
+        job = job_registry.create(job_id or request.headers.get("x-job-id"))
+        return job, asyncio.ensure_future(_execute_job(job, work))
+
+    job, task, coalesced = single_flight.join(flight_key, start)
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+        if done:
+            single_flight.leave(job)
+            return task.result(), job, coalesced
+        if await request.is_disconnected():
+            logger.info(f"Client disconnected from job {job.job_id}")
+            if single_flight.leave(job):
+                job.cancel()
+            raise GenerationCancelled(job.job_id)
+
+
+def _flight_key(endpoint: str, request: Request, job_id: Optional[str], image_bytes: bytes, prompt: str,
+                settings: Dict[str, Any], deterministic: bool, profile: bool) -> Optional[str]:
+    """Single-flight key for a request, or None if it must run as its own job.
+
+    Profiled requests, requests naming their own job id and deadline requests (whose plan
+    depends on the queue when they arrive) never coalesce.
+    """
+    if not deterministic or profile or settings.get('deadlineMs'):
+        return None
+    if job_id or request.headers.get("x-job-id"):
+        return None
+    return canonical_request_hash(endpoint, image_bytes, prompt, settings)
+
+
+def _profiled(fn, job: Job, enabled: bool):
+    """Wrap a generation function so it writes a profiler trace for the job, if enabled"""
+    if not enabled or trace_path(job.job_id) is None:
+        return fn
+    return functools.partial(run_profiled, job.job_id, fn)
+
+
+def _plan_memory(settings: Dict[str, Any], input_size, batch: int = 1):
+    """Memory plan for a request; raises MemoryBudgetExceeded if it can't fit"""
+    if memory_planner is None:
+        return None
+    return memory_planner.plan(input_size, settings, batch)
+
+
+def _budgeted(fn, plan, target_pipe, input_size, settings: Dict[str, Any]):
+    """Wrap a generation function so it runs under its memory plan (on the inference worker)"""
+    if plan is None:
+        return fn
+
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        with memory_planner.apply(target_pipe, plan, input_size, settings):
+            return fn(*args, **kwargs)
+    return run
+
+
+def _memory_response(e: MemoryBudgetExceeded) -> JSONResponse:
+    logger.warning(f"Rejected request: {e}")
+    return JSONResponse({
+        "success": False,
+        "error": str(e),
+        "needed_mb": round(e.needed_mb),
+        "limit_mb": round(e.limit_mb)
+    }, status_code=e.status_code)
+
+
+def _duplicate_job_response(e: DuplicateJobId) -> JSONResponse:
+    return JSONResponse({
+        "success": False,
+        "error": f"Job id {e} is already in use by a running job",
+        "job_id": str(e)
+    }, status_code=409)
+
+
+def _cancelled_response(job_id: str) -> JSONResponse:
+    logger.info(f"Job {job_id} cancelled")
+    return JSONResponse({
+        "success": False,
+        "error": "Generation cancelled",
+        "job_id": job_id
+    }, status_code=499)
+
+
+def _plan_for_deadline(settings: Dict[str, Any], input_size) -> Optional[Dict[str, Any]]:
+    """Fit steps, working resolution and upscaling to settings['deadlineMs'].
 
-    # Local fallback
-    local_path = f"images/{key}"
-    image.save(local_path)
-    return f"/images/{key}"
+    Updates settings in place and returns the plan report, or None without a deadline.
+    """
+    deadline_ms = settings.get('deadlineMs')
+    if not deadline_ms or is_draft(settings):
+        return None
+    overrides, predicted = cost_model.plan(
+        float(deadline_ms) / 1000, input_size, settings, inference_executor.jobs_ahead()
+    )
+    settings.update(overrides)
+    logger.info(f"Deadline {deadline_ms}ms planned {overrides} (predicted {predicted:.1f}s)")
+    return {
+        "deadline_ms": deadline_ms,
+        "predicted_ms": round(predicted * 1000),
+        "queue_depth": inference_executor.queue_depth(),
+        "planned": overrides
+    }
+
+
+def _record_timings(input_size, settings: Dict[str, Any], timings: Dict[str, float], job: Job):
+    """Feed measured stage timings into the cost model (skipped for renders that reused cached work)"""
+    if cost_model is not None and timings and not is_draft(settings) and not job.cache_reused:
+        cost_model.observe(input_size, settings, timings)
 
 @app.get("/")
 async def root():
@@ -108,9 +361,12 @@ async def health_check():
 
 @app.post("/generate/")
 async def generate(
+    request: Request,
     prompt: str = Form(...),
     file: UploadFile = File(...),
-    settings: str = Form(default="{}")
+    settings: str = Form(default="{}"),
+    job_id: Optional[str] = Form(default=None),
+    user_id: Optional[str] = Form(default=None)
 ):
     """Enhanced generation endpoint with backward compatibility"""
     try:
@@ -121,40 +377,111 @@ async def generate(
             settings_dict = {}
         
         # Save uploaded image
-        input_image = Image.open(file.file).convert("RGB")
+        image_bytes = await file.read()
+        input_image = Image.open(BytesIO(image_bytes)).convert("RGB")
         
         # Log input dimensions
         input_width, input_height = input_image.size
         logger.info(f"Input image dimensions: {input_width}x{input_height}")
         
-        # Use enhanced generation if available, otherwise fallback to basic
+        image_hash = input_hash(image_bytes)
+        request_hash = _request_hash("/generate/", image_bytes, prompt, settings_dict)
+        reused = _reused_response(settings_dict, request_hash)
+        if reused is not None:
+            return reused
+        
+        # Opt-in profiling, rate-limited
+        profile = ENHANCED_FEATURES and profiling_requested(request.headers, settings_dict) and acquire_profile_slot()
+        
         if ENHANCED_FEATURES and settings_dict:
-            output_image = generate_image_advanced(prompt, input_image, pipe, depth_estimator, settings_dict)
-        else:
-            output_image = generate_image(prompt, input_image, pipe, depth_estimator)
+            invalid = _conditioning_response(settings_dict)
+            if invalid is not None:
+                return invalid
         
-        # Log output dimensions
-        output_width, output_height = output_image.size
-        logger.info(f"Output image dimensions: {output_width}x{output_height}")
+        # Drafts need a concrete seed so the upgrade reproduces them
+        draft = ENHANCED_FEATURES and is_draft(settings_dict)
+        if draft:
+            settings_dict['seed'] = resolve_seed(settings_dict)
         
-        # Verify dimensions match
-        if input_width == output_width and input_height == output_height:
-            logger.info("✅ Output dimensions match input dimensions")
-        else:
-            logger.warning("❌ Output dimensions do not match input dimensions")
+        started = time.perf_counter()
+        deadline = _plan_for_deadline(settings_dict, input_image.size) if ENHANCED_FEATURES else None
+        memory_plan = _plan_memory(settings_dict, input_image.size)
+        
+        # Identical requests coalesce only when the output is deterministic
+        # (the basic path uses a fixed seed); keyed on the settings as planned
+        flight_key = _flight_key(
+            "/generate/", request, job_id, image_bytes, prompt, settings_dict,
+            deterministic=not settings_dict or settings_dict.get('seed', 0) > 0, profile=profile
+        )
+        
+        async def work(job: Job) -> Dict[str, Any]:
+            timings: Dict[str, float] = {}
+            target_pipe = _pipe_for(settings_dict) if ENHANCED_FEATURES else pipe
+            
+            # Use enhanced generation if available, otherwise fallback to basic
+            if ENHANCED_FEATURES and settings_dict:
+                output_image = await _run_inference(
+                    _budgeted(_profiled(_conditioned(generate_image_advanced, settings_dict), job, profile),
+                              memory_plan, target_pipe, input_image.size, settings_dict),
+                    prompt, input_image, target_pipe, depth_estimator, settings_dict, timings=timings, job=job
+                )
+            else:
+                # Only the guidance shortcuts carry over to the fixed basic pipeline
+                output_image = await _run_inference(
+                    _budgeted(generate_image, memory_plan, target_pipe, input_image.size, settings_dict),
+                    prompt, input_image, pipe, depth_estimator, job=job,
+                    cfg_cutoff=settings_dict.get('cfgCutoff'), control_end=settings_dict.get('controlEnd')
+                )
+            job.check()
+            
+            # Log output dimensions
+            output_width, output_height = output_image.size
+            logger.info(f"Output image dimensions: {output_width}x{output_height}")
+            
+            # Verify dimensions match
+            if input_width == output_width and input_height == output_height:
+                logger.info("✅ Output dimensions match input dimensions")
+            else:
+                logger.warning("❌ Output dimensions do not match input dimensions")
 
-        # Upload and return URL(s)
-        key = f"{uuid.uuid4()}.png"
-        url = _upload_image_return_url(output_image, key)
+            # Upload and return URL(s)
+            key = f"{uuid.uuid4()}.png"
+            with stage(timings, STAGE_UPLOAD):
+                url = upload_image_return_url(output_image, key)
+            _record_timings(input_image.size, settings_dict, timings, job)
+            _record_generation("/generate/", job, image_hash, prompt, settings_dict, [url], input_image.size,
+                               timings, user_id, request_hash)
 
-        return JSONResponse({
-            "success": True,
-            "output": [url, url],
-            "settings_used": settings_dict,
-            "input_dimensions": [input_width, input_height],
-            "output_dimensions": [output_width, output_height]
-        })
+            return {
+                "success": True,
+                "output": [url, url],
+                "settings_used": settings_dict,
+                "input_dimensions": [input_width, input_height],
+                "output_dimensions": [output_width, output_height],
+                "job_id": job.job_id,
+                "timings": timings,
+                "memory": memory_plan.to_dict() if memory_plan is not None else None
+            }
+
+        result, job, coalesced = await _run_job(request, job_id, work, flight_key)
+        response = {**result, "coalesced": coalesced}
+        if profile and trace_written(job.job_id):
+            response["trace_url"] = f"/traces/{job.job_id}"
+        if deadline is not None:
+            deadline["actual_ms"] = round((time.perf_counter() - started) * 1000)
+            deadline["met"] = deadline["actual_ms"] <= deadline["deadline_ms"]
+            response["deadline"] = deadline
+        if draft:
+            response["draft_id"] = _remember_draft(prompt, input_image, settings_dict, image_hash)
+            response["seed"] = settings_dict['seed']
+        return JSONResponse(response)
         
+    except GenerationCancelled as e:
+        return _cancelled_response(str(e))
+    except DuplicateJobId as e:
+        return _duplicate_job_response(e)
+    except MemoryBudgetExceeded as e:
+        return _memory_response(e)
     except Exception as e:
         logger.error(f"Generation error: {str(e)}")
         return JSONResponse({
@@ -164,9 +491,12 @@ async def generate(
 
 @app.post("/generate/advanced")
 async def generate_advanced(
+    request: Request,
     prompt: str = Form(...),
     file: UploadFile = File(...),
-    settings: str = Form(default="{}")
+    settings: str = Form(default="{}"),
+    job_id: Optional[str] = Form(default=None),
+    user_id: Optional[str] = Form(default=None)
 ):
     """Advanced generation with custom settings"""
     if not ENHANCED_FEATURES:
@@ -183,35 +513,87 @@ async def generate_advanced(
             settings_dict = {}
         
         # Default settings with overrides
-        default_settings = {
-            'steps': 20,
-            'guidanceScale': 7.5,
-            'strength': 0.8,
-            'seed': 0,
-            'enableUpscaling': False,
-            'preserveColors': False,
-            'enhanceLighting': True,
-            'style': 'Modern',
-            'roomType': 'Living Room'
-        }
-        default_settings.update(settings_dict)
+        default_settings = {**ADVANCED_SETTINGS, **settings_dict}
+        invalid = _conditioning_response(default_settings)
+        if invalid is not None:
+            return invalid
         
         # Save uploaded image
-        input_image = Image.open(file.file).convert("RGB")
+        image_bytes = await file.read()
+        input_image = Image.open(BytesIO(image_bytes)).convert("RGB")
         
-        # Generate image
-        output_image = generate_image_advanced(prompt, input_image, pipe, depth_estimator, default_settings)
+        image_hash = input_hash(image_bytes)
+        request_hash = _request_hash("/generate/advanced", image_bytes, prompt, default_settings)
+        reused = _reused_response(default_settings, request_hash)
+        if reused is not None:
+            return reused
         
-        # Upload and return URL(s)
-        key = f"{uuid.uuid4()}.png"
-        url = _upload_image_return_url(output_image, key)
+        # Opt-in profiling, rate-limited
+        profile = profiling_requested(request.headers, default_settings) and acquire_profile_slot()
+        
+        # Drafts need a concrete seed so the upgrade reproduces them
+        draft = is_draft(default_settings)
+        if draft:
+            default_settings['seed'] = resolve_seed(default_settings)
+        
+        started = time.perf_counter()
+        deadline = _plan_for_deadline(default_settings, input_image.size)
+        memory_plan = _plan_memory(default_settings, input_image.size)
+        
+        # Identical requests coalesce only when the seed is deterministic; keyed on the settings as planned
+        flight_key = _flight_key(
+            "/generate/advanced", request, job_id, image_bytes, prompt, default_settings,
+            deterministic=default_settings.get('seed', 0) > 0, profile=profile
+        )
+        
+        async def work(job: Job) -> Dict[str, Any]:
+            timings: Dict[str, float] = {}
+            target_pipe = _pipe_for(default_settings)
+            
+            # Generate image
+            output_image = await _run_inference(
+                _budgeted(_profiled(_conditioned(generate_image_advanced, default_settings), job, profile),
+                          memory_plan, target_pipe, input_image.size, default_settings),
+                prompt, input_image, target_pipe, depth_estimator, default_settings, timings=timings, job=job
+            )
+            job.check()
+            
+            # Upload and return URL(s)
+            key = f"{uuid.uuid4()}.png"
+            with stage(timings, STAGE_UPLOAD):
+                url = upload_image_return_url(output_image, key)
+            _record_timings(input_image.size, default_settings, timings, job)
+            _record_generation("/generate/advanced", job, image_hash, prompt, default_settings, [url],
+                               input_image.size, timings, user_id, request_hash)
 
-        return JSONResponse({
-            "success": True,
-            "output": [url, url],
-            "settings_used": default_settings
-        })
+            return {
+                "success": True,
+                "output": [url, url],
+                "settings_used": default_settings,
+                "job_id": job.job_id,
+                "timings": timings,
+                "memory": memory_plan.to_dict()
+            }
+
+        result, job, coalesced = await _run_job(request, job_id, work, flight_key)
+        response = {**result, "coalesced": coalesced}
+        if profile and trace_written(job.job_id):
+            response["trace_url"] = f"/traces/{job.job_id}"
+        if deadline is not None:
+            deadline["actual_ms"] = round((time.perf_counter() - started) * 1000)
+            deadline["met"] = deadline["actual_ms"] <= deadline["deadline_ms"]
+            response["deadline"] = deadline
+        if draft:
+            response["draft_id"] = _remember_draft(prompt, input_image, default_settings, image_hash)
+            response["seed"] = default_settings['seed']
+        return JSONResponse(response)
         
+    except GenerationCancelled as e:
+        return _cancelled_response(str(e))
+    except DuplicateJobId as e:
+        return _duplicate_job_response(e)
+    except MemoryBudgetExceeded as e:
+        return _memory_response(e)
     except Exception as e:
         logger.error(f"Advanced generation error: {str(e)}")
         return JSONResponse({
@@ -219,12 +601,91 @@ async def generate_advanced(
             "error": str(e)
         }, status_code=500)
 
+@app.post("/generate/upgrade")
+async def upgrade_draft(
+    request: Request,
+    draft_id: str = Form(...),
+    settings: str = Form(default="{}"),
+    job_id: Optional[str] = Form(default=None),
+    user_id: Optional[str] = Form(default=None)
+):
+    """Re-render a previous draft at full quality with the same seed"""
+    if not ENHANCED_FEATURES:
+        return JSONResponse({
+            "success": False,
+            "error": "Enhanced features not available. Please install required dependencies."
+        }, status_code=501)
+    
+    draft = _drafts.get(draft_id)
+    if draft is None:
+        return JSONResponse({
+            "success": False,
+            "error": "Draft not found or expired"
+        }, status_code=404)
+    
+    try:
+        # Parse overrides (the seed always comes from the draft)
+        try:
+            settings_dict = json.loads(settings)
+        except json.JSONDecodeError:
+            settings_dict = {}
+        
+        final_settings = {**draft["settings"], **settings_dict}
+        final_settings['quality'] = 'final'
+        final_settings['seed'] = draft["settings"]['seed']
+        final_settings.pop('draftSteps', None)
+        invalid = _conditioning_response(final_settings)
+        if invalid is not None:
+            return invalid
+        memory_plan = _plan_memory(final_settings, draft["image"].size)
+        
+        async def work(job: Job) -> Dict[str, Any]:
+            output_image = await _run_inference(
+                _budgeted(_conditioned(generate_image_advanced, final_settings), memory_plan, pipe,
+                          draft["image"].size, final_settings),
+                draft["prompt"], draft["image"], pipe, depth_estimator, final_settings, job=job
+            )
+            job.check()
+            
+            key = f"{uuid.uuid4()}.png"
+            url = upload_image_return_url(output_image, key)
+            _record_generation("/generate/upgrade", job, draft["input_hash"], draft["prompt"], final_settings,
+                               [url], draft["image"].size, user_id=user_id)
+            
+            return {
+                "success": True,
+                "output": [url, url],
+                "settings_used": final_settings,
+                "seed": final_settings['seed'],
+                "job_id": job.job_id,
+                "memory": memory_plan.to_dict()
+            }
+        
+        result, _, _ = await _run_job(request, job_id, work)
+        return JSONResponse(result)
+        
+    except GenerationCancelled as e:
+        return _cancelled_response(str(e))
+    except DuplicateJobId as e:
+        return _duplicate_job_response(e)
+    except MemoryBudgetExceeded as e:
+        return _memory_response(e)
+    except Exception as e:
+        logger.error(f"Draft upgrade error: {str(e)}")
+        return JSONResponse({
+            "success": False,
+            "error": str(e)
+        }, status_code=500)
+
 @app.post("/generate/variations")
 async def generate_variations(
+    request: Request,
     prompt: str = Form(...),
     file: UploadFile = File(...),
     settings: str = Form(default="{}"),
-    num_variations: int = Form(default=3)
+    num_variations: int = Form(default=3),
+    job_id: Optional[str] = Form(default=None),
+    user_id: Optional[str] = Form(default=None)
 ):
     """Generate multiple variations of the same design"""
     if not ENHANCED_FEATURES:
@@ -253,79 +714,452 @@ async def generate_variations(
             'roomType': 'Living Room'
         }
         default_settings.update(settings_dict)
+        invalid = _conditioning_response(default_settings)
+        if invalid is not None:
+            return invalid
         
         # Limit variations
         num_variations = min(max(1, num_variations), 5)
         
         # Save uploaded image
-        input_image = Image.open(file.file).convert("RGB")
+        image_bytes = await file.read()
+        input_image = Image.open(BytesIO(image_bytes)).convert("RGB")
+        
+        # Variations render one after another, so each must fit on its own
+        memory_plan = _plan_memory(default_settings, input_image.size)
         
         # Generate variations
-        variations = generate_multiple_variations(
-            prompt, input_image, pipe, depth_estimator, default_settings, num_variations
+        async def work(job: Job) -> Dict[str, Any]:
+            variations = await _run_inference(
+                _budgeted(_conditioned(generate_multiple_variations, default_settings), memory_plan, pipe,
+                          input_image.size, default_settings),
+                prompt, input_image, pipe, depth_estimator, default_settings, num_variations, job=job
+            )
+            job.check()
+            
+            # Upload all variations and return URLs
+            urls = []
+            for i, variation in enumerate(variations):
+                key = f"{uuid.uuid4()}_var_{i}.png"
+                url = upload_image_return_url(variation, key)
+                urls.append(url)
+            _record_generation("/generate/variations", job, input_hash(image_bytes), prompt, default_settings,
+                               urls, input_image.size, user_id=user_id)
+            
+            return {
+                "success": True,
+                "variations": urls,
+                "num_generated": len(urls),
+                "settings_used": default_settings,
+                "job_id": job.job_id,
+                "memory": memory_plan.to_dict()
+            }
+        
+        result, _, _ = await _run_job(request, job_id, work)
+        return JSONResponse(result)
+        
+    except GenerationCancelled as e:
+        return _cancelled_response(str(e))
+    except DuplicateJobId as e:
+        return _duplicate_job_response(e)
+    except MemoryBudgetExceeded as e:
+        return _memory_response(e)
+    except Exception as e:
+        logger.error(f"Variations generation error: {str(e)}")
+        return JSONResponse({
+            "success": False,
+            "error": str(e)
+        }, status_code=500)
+
+@app.post("/generate/sweep")
+async def generate_sweep(
+    request: Request,
+    file: UploadFile = File(...),
+    combinations: str = Form(...),
+    settings: str = Form(default="{}"),
+    job_id: Optional[str] = Form(default=None),
+    user_id: Optional[str] = Form(default=None)
+):
+    """Render one photo in several theme/room combinations in batched runs"""
+    if not ENHANCED_FEATURES:
+        return JSONResponse({
+            "success": False,
+            "error": "Enhanced features not available. Please install required dependencies."
+        }, status_code=501)
+    
+    try:
+        try:
+            combinations_list = json.loads(combinations)
+            combinations_list = [
+                {"theme": str(c["theme"]), "room": str(c.get("room", "Living Room"))} for c in combinations_list
+            ]
+        except (json.JSONDecodeError, TypeError, KeyError):
+            return JSONResponse({
+                "success": False,
+                "error": 'combinations must be a JSON list of {"theme": ..., "room": ...}'
+            }, status_code=400)
+        if not combinations_list:
+            return JSONResponse({
+                "success": False,
+                "error": "No combinations given"
+            }, status_code=400)
+        combinations_list = combinations_list[:MAX_SWEEP_COMBINATIONS]
+        
+        # Parse settings
+        try:
+            settings_dict = json.loads(settings)
+        except json.JSONDecodeError:
+            settings_dict = {}
+        
+        default_settings = {
+            'steps': 20,
+            'guidanceScale': 7.5,
+            'strength': 0.8,
+            'seed': 0,
+            'enableUpscaling': False,
+            'preserveColors': False,
+            'enhanceLighting': True
+        }
+        default_settings.update(settings_dict)
+        default_settings['seed'] = resolve_seed(default_settings)
+        invalid = _conditioning_response(default_settings)
+        if invalid is not None:
+            return invalid
+        
+        image_bytes = await file.read()
+        input_image = Image.open(BytesIO(image_bytes)).convert("RGB")
+        
+        # Batch size is whatever fits the memory budget
+        memory_plan = _plan_memory(
+            default_settings, input_image.size, batch=min(len(combinations_list), SWEEP_MAX_BATCH)
         )
         
-        # Upload all variations and return URLs
-        urls = []
-        for i, variation in enumerate(variations):
-            key = f"{uuid.uuid4()}_var_{i}.png"
-            url = _upload_image_return_url(variation, key)
-            urls.append(url)
+        async def work(job: Job) -> Dict[str, Any]:
+            timings: Dict[str, float] = {}
+            outputs = await _run_inference(
+                _budgeted(_conditioned(generate_style_sweep, default_settings), memory_plan, pipe,
+                          input_image.size, default_settings),
+                input_image, combinations_list, pipe, depth_estimator, default_settings,
+                batch_size=memory_plan.batch, timings=timings, job=job
+            )
+            job.check()
+            
+            labels = [f"{c['theme']} {c['room']}" for c in combinations_list]
+            sweep_id = uuid.uuid4()
+            with stage(timings, STAGE_UPLOAD):
+                urls = [
+                    upload_image_return_url(output, f"{sweep_id}_sweep_{i}.png") for i, output in enumerate(outputs)
+                ]
+                grid_url = upload_image_return_url(make_grid(outputs, labels), f"{sweep_id}_sweep_grid.png")
+            _record_generation("/generate/sweep", job, input_hash(image_bytes), None,
+                               {**default_settings, 'combinations': combinations_list}, urls, input_image.size,
+                               timings, user_id)
+            
+            return {
+                "success": True,
+                "grid": grid_url,
+                "results": [
+                    {**combination, "url": url, "seed": default_settings['seed'] + i}
+                    for i, (combination, url) in enumerate(zip(combinations_list, urls))
+                ],
+                "settings_used": default_settings,
+                "batch_size": memory_plan.batch,
+                "job_id": job.job_id,
+                "timings": timings,
+                "memory": memory_plan.to_dict()
+            }
+        
+        result, _, _ = await _run_job(request, job_id, work)
+        return JSONResponse(result)
+        
+    except GenerationCancelled as e:
+        return _cancelled_response(str(e))
+    except DuplicateJobId as e:
+        return _duplicate_job_response(e)
+    except MemoryBudgetExceeded as e:
+        return _memory_response(e)
+    except Exception as e:
+        logger.error(f"Style sweep error: {str(e)}")
+        return JSONResponse({
+            "success": False,
+            "error": str(e)
+        }, status_code=500)
 
+@app.post("/generate/masked")
+async def generate_masked(
+    request: Request,
+    prompt: str = Form(...),
+    file: UploadFile = File(...),
+    mask: UploadFile = File(...),
+    settings: str = Form(default="{}"),
+    job_id: Optional[str] = Form(default=None),
+    user_id: Optional[str] = Form(default=None)
+):
+    """Redesign only the masked region (white = change) and keep the rest of the photo"""
+    if not ENHANCED_FEATURES:
         return JSONResponse({
-            "success": True,
-            "variations": urls,
-            "num_generated": len(urls),
-            "settings_used": default_settings
-        })
+            "success": False,
+            "error": "Enhanced features not available. Please install required dependencies."
+        }, status_code=501)
+    
+    try:
+        # Parse settings
+        try:
+            settings_dict = json.loads(settings)
+        except json.JSONDecodeError:
+            settings_dict = {}
+        
+        default_settings = {
+            'steps': 20,
+            'guidanceScale': 7.5,
+            'strength': 1.0,
+            'seed': 0,
+            'maskMargin': 0.15,
+            'enhanceLighting': True,
+            'style': 'Modern',
+            'roomType': 'Living Room'
+        }
+        default_settings.update(settings_dict)
+        
+        image_bytes = await file.read()
+        input_image = Image.open(BytesIO(image_bytes)).convert("RGB")
+        mask_image = Image.open(BytesIO(await mask.read()))
+        
+        # Conservative: planned as if the whole frame were rendered
+        memory_plan = _plan_memory(default_settings, input_image.size)
+        inpaint_pipe = get_inpaint_pipe()
         
+        async def work(job: Job) -> Dict[str, Any]:
+            timings: Dict[str, float] = {}
+            output_image, region = await _run_inference(
+                _budgeted(generate_masked_region, memory_plan, inpaint_pipe, input_image.size, default_settings),
+                prompt, input_image, mask_image, inpaint_pipe, depth_estimator, default_settings,
+                timings=timings, job=job
+            )
+            job.check()
+            
+            key = f"{uuid.uuid4()}.png"
+            with stage(timings, STAGE_UPLOAD):
+                url = upload_image_return_url(output_image, key)
+            _record_generation("/generate/masked", job, input_hash(image_bytes), prompt, default_settings, [url],
+                               input_image.size, timings, user_id)
+            
+            return {
+                "success": True,
+                "output": [url, url],
+                "settings_used": default_settings,
+                "region": region,
+                "job_id": job.job_id,
+                "timings": timings,
+                "memory": memory_plan.to_dict()
+            }
+        
+        result, _, _ = await _run_job(request, job_id, work)
+        return JSONResponse(result)
+        
+    except GenerationCancelled as e:
+        return _cancelled_response(str(e))
+    except DuplicateJobId as e:
+        return _duplicate_job_response(e)
+    except MemoryBudgetExceeded as e:
+        return _memory_response(e)
+    except EmptyMaskError as e:
+        return JSONResponse({
+            "success": False,
+            "error": str(e)
+        }, status_code=400)
     except Exception as e:
-        logger.error(f"Variations generation error: {str(e)}")
+        logger.error(f"Masked generation error: {str(e)}")
         return JSONResponse({
             "success": False,
             "error": str(e)
         }, status_code=500)
 
+@app.post("/queue/jobs")
+async def enqueue_job(
+    prompt: str = Form(...),
+    file: UploadFile = File(...),
+    settings: str = Form(default="{}")
+):
+    """Queue a generation for the worker nodes; poll /queue/jobs/{job_id} for the result"""
+    if job_queue is None:
+        return JSONResponse({
+            "success": False,
+            "error": "Distributed mode not enabled. Set JOB_QUEUE_URL."
+        }, status_code=501)
+    
+    try:
+        settings_dict = json.loads(settings)
+    except json.JSONDecodeError:
+        settings_dict = {}
+    queued_settings = {**ADVANCED_SETTINGS, **settings_dict}
+    invalid = _conditioning_response(queued_settings)
+    if invalid is not None:
+        return invalid
+    
+    image_bytes = await file.read()
+    try:
+        Image.open(BytesIO(image_bytes)).verify()
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid image")
+    
+    job_id = job_queue.enqueue(prompt, queued_settings, image_bytes)
+    return {"success": True, "job_id": job_id}
+
+@app.get("/queue/jobs/{job_id}")
+async def get_queued_job(job_id: str):
+    """Status of a queued job, with its output URLs once done"""
+    if job_queue is None:
+        raise HTTPException(status_code=501, detail="Distributed mode not enabled")
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.get("/queue/stats")
+async def get_queue_stats():
+    """Job counts by status in the shared queue"""
+    if job_queue is None:
+        raise HTTPException(status_code=501, detail="Distributed mode not enabled")
+    return job_queue.stats()
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Status and denoising progress of a generation job"""
+    job = job_registry.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+@app.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    """Cancel an in-flight generation; it stops within one denoising step"""
+    if not job_registry.cancel(job_id):
+        raise HTTPException(status_code=404, detail="Job not found or already finished")
+    return {"success": True, "job_id": job_id}
+
+@app.get("/traces/{job_id}")
+async def get_trace(job_id: str):
+    """Chrome-trace file of a profiled job (open in chrome://tracing or Perfetto)"""
+    path = trace_path(job_id)
+    if path is None or not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Trace not found")
+    return FileResponse(path, media_type="application/json")
+
+def _require_metadata_token(request: Request):
+    """Reject /generations calls without the server's METADATA_API_TOKEN"""
+    if metadata_store is None:
+        raise HTTPException(status_code=501, detail="Generation records disabled. Set METADATA_DB_PATH.")
+    if not METADATA_API_TOKEN:
+        raise HTTPException(status_code=403, detail="Generation records API disabled. Set METADATA_API_TOKEN.")
+    token = request.headers.get("x-metadata-token", "")
+    if not secrets.compare_digest(token.encode(), METADATA_API_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Invalid or missing X-Metadata-Token")
+
+@app.get("/generations")
+async def list_generations(
+    request: Request,
+    input_hash: Optional[str] = None,
+    user_id: Optional[str] = None,
+    request_hash: Optional[str] = None,
+    job_id: Optional[str] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    limit: int = 50
+):
+    """Recorded generations matching the filters (unix-time since/until), newest first"""
+    _require_metadata_token(request)
+    return {"generations": metadata_store.find(
+        input_hash=input_hash, user_id=user_id, request_hash=request_hash, job_id=job_id,
+        since=since, until=until, limit=limit
+    )}
+
+@app.post("/generations/lookup")
+async def lookup_generations(request: Request, file: UploadFile = File(...), limit: int = Form(default=20)):
+    """Earlier generations from the same input photo (matched by its bytes)"""
+    _require_metadata_token(request)
+    image_hash = input_hash(await file.read())
+    return {"input_hash": image_hash, "generations": metadata_store.find(input_hash=image_hash, limit=limit)}
+
+@app.get("/generations/{generation_id}")
+async def get_generation(request: Request, generation_id: str):
+    """One recorded generation by its record id (see the job_id filter of /generations for lookups by job)"""
+    _require_metadata_token(request)
+    record = metadata_store.get(generation_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Generation not found")
+    return record
+
+@app.on_event("shutdown")
+def close_metadata_store():
+    """Write out queued generation records before exiting"""
+    if metadata_store is not None:
+        metadata_store.close()
+
+@app.get("/metrics")
+async def get_metrics():
+    """Generation counters (completed, failed, cancelled), runtime gauges and inference slot usage"""
+    executor = inference_executor.snapshot()
+    metrics.set_gauge("queue_depth", executor["waiting"] + executor["running"])
+    metrics.set_gauge("inference_waiting", executor["waiting"])
+    metrics.set_gauge("inference_slots_busy", executor["running"])
+    metrics.set_gauge("flights_in_flight", single_flight.in_flight())
+    return {
+        **metrics.snapshot(),
+        "inference": executor,
+        "metadata_store": metadata_store.stats() if metadata_store is not None else None
+    }
+
 @app.get("/models/info")
 async def get_model_info():
     """Get information about loaded models"""
     return {
         "stable_diffusion_model": "runwayml/stable-diffusion-v1-5",
         "controlnet_model": "lllyasviel/sd-controlnet-depth",
-        "depth_estimator": "depth-estimation",
+        "depth_estimator": depth_estimator.describe(),
+        "controlnet_pool": model_pool.snapshot(),
         "device": "cuda" if pipe.device.type == "cuda" else "cpu",
         "enhanced_features": ENHANCED_FEATURES,
         "optimizations": {
-            "memory_efficient_attention": True,
+            "attention": tuned_config["attention"] if tuned_config else "default",
+            "intra_op_threads": torch.get_num_threads(),
+            "tuned_intra_op_threads": inference_executor.tuned_threads,
+            "inter_op_threads": torch.get_num_interop_threads(),
+            "inference_slots": len(inference_executor.slots),
+            "intra_op_threads_per_slot": inference_executor.slots[0].threads,
             "cpu_offload": pipe.device.type == "cuda"
         },
         "storage": {
-            "r2_enabled": _r2_enabled,
-            "bucket": R2_BUCKET_NAME if _r2_enabled else None,
-        }
+            "r2_enabled": r2_enabled,
+            "bucket": R2_BUCKET_NAME if r2_enabled else None,
+        },
+        "cost_model": cost_model.snapshot() if cost_model is not None else None,
+        "memory_budget": memory_planner.snapshot() if memory_planner is not None else None,
+        "latent_cache": latent_cache.snapshot() if ENHANCED_FEATURES else None,
+        "resolution_buckets": [f"{w}x{h}" for w, h in bucket_sizes()]
     }
 
 # Serve static files
-@app.get("/images/{image_name}")
+@app.get("/images/{image_name:path}")
 async def get_image(image_name: str):
-    """Serve generated images from local fallback storage."""
-    image_path = f"images/{image_name}"
-    if os.path.exists(image_path):
+    """Serve generated images from local fallback storage (keys may include a prefix, e.g. bulk/)."""
+    image_path = local_image_path(image_name)
+    if image_path is not None and os.path.isfile(image_path):
         return FileResponse(image_path, media_type="image/png")
     raise HTTPException(status_code=404, detail="Image not found")
 
 
-@app.delete("/images/{image_key}")
+@app.delete("/images/{image_key:path}")
 async def delete_image(image_key: str):
     """Delete a generated image either from R2 (if configured) or local storage."""
     try:
-        if _r2_enabled and s3_client is not None:
+        if r2_enabled and s3_client is not None:
             s3_client.delete_object(Bucket=R2_BUCKET_NAME, Key=image_key)
             return {"success": True, "message": "Image deleted from R2"}
 
         # Local fallback
-        image_path = f"images/{image_key}"
-        if os.path.exists(image_path):
+        image_path = local_image_path(image_key)
+        if image_path is not None and os.path.isfile(image_path):
             os.remove(image_path)
             return {"success": True, "message": "Image deleted from local storage"}
         raise HTTPException(status_code=404, detail="Image not found")
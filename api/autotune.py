@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Attention and thread autotuner.
+
+Times a few denoising steps at every bucket resolution for each candidate
+attention implementation and thread count on this host, and stores the winner
+in a JSON file that model_loader applies on later starts. Runs automatically on
+the first start (no config for this host yet); run it by hand to re-tune:
+
+    python autotune.py            # tune and overwrite the config
+    python autotune.py --quick    # only the square bucket, no inter-op probing
+
+Environment:
+
+    AUTOTUNE=auto|force|off       auto (default): tune only when no config matches the host
+    AUTOTUNE_CONFIG=path          where the config lives (default: api/autotune.json)
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+from PIL import Image
+
+from buckets import bucket_sizes
+
+AUTOTUNE_CONFIG = os.getenv(
+    "AUTOTUNE_CONFIG", os.path.join(os.path.dirname(os.path.abspath(__file__)), "autotune.json")
+)
+AUTOTUNE_MODE = os.getenv("AUTOTUNE", "auto").lower()
+
+# Denoising steps per timed call; the first call per candidate is an untimed warm-up
+BENCH_STEPS = 2
+
+
+def host_fingerprint(device: str) -> Dict[str, Any]:
+    """What a tuned config depends on; a config for a different host is ignored"""
+    fingerprint = {
+        "device": device,
+        "cpus": len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count(),
+        "torch": torch.__version__.split("+")[0],
+    }
+    if device == "cuda":
+        fingerprint["gpu"] = torch.cuda.get_device_name(0)
+    return fingerprint
+
+
+def load_config(device: str, path: str = AUTOTUNE_CONFIG) -> Optional[Dict[str, Any]]:
+    """The stored config if it was tuned on this host, otherwise None"""
+    if AUTOTUNE_MODE in ("off", "0") or not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            config = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"Ignoring unreadable autotune config {path}: {e}")
+        return None
+    if config.get("host") != host_fingerprint(device):
+        print(f"Autotune config {path} was tuned on a different host, ignoring it")
+        return None
+    return config
+
+
+def save_config(config: Dict[str, Any], path: str = AUTOTUNE_CONFIG):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(config, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def apply_threads(config: Dict[str, Any]):
+    """Set torch thread pools from a config (inter-op only before any parallel work ran)"""
+    intra = config.get("intra_op_threads")
+    if intra:
+        torch.set_num_threads(int(intra))
+    inter = config.get("inter_op_threads")
+    if inter and torch.get_num_interop_threads() != int(inter):
+        try:
+            torch.set_num_interop_threads(int(inter))
+        except RuntimeError:
+            print(f"Inter-op threads already fixed at {torch.get_num_interop_threads()}; "
+                  f"restart to use {inter}")
+
+
+def attention_candidates(device: str) -> List[str]:
+    candidates = ["sdpa", "classic", "sliced"]
+    if not hasattr(torch.nn.functional, "scaled_dot_product_attention"):
+        candidates.remove("sdpa")
+    if device == "cuda":
+        try:
+            import xformers  # noqa: F401
+            candidates.append("xformers")
+        except ImportError:
+            pass
+    return candidates
+
+
+def apply_attention(pipe, name: str):
+    """Switch the UNet and ControlNet to an attention implementation by name"""
+    from diffusers.models.attention_processor import AttnProcessor, AttnProcessor2_0
+
+    if name == "xformers":
+        pipe.enable_xformers_memory_efficient_attention()
+        return
+    pipe.disable_attention_slicing()
+    if name == "sliced":
+        pipe.enable_attention_slicing("auto")
+        return
+    processor = AttnProcessor2_0 if name == "sdpa" else AttnProcessor
+    for model in (pipe.unet, pipe.controlnet):
+        model.set_attn_processor(processor())
+
+
+def thread_candidates() -> List[int]:
+    cpus = host_fingerprint("cpu")["cpus"] or 1
+    candidates = {cpus, max(1, cpus // 2), max(1, cpus * 3 // 4), torch.get_num_threads()}
+    return sorted(candidates, reverse=True)
+
+
+def seconds_per_step(pipe, sizes: List[Tuple[int, int]]) -> float:
+    """Mean seconds per denoising step over the given working sizes"""
+    def run(size):
+        pipe(
+            prompt="interior design",
+            image=Image.new("RGB", size, (128, 128, 128)),
+            num_inference_steps=BENCH_STEPS,
+            output_type="latent"
+        )
+
+    run(sizes[0])  # warm-up for this candidate
+    total = 0.0
+    for size in sizes:
+        started = time.perf_counter()
+        run(size)
+        total += time.perf_counter() - started
+    return total / (len(sizes) * BENCH_STEPS)
+
+
+def _probe_interop(threads: int, config: Dict[str, Any], sizes) -> Optional[float]:
+    """Time one inter-op thread count in a fresh process (it can only be set once per process)"""
+    probe = {**config, "inter_op_threads": threads, "sizes": sizes}
+    env = {**os.environ, "AUTOTUNE": "off"}
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--probe", json.dumps(probe)],
+        capture_output=True, text=True, env=env, cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    if result.returncode != 0:
+        print(f"  inter-op {threads}: probe failed: {result.stderr.strip().splitlines()[-1:]}")
+        return None
+    return json.loads(result.stdout.strip().splitlines()[-1])["seconds_per_step"]
+
+
+def tune(pipe, device: str, sizes: Optional[List[Tuple[int, int]]] = None,
+         probe_interop: bool = True) -> Dict[str, Any]:
+    """Benchmark candidates on this host and return the winning config"""
+    sizes = sizes or bucket_sizes()
+    results: Dict[str, Dict[str, float]] = {"attention": {}, "intra_op_threads": {}, "inter_op_threads": {}}
+    print(f"Autotuning attention and threads at {', '.join(f'{w}x{h}' for w, h in sizes)}")
+
+    for name in attention_candidates(device):
+        try:
+            apply_attention(pipe, name)
+            results["attention"][name] = seconds_per_step(pipe, sizes)
+        except Exception as e:
+            print(f"  attention {name}: failed ({e})")
+            continue
+        print(f"  attention {name}: {results['attention'][name]:.3f}s/step")
+    attention = min(results["attention"], key=results["attention"].get)
+    apply_attention(pipe, attention)
+
+    config = {
+        "host": host_fingerprint(device),
+        "attention": attention,
+        "intra_op_threads": None,
+        "inter_op_threads": None,
+    }
+
+    if device == "cpu":
+        for threads in thread_candidates():
+            torch.set_num_threads(threads)
+            results["intra_op_threads"][str(threads)] = seconds_per_step(pipe, sizes)
+            print(f"  intra-op {threads}: {results['intra_op_threads'][str(threads)]:.3f}s/step")
+        intra = min(results["intra_op_threads"], key=results["intra_op_threads"].get)
+        config["intra_op_threads"] = int(intra)
+        torch.set_num_threads(int(intra))
+
+        if probe_interop:
+            for threads in sorted({1, 2, torch.get_num_interop_threads()}):
+                seconds = _probe_interop(threads, config, sizes)
+                if seconds is not None:
+                    results["inter_op_threads"][str(threads)] = seconds
+                    print(f"  inter-op {threads}: {seconds:.3f}s/step")
+            if results["inter_op_threads"]:
+                config["inter_op_threads"] = int(min(results["inter_op_threads"], key=results["inter_op_threads"].get))
+
+    config["results"] = results
+    config["tuned_at"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    print(f"Autotune picked attention={config['attention']}, intra-op={config['intra_op_threads']}, "
+          f"inter-op={config['inter_op_threads']}")
+    return config
+
+
+def ensure_tuned(pipe, device: str, config: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    """Apply the stored config, tuning first when there is none for this host (or AUTOTUNE=force)"""
+    if AUTOTUNE_MODE in ("off", "0"):
+        return None
+    if config is None or AUTOTUNE_MODE == "force":
+        # No inter-op probes at startup: each child loads a second pipeline next to the server's.
+        # Run `python autotune.py` (offline) to include them.
+        config = tune(pipe, device, probe_interop=False)
+        save_config(config)
+        print(f"Saved autotune config to {AUTOTUNE_CONFIG}")
+    apply_threads(config)
+    apply_attention(pipe, config["attention"])
+    return config
+
+
+def _run_probe(probe: Dict[str, Any]):
+    """Child process of _probe_interop: inter-op threads first, then models, then time"""
+    apply_threads(probe)
+    from model_loader import get_models
+    pipe, _ = get_models()
+    apply_attention(pipe, probe["attention"])
+    sizes = [tuple(size) for size in probe["sizes"]]
+    print(json.dumps({"seconds_per_step": seconds_per_step(pipe, sizes)}))
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Tune attention and thread settings for this host")
+    parser.add_argument("--quick", action="store_true", help="square bucket only, skip inter-op probes")
+    parser.add_argument("--probe", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.probe:
+        _run_probe(json.loads(args.probe))
+        return 0
+
+    # Load the models untuned; this run decides the config
+    os.environ["AUTOTUNE"] = "off"
+    from model_loader import get_models, device
+    pipe, _ = get_models()
+
+    sizes = bucket_sizes()[:1] if args.quick else None
+    config = tune(pipe, device, sizes=sizes, probe_interop=not args.quick)
+    save_config(config)
+    print(f"Saved autotune config to {AUTOTUNE_CONFIG}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
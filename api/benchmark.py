@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Benchmark guidance shortcuts and step caching against the full-CFG baseline.
+
+Renders each input with the same seed and settings once per variant and reports
+denoising time, speedup and PSNR/SSIM against the baseline render.
+
+Usage:
+
+    python benchmark.py ../outputs/image.png --steps 20 --repeats 2
+"""
+
+import argparse
+import sys
+import time
+from typing import Dict, Any, List
+
+import numpy as np
+from PIL import Image
+from skimage.metrics import peak_signal_noise_ratio, structural_similarity
+
+from stages import STAGE_DENOISE
+
+BASE_SETTINGS = {
+    'steps': 20,
+    'guidanceScale': 7.5,
+    'strength': 0.8,
+    'seed': 42,
+    'enableUpscaling': False,
+    'preserveColors': False,
+    'enhanceLighting': True,
+    'style': 'Modern',
+    'roomType': 'Living Room',
+    # Every measured render does the full work, not a resume from an earlier repeat or variant
+    'latentCache': False
+}
+
+# Variant name -> settings overrides; "baseline" is the reference every other variant is compared to
+VARIANTS = {
+    'baseline': {},
+    'cfg-0.7': {'cfgCutoff': 0.7},
+    'cfg-0.5': {'cfgCutoff': 0.5},
+    'control-0.6': {'controlEnd': 0.6},
+    'cfg-0.5+control-0.6': {'cfgCutoff': 0.5, 'controlEnd': 0.6},
+    'cache-2': {'cacheInterval': 2},
+    'cache-3': {'cacheInterval': 3},
+    'cache-3+cfg-0.5': {'cacheInterval': 3, 'cfgCutoff': 0.5},
+}
+
+
+def render(pipe, depth_estimator, image: Image.Image, prompt: str, settings: Dict[str, Any], repeats: int):
+    """Render ``repeats`` times; returns the last output and the best denoise/total seconds"""
+    from enhanced_generate import generate_image_advanced
+
+    best_denoise, best_total, output = None, None, None
+    for _ in range(repeats):
+        timings: Dict[str, float] = {}
+        started = time.perf_counter()
+        output = generate_image_advanced(prompt, image, pipe, depth_estimator, settings, timings=timings)
+        total = time.perf_counter() - started
+        denoise = timings.get(STAGE_DENOISE, total)
+        best_denoise = denoise if best_denoise is None else min(best_denoise, denoise)
+        best_total = total if best_total is None else min(best_total, total)
+    return output, best_denoise, best_total
+
+
+def similarity(reference: Image.Image, candidate: Image.Image):
+    """PSNR (dB) and SSIM of a render against the baseline render"""
+    reference = np.array(reference.convert('RGB'))
+    candidate = np.array(candidate.convert('RGB').resize((reference.shape[1], reference.shape[0])))
+    psnr = peak_signal_noise_ratio(reference, candidate, data_range=255)
+    ssim = structural_similarity(reference, candidate, channel_axis=2, data_range=255)
+    return psnr, ssim
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Compare guidance shortcuts and step caching with the full-CFG baseline")
+    parser.add_argument("images", nargs="+", help="input room photos")
+    parser.add_argument("--prompt", default="Modern style Living Room interior design")
+    parser.add_argument("--steps", type=int, default=BASE_SETTINGS['steps'])
+    parser.add_argument("--repeats", type=int, default=1, help="timed runs per variant (best is reported)")
+    parser.add_argument("--variants", default=",".join(VARIANTS), help="comma-separated variant names")
+    parser.add_argument("--save", action="store_true", help="save every render next to this script")
+    args = parser.parse_args(argv)
+
+    names = [name.strip() for name in args.variants.split(",") if name.strip()]
+    unknown = [name for name in names if name not in VARIANTS]
+    if unknown:
+        parser.error(f"unknown variants: {', '.join(unknown)}")
+    if 'baseline' not in names:
+        names.insert(0, 'baseline')
+
+    from model_loader import get_models
+    pipe, depth_estimator = get_models()
+
+    results: Dict[str, List[Dict[str, float]]] = {name: [] for name in names}
+    for path in args.images:
+        image = Image.open(path).convert('RGB')
+        print(f"\n{path} ({image.width}x{image.height})")
+
+        baseline = None
+        for name in names:
+            settings = {**BASE_SETTINGS, 'steps': args.steps, **VARIANTS[name]}
+            output, denoise, total = render(pipe, depth_estimator, image, args.prompt, settings, args.repeats)
+            if name == 'baseline':
+                baseline = (output, denoise)
+                psnr, ssim = float('inf'), 1.0
+            else:
+                psnr, ssim = similarity(baseline[0], output)
+            speedup = baseline[1] / denoise if denoise else 0.0
+            results[name].append({"denoise": denoise, "total": total, "speedup": speedup, "psnr": psnr, "ssim": ssim})
+            print(f"  {name:<22} denoise {denoise:7.2f}s  total {total:7.2f}s  "
+                  f"speedup {speedup:5.2f}x  PSNR {psnr:6.2f} dB  SSIM {ssim:.4f}")
+            if args.save:
+                output.save(f"benchmark_{len(results[name])}_{name}.png")
+
+    print("\nMean over all images:")
+    print(f"  {'variant':<22} {'denoise':>9} {'speedup':>8} {'PSNR':>9} {'SSIM':>7}")
+    for name in names:
+        rows = results[name]
+        mean = lambda key: sum(row[key] for row in rows) / len(rows)
+        print(f"  {name:<22} {mean('denoise'):8.2f}s {mean('speedup'):7.2f}x "
+              f"{mean('psnr'):6.2f} dB {mean('ssim'):7.4f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Benchmark depth backends: latency (one image at a time and batched) and how
+closely each backend's depth maps match the reference backend's.
+
+Images are bucket-fitted exactly as for generation, so the maps are compared at
+working size. Similarity is reported as SSIM and Pearson correlation of the raw
+backend output (before histogram equalization).
+
+Usage:
+
+    python benchmark_depth.py ../outputs/*.png --backends small,large --reference large
+"""
+
+import argparse
+import sys
+import time
+from typing import Dict, List
+
+import numpy as np
+from PIL import Image
+from skimage.metrics import structural_similarity
+
+from buckets import fit_to_bucket
+from depth_backends import DEPTH_MODELS, load_depth_backend
+
+
+def time_backend(backend, images: List[Image.Image], repeats: int) -> Dict[str, float]:
+    """Best seconds per image, one image per call and all images in one call"""
+    backend.estimate(images[:1])  # warm-up
+    single, batched = None, None
+    for _ in range(repeats):
+        started = time.perf_counter()
+        for image in images:
+            backend.estimate([image])
+        elapsed = (time.perf_counter() - started) / len(images)
+        single = elapsed if single is None else min(single, elapsed)
+
+        started = time.perf_counter()
+        backend.estimate(images)
+        elapsed = (time.perf_counter() - started) / len(images)
+        batched = elapsed if batched is None else min(batched, elapsed)
+    return {"single": single, "batched": batched}
+
+
+def similarity(reference: np.ndarray, candidate: np.ndarray) -> Dict[str, float]:
+    return {
+        "ssim": structural_similarity(reference, candidate, data_range=255),
+        "correlation": float(np.corrcoef(reference.ravel(), candidate.ravel())[0, 1]),
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Compare depth backends on latency and agreement")
+    parser.add_argument("images", nargs="+", help="input room photos")
+    parser.add_argument("--backends", default=",".join(DEPTH_MODELS), help="comma-separated backend names")
+    parser.add_argument("--reference", default="large", help="backend the others are compared to")
+    parser.add_argument("--max-size", type=int, default=512, help="working resolution (longest side)")
+    parser.add_argument("--repeats", type=int, default=2, help="timed runs (best is reported)")
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args(argv)
+
+    names = [name.strip() for name in args.backends.split(",") if name.strip()]
+    if args.reference not in names:
+        names.append(args.reference)
+
+    # Bucket-fitted inputs, as generation feeds them to the backend
+    images = [fit_to_bucket(Image.open(path).convert("RGB"), args.max_size)[0] for path in args.images]
+    print(f"{len(images)} images at {', '.join(sorted({f'{w}x{h}' for w, h in (i.size for i in images)}))}")
+
+    depths, timings = {}, {}
+    for name in names:
+        backend = load_depth_backend(name, device=args.device)
+        timings[name] = time_backend(backend, images, args.repeats)
+        depths[name] = backend.estimate(images)
+        del backend
+
+    print(f"\n  {'backend':<8} {'single':>9} {'batched':>9} {'speedup':>8} {'SSIM':>7} {'corr':>7}")
+    reference_time = timings[args.reference]["single"]
+    for name in names:
+        scores = [similarity(ref, cand) for ref, cand in zip(depths[args.reference], depths[name])]
+        ssim = sum(score["ssim"] for score in scores) / len(scores)
+        correlation = sum(score["correlation"] for score in scores) / len(scores)
+        print(f"  {name:<8} {timings[name]['single']:8.3f}s {timings[name]['batched']:8.3f}s "
+              f"{reference_time / timings[name]['single']:7.2f}x {ssim:7.4f} {correlation:7.4f}")
+    print(f"\nLatency is seconds per image; speedup and similarity are relative to '{args.reference}'.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,87 @@
+import math
+import os
+from typing import List, NamedTuple, Tuple
+
+import numpy as np
+from PIL import Image
+
+# Working sizes are defined at this longest-side reference and scaled for other max sizes
+BASE_SIZE = 512
+
+# Aspect-ratio buckets (width x height) of roughly equal area; override with
+# RESOLUTION_BUCKETS="512x512,576x448,..." (multiples of 8)
+DEFAULT_BUCKETS = "512x512,576x448,448x576,640x384,384x640"
+
+def _parse_buckets(spec: str) -> List[Tuple[int, int]]:
+    buckets = []
+    for item in spec.split(","):
+        item = item.strip().lower()
+        if not item:
+            continue
+        width, height = (int(v) for v in item.split("x"))
+        buckets.append(((width // 8) * 8, (height // 8) * 8))
+    return buckets
+
+BUCKETS = _parse_buckets(os.getenv("RESOLUTION_BUCKETS", DEFAULT_BUCKETS))
+
+class BucketPlacement(NamedTuple):
+    """Where an image was placed inside its bucket, to map results back exactly"""
+    bucket: Tuple[int, int]                    # working size fed to the pipeline
+    content_box: Tuple[int, int, int, int]     # left, top, right, bottom of the image inside the bucket
+    original_size: Tuple[int, int]
+
+def scaled_bucket(bucket: Tuple[int, int], max_size: int = BASE_SIZE) -> Tuple[int, int]:
+    """Bucket size for a working max size other than BASE_SIZE (kept to multiples of 8)"""
+    scale = max_size / BASE_SIZE
+    width, height = bucket
+    return max(64, int(round(width * scale / 8)) * 8), max(64, int(round(height * scale / 8)) * 8)
+
+def bucket_sizes(max_size: int = BASE_SIZE) -> List[Tuple[int, int]]:
+    """All working sizes for a max size"""
+    return [scaled_bucket(bucket, max_size) for bucket in BUCKETS]
+
+def select_bucket(width: int, height: int, max_size: int = BASE_SIZE) -> Tuple[int, int]:
+    """Working size of the bucket whose aspect ratio is nearest to width x height"""
+    aspect = math.log(width / height)
+    bucket = min(BUCKETS, key=lambda b: abs(math.log(b[0] / b[1]) - aspect))
+    return scaled_bucket(bucket, max_size)
+
+def fit_to_bucket(image: Image.Image, max_size: int = BASE_SIZE) -> Tuple[Image.Image, BucketPlacement]:
+    """Resize an image to fit inside its bucket and pad the rest by repeating edge pixels"""
+    original_width, original_height = image.size
+    bucket_width, bucket_height = select_bucket(original_width, original_height, max_size)
+
+    scale = min(bucket_width / original_width, bucket_height / original_height)
+    content_width = min(bucket_width, max(1, round(original_width * scale)))
+    content_height = min(bucket_height, max(1, round(original_height * scale)))
+    resized = image.resize((content_width, content_height), Image.Resampling.LANCZOS)
+
+    left = (bucket_width - content_width) // 2
+    top = (bucket_height - content_height) // 2
+    pixels = np.array(resized)
+    padding = [(top, bucket_height - content_height - top), (left, bucket_width - content_width - left)]
+    padding += [(0, 0)] * (pixels.ndim - 2)
+    padded = Image.fromarray(np.pad(pixels, padding, mode="edge"))
+
+    placement = BucketPlacement(
+        bucket=(bucket_width, bucket_height),
+        content_box=(left, top, left + content_width, top + content_height),
+        original_size=(original_width, original_height),
+    )
+    return padded, placement
+
+def crop_to_content(image: Image.Image, placement: BucketPlacement) -> Image.Image:
+    """Drop the padding from a bucket-shaped result (also works for an upscaled result)"""
+    scale_x = image.width / placement.bucket[0]
+    scale_y = image.height / placement.bucket[1]
+    left, top, right, bottom = placement.content_box
+    return image.crop((
+        round(left * scale_x), round(top * scale_y), round(right * scale_x), round(bottom * scale_y)
+    ))
+
+def restore_from_bucket(image: Image.Image, placement: BucketPlacement) -> Image.Image:
+    """Map a bucket-shaped result back to the original image geometry"""
+    content = crop_to_content(image, placement)
+    if content.size == placement.original_size:
+        return content
+    return content.resize(placement.original_size, Image.Resampling.LANCZOS)
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Offline bulk renderer for whole photo catalogs.
+
+Renders every image in a manifest in every listed style, using several worker
+processes. Finished renders are appended to a journal, so re-running the same
+command after a crash resumes where it left off.
+
+Manifest (JSON):
+
+    {
+      "images": ["photos/*.jpg", "extra/kitchen.png"],
+      "styles": ["Modern", "Minimalist"],
+      "room": "Living Room",
+      "settings": {"steps": 20}
+    }
+
+Image paths and globs are relative to the manifest file.
+
+Usage:
+
+    python bulk_render.py catalog.json --workers 2 --threads-per-worker 4
+"""
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+from typing import Dict, Any, List, Set
+
+from stages import stage, STAGES, STAGE_UPLOAD
+
+# Same defaults as /generate/advanced
+DEFAULT_SETTINGS = {
+    'steps': 20,
+    'guidanceScale': 7.5,
+    'strength': 0.8,
+    'seed': 0,
+    'enableUpscaling': False,
+    'preserveColors': False,
+    'enhanceLighting': True
+}
+
+# Per-process models, loaded once by _init_worker
+_pipe = None
+_depth_estimator = None
+
+
+def _slug(text: str) -> str:
+    return re.sub(r"[^a-z0-9]+", "-", text.lower()).strip("-")
+
+
+def load_jobs(manifest_path: str) -> List[Dict[str, Any]]:
+    """Expand a manifest into one job per image x style"""
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    images = []
+    for pattern in manifest["images"]:
+        matches = sorted(glob.glob(os.path.join(base_dir, pattern)))
+        images.extend(matches if matches else [os.path.join(base_dir, pattern)])
+
+    room = manifest.get("room", "Living Room")
+    settings = {**DEFAULT_SETTINGS, **manifest.get("settings", {})}
+
+    jobs = []
+    for image_path in images:
+        relative_path = os.path.relpath(image_path, base_dir)
+        for style in manifest["styles"]:
+            jobs.append({
+                "key": f"{relative_path}::{style}",
+                "output_name": f"{_slug(os.path.splitext(relative_path)[0])}_{_slug(style)}.png",
+                "image": image_path,
+                "style": style,
+                "prompt": f"{style} style {room} interior design",
+                "settings": {**settings, 'style': style, 'roomType': room}
+            })
+    return jobs
+
+
+def read_journal(journal_path: str) -> Set[str]:
+    """Keys of jobs already rendered by a previous run"""
+    done = set()
+    if not os.path.exists(journal_path):
+        return done
+    with open(journal_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # torn last line from a crash
+            if record.get("status") == "done":
+                done.add(record["key"])
+    return done
+
+
+def _init_worker(threads: int):
+    """Set this process's thread budget, then load the models"""
+    global _pipe, _depth_estimator
+    import torch
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+
+    # Workers never autotune (they would all tune at once on every core and race on the config
+    # file); they reuse a stored attention choice but keep --threads-per-worker
+    os.environ["AUTOTUNE"] = "off"
+    from autotune import load_config, apply_attention
+    from model_loader import get_models, device
+    _pipe, _depth_estimator = get_models()
+    torch.set_num_threads(threads)
+    config = load_config(device)
+    if config is not None:
+        apply_attention(_pipe, config["attention"])
+
+
+def _render(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Render one job in a worker and upload the result"""
+    from PIL import Image
+    from enhanced_generate import generate_image_advanced
+    from storage import upload_image_return_url
+
+    started = time.perf_counter()
+    timings: Dict[str, float] = {}
+    record = {"key": job["key"], "image": job["image"], "style": job["style"]}
+    try:
+        image = Image.open(job["image"]).convert("RGB")
+        output = generate_image_advanced(
+            job["prompt"], image, _pipe, _depth_estimator, job["settings"], timings=timings
+        )
+
+        key = f"{job['prefix']}{job['output_name']}"
+        with stage(timings, STAGE_UPLOAD):
+            record["url"] = upload_image_return_url(output, key)
+        record["status"] = "done"
+    except Exception as e:
+        record["status"] = "failed"
+        record["error"] = str(e)
+
+    record["seconds"] = time.perf_counter() - started
+    record["timings"] = timings
+    return record
+
+
+def print_summary(records: List[Dict[str, Any]], skipped: int, elapsed: float):
+    done = [r for r in records if r["status"] == "done"]
+    failed = len(records) - len(done)
+
+    print(f"\nRendered {len(done)} images, {failed} failed, {skipped} skipped (already in journal)")
+    print(f"Wall time: {elapsed:.1f}s")
+    if elapsed > 0:
+        print(f"Throughput: {len(done) / elapsed * 60:.2f} images/min")
+
+    if done:
+        totals = {name: sum(r["timings"].get(name, 0.0) for r in done) for name in STAGES}
+        busy = sum(totals.values()) or 1.0
+        print("Per-stage breakdown (mean seconds per image, share of worker time):")
+        for name in STAGES:
+            print(f"  {name:<12} {totals[name] / len(done):8.2f}s  {totals[name] / busy * 100:5.1f}%")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Render a catalog of photos in several styles")
+    parser.add_argument("manifest", help="JSON manifest with images, styles, room and settings")
+    parser.add_argument("--journal", help="checkpoint journal (default: <manifest>.journal)")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes (each loads its own models)")
+    parser.add_argument("--threads-per-worker", type=int, default=None,
+                        help="torch intra-op threads per worker (default: cores / workers)")
+    parser.add_argument("--prefix", default="bulk/", help="storage key prefix for outputs")
+    args = parser.parse_args(argv)
+
+    journal_path = args.journal or f"{args.manifest}.journal"
+    threads = args.threads_per_worker or max(1, (os.cpu_count() or 1) // args.workers)
+
+    jobs = load_jobs(args.manifest)
+    done = read_journal(journal_path)
+    pending = [dict(job, prefix=args.prefix) for job in jobs if job["key"] not in done]
+    skipped = len(jobs) - len(pending)
+    print(f"{len(jobs)} jobs in manifest, {skipped} already done, {len(pending)} to render "
+          f"with {args.workers} worker(s) x {threads} thread(s)")
+
+    records = []
+    started = time.perf_counter()
+    if pending:
+        context = multiprocessing.get_context("spawn")
+        with open(journal_path, "a") as journal, \
+                context.Pool(args.workers, initializer=_init_worker, initargs=(threads,)) as pool:
+            for record in pool.imap_unordered(_render, pending):
+                journal.write(json.dumps(record) + "\n")
+                journal.flush()
+                os.fsync(journal.fileno())
+                records.append(record)
+
+                status = "✅" if record["status"] == "done" else f"❌ {record.get('error')}"
+                print(f"[{len(records)}/{len(pending)}] {record['key']} {record['seconds']:.1f}s {status}")
+
+    print_summary(records, skipped, time.perf_counter() - started)
+    return 0 if all(r["status"] == "done" for r in records) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
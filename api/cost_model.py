@@ -0,0 +1,162 @@
+import threading
+from typing import Dict, Any, Optional, Tuple
+
+from buckets import select_bucket
+from deep_cache import cache_interval, SHALLOW_STEP_COST
+from stages import (
+    STAGE_PREPROCESS, STAGE_DEPTH, STAGE_DENOISE, STAGE_DECODE, STAGE_POSTPROCESS, STAGE_UPLOAD
+)
+
+# Working resolutions (longest side) and step counts the planner may choose from
+RESOLUTION_CANDIDATES = [512, 448, 384, 320, 256]
+STEP_CANDIDATES = [30, 25, 20, 15, 12, 10, 8]
+
+# Beyond this many steps extra steps barely change the render, so the planner
+# prefers spending the budget on resolution instead
+PLANNER_STEP_CAP = 20
+
+# Seconds per unit before anything has been measured on this node. Units per stage:
+# preprocess -> input megapixel, depth/decode -> working megapixel,
+# denoise -> step x working megapixel, postprocess/upload -> output megapixel
+_PRIORS = {
+    "cpu": {
+        STAGE_PREPROCESS: 0.15,
+        STAGE_DEPTH: 8.0,
+        STAGE_DENOISE: 12.0,
+        STAGE_DECODE: 20.0,
+        STAGE_POSTPROCESS: 0.3,
+        STAGE_UPLOAD: 0.4,
+    },
+    "cuda": {
+        STAGE_PREPROCESS: 0.15,
+        STAGE_DEPTH: 0.4,
+        STAGE_DENOISE: 0.25,
+        STAGE_DECODE: 0.6,
+        STAGE_POSTPROCESS: 0.3,
+        STAGE_UPLOAD: 0.4,
+    },
+}
+
+
+def stage_units(input_size: Tuple[int, int], settings: Dict[str, Any]) -> Dict[str, float]:
+    """Work units per stage for a request (see _PRIORS for what a unit is)"""
+    width, height = input_size
+    working_width, working_height = select_bucket(width, height, int(settings.get('maxSize', 512)))
+    working_mp = working_width * working_height / 1e6
+
+    if settings.get('enableUpscaling', False):
+        output_mp = working_mp * 4
+    else:
+        output_mp = width * height / 1e6
+
+    # Steps after the CFG cutoff run the UNet on half the batch
+    guided = min(max(float(settings.get('cfgCutoff') or 1.0), 0.0), 1.0)
+    step_cost = guided + (1.0 - guided) / 2
+    # With step caching only one step per interval runs the full UNet
+    interval = cache_interval(settings)
+    step_cost *= (1 + (interval - 1) * SHALLOW_STEP_COST) / interval
+
+    return {
+        STAGE_PREPROCESS: width * height / 1e6,
+        STAGE_DEPTH: working_mp,
+        STAGE_DENOISE: int(settings.get('steps', 20)) * working_mp * step_cost,
+        STAGE_DECODE: working_mp,
+        STAGE_POSTPROCESS: output_mp,
+        STAGE_UPLOAD: output_mp,
+    }
+
+
+class CostModel:
+    """Online per-stage latency model fed by timings measured on this node.
+
+    Each stage keeps an exponentially weighted average of seconds per work unit,
+    seeded with a per-device prior until the first measurement arrives.
+    """
+
+    def __init__(self, device: str = "cpu", alpha: float = 0.3):
+        self._rates = dict(_PRIORS.get(device, _PRIORS["cpu"]))
+        self._samples = {name: 0 for name in self._rates}
+        self._job_seconds: Optional[float] = None
+        self._alpha = alpha
+        self._lock = threading.Lock()
+
+    def predict(self, input_size: Tuple[int, int], settings: Dict[str, Any]) -> float:
+        """Predicted seconds to run a request, excluding queue wait"""
+        units = stage_units(input_size, settings)
+        with self._lock:
+            return sum(self._rates[name] * amount for name, amount in units.items())
+
+    def observe(self, input_size: Tuple[int, int], settings: Dict[str, Any], timings: Dict[str, float]):
+        """Update the per-stage rates from a finished request's measured timings"""
+        units = stage_units(input_size, settings)
+        with self._lock:
+            for name, seconds in timings.items():
+                amount = units.get(name, 0.0)
+                if amount <= 0:
+                    continue
+                rate = seconds / amount
+                if self._samples[name] == 0:
+                    self._rates[name] = rate
+                else:
+                    self._rates[name] += self._alpha * (rate - self._rates[name])
+                self._samples[name] += 1
+
+            total = sum(timings.values())
+            if self._job_seconds is None:
+                self._job_seconds = total
+            else:
+                self._job_seconds += self._alpha * (total - self._job_seconds)
+
+    def expected_wait(self, queue_depth: int, input_size: Tuple[int, int], settings: Dict[str, Any]) -> float:
+        """Seconds a new request is expected to wait behind queue_depth jobs"""
+        with self._lock:
+            job_seconds = self._job_seconds
+        if job_seconds is None:
+            job_seconds = self.predict(input_size, settings)
+        return queue_depth * job_seconds
+
+    def plan(
+        self,
+        deadline_s: float,
+        input_size: Tuple[int, int],
+        settings: Dict[str, Any],
+        queue_depth: int = 0
+    ) -> Tuple[Dict[str, Any], float]:
+        """Pick the largest steps/resolution combination that fits the deadline.
+
+        Returns the settings overrides and the predicted end-to-end seconds (queue
+        wait included). If nothing fits, the cheapest combination is returned.
+        """
+        wait = self.expected_wait(queue_depth, input_size, settings)
+        budget = deadline_s - wait
+        upscaling_options = [True, False] if settings.get('enableUpscaling', False) else [False]
+
+        best, best_score, best_time = None, None, None
+        cheapest, cheapest_time = None, None
+        for max_size in RESOLUTION_CANDIDATES:
+            for steps in STEP_CANDIDATES:
+                for upscaling in upscaling_options:
+                    overrides = {'steps': steps, 'maxSize': max_size, 'enableUpscaling': upscaling}
+                    predicted = self.predict(input_size, {**settings, **overrides})
+
+                    if cheapest_time is None or predicted < cheapest_time:
+                        cheapest, cheapest_time = overrides, predicted
+                    if predicted > budget:
+                        continue
+
+                    score = (min(steps, PLANNER_STEP_CAP) * max_size * max_size, upscaling, steps)
+                    if best_score is None or score > best_score:
+                        best, best_score, best_time = overrides, score, predicted
+
+        if best is None:
+            return cheapest, wait + cheapest_time
+        return best, wait + best_time
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Current per-stage rates and sample counts"""
+        with self._lock:
+            return {
+                "rates": dict(self._rates),
+                "samples": dict(self._samples),
+                "job_seconds": self._job_seconds,
+            }
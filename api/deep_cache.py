@@ -0,0 +1,186 @@
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Optional
+
+import torch
+
+# Rough cost of a shallow step relative to a full UNet + ControlNet step (SD1.5),
+# used by the cost model to predict denoise time with caching enabled
+SHALLOW_STEP_COST = 0.2
+
+# Per-thread cache state of the pipeline call in progress (None outside deep_cache())
+_active = threading.local()
+_install_lock = threading.Lock()
+
+class StepCache:
+    """Deep UNet features carried across denoising steps of one pipeline call.
+
+    Every ``interval``-th step runs the full UNet and ControlNet and keeps the input
+    of the last up block plus the ControlNet residuals. Steps in between only run
+    conv_in, the first down block, the last up block and conv_out on top of them.
+    """
+
+    def __init__(self, interval: int):
+        self.interval = interval
+        self.step = 0
+        self.hidden: Optional[torch.Tensor] = None
+        self.control: Optional[tuple] = None
+        self.capturing = False
+        self.full_steps = 0
+        self.shallow_steps = 0
+
+    def is_full_step(self) -> bool:
+        return self.hidden is None or self.step % self.interval == 0
+
+def cache_interval(settings: Dict[str, Any]) -> int:
+    """Steps per full UNet pass requested by ``cacheInterval`` (1 = caching off)"""
+    try:
+        return min(max(int(settings.get('cacheInterval') or 1), 1), 10)
+    except (TypeError, ValueError):
+        return 1
+
+def _state() -> Optional[StepCache]:
+    return getattr(_active, 'cache', None)
+
+def _match_batch(tensor: torch.Tensor, batch: int) -> torch.Tensor:
+    """Cached tensors from a guided step hold [uncond, cond]; keep the conditional
+    half once CFG truncation has dropped the unconditional batch"""
+    if tensor.shape[0] == batch:
+        return tensor
+    if tensor.shape[0] == 2 * batch:
+        return tensor.chunk(2)[1]
+    raise ValueError(f"Cached batch of {tensor.shape[0]} does not match batch of {batch}")
+
+def _time_embedding(unet, sample, timestep, timestep_cond=None):
+    """Timestep embedding as computed at the start of UNet2DConditionModel.forward"""
+    timesteps = timestep
+    if not torch.is_tensor(timesteps):
+        timesteps = torch.tensor([timesteps], device=sample.device)
+    elif timesteps.dim() == 0:
+        timesteps = timesteps[None].to(sample.device)
+    timesteps = timesteps.expand(sample.shape[0])
+    t_emb = unet.time_proj(timesteps).to(dtype=sample.dtype)
+    return unet.time_embedding(t_emb, timestep_cond)
+
+def _shallow_forward(unet, state: StepCache, sample, timestep, encoder_hidden_states,
+                     timestep_cond=None, cross_attention_kwargs=None,
+                     down_block_additional_residuals=None, **kwargs):
+    """Run only the outermost UNet blocks, reusing the cached deep features"""
+    if unet.config.center_input_sample:
+        sample = 2 * sample - 1.0
+    emb = _time_embedding(unet, sample, timestep, timestep_cond)
+
+    hidden = unet.conv_in(sample)
+    skips = (hidden,)
+    first = unet.down_blocks[0]
+    if getattr(first, 'has_cross_attention', False):
+        hidden, block_skips = first(
+            hidden_states=hidden, temb=emb, encoder_hidden_states=encoder_hidden_states,
+            cross_attention_kwargs=cross_attention_kwargs
+        )
+    else:
+        hidden, block_skips = first(hidden_states=hidden, temb=emb)
+    skips += block_skips
+
+    last = unet.up_blocks[-1]
+    skips = skips[:len(last.resnets)]
+    if down_block_additional_residuals is not None:
+        skips = tuple(skip + residual for skip, residual in zip(skips, down_block_additional_residuals))
+
+    cached = _match_batch(state.hidden, sample.shape[0])
+    if getattr(last, 'has_cross_attention', False):
+        sample = last(
+            hidden_states=cached, temb=emb, res_hidden_states_tuple=skips,
+            encoder_hidden_states=encoder_hidden_states, cross_attention_kwargs=cross_attention_kwargs
+        )
+    else:
+        sample = last(hidden_states=cached, temb=emb, res_hidden_states_tuple=skips)
+
+    if unet.conv_norm_out is not None:
+        sample = unet.conv_act(unet.conv_norm_out(sample))
+    return unet.conv_out(sample)
+
+def _install(pipe):
+    """Wrap the pipeline's UNet and ControlNet forwards once each; the wrappers only act
+    while a deep_cache() block is active on the calling thread. Pipelines sharing the UNet
+    with a different ControlNet (model_pool.py) get their ControlNet wrapped on first use."""
+    unet, controlnet = pipe.unet, pipe.controlnet
+    with _install_lock:
+        if not getattr(unet, '_deep_cache_installed', False):
+            _install_unet(unet)
+        if not getattr(controlnet, '_deep_cache_installed', False):
+            _install_controlnet(controlnet)
+
+def _install_unet(unet):
+    def capture(module, args, kwargs):
+        state = _state()
+        if state is not None and state.capturing:
+            state.hidden = kwargs['hidden_states'] if 'hidden_states' in kwargs else args[0]
+    unet.up_blocks[-1].register_forward_pre_hook(capture, with_kwargs=True)
+
+    unet_forward = unet.forward
+
+    def cached_unet_forward(sample, timestep, encoder_hidden_states=None, *args, return_dict=True, **kwargs):
+        state = _state()
+        if state is None:
+            return unet_forward(sample, timestep, encoder_hidden_states, *args, return_dict=return_dict, **kwargs)
+        try:
+            if state.is_full_step():
+                state.capturing = True
+                try:
+                    output = unet_forward(
+                        sample, timestep, encoder_hidden_states, *args, return_dict=return_dict, **kwargs
+                    )
+                finally:
+                    state.capturing = False
+                state.full_steps += 1
+                return output
+            sample = _shallow_forward(unet, state, sample, timestep, encoder_hidden_states, **kwargs)
+            state.shallow_steps += 1
+            if not return_dict:
+                return (sample,)
+            from diffusers.models.unets.unet_2d_condition import UNet2DConditionOutput
+            return UNet2DConditionOutput(sample=sample)
+        finally:
+            state.step += 1
+
+    unet.forward = cached_unet_forward
+    unet._deep_cache_installed = True
+
+def _install_controlnet(controlnet):
+    controlnet_forward = controlnet.forward
+
+    def cached_controlnet_forward(sample, timestep, *args, conditioning_scale=1.0, return_dict=True, **kwargs):
+        state = _state()
+        call = lambda: controlnet_forward(
+            sample, timestep, *args, conditioning_scale=conditioning_scale, return_dict=return_dict, **kwargs
+        )
+        # Outside the conditioning window the ControlNet contributes nothing to reuse
+        if state is None or return_dict or conditioning_scale == 0:
+            return call()
+        if state.is_full_step() or state.control is None:
+            down, mid = call()
+            state.control = (down, mid)
+            return down, mid
+        down, mid = state.control
+        batch = sample.shape[0]
+        return [_match_batch(residual, batch) for residual in down], _match_batch(mid, batch)
+
+    controlnet.forward = cached_controlnet_forward
+    controlnet._deep_cache_installed = True
+
+@contextmanager
+def deep_cache(pipe, interval: int):
+    """Reuse deep UNet features for ``interval`` - 1 of every ``interval`` steps of
+    pipeline calls made on this thread inside the block (interval <= 1: no-op)"""
+    if interval <= 1:
+        yield None
+        return
+    _install(pipe)
+    state = StepCache(interval)
+    _active.cache = state
+    try:
+        yield state
+    finally:
+        _active.cache = None
+        print(f"Step cache: {state.full_steps} full / {state.shallow_steps} shallow UNet passes")
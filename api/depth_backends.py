@@ -0,0 +1,83 @@
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+from transformers import AutoImageProcessor, AutoModelForDepthEstimation
+
+# Selectable depth models: small is much faster on CPU, large is the previous default
+DEPTH_MODELS = {
+    "small": "depth-anything/Depth-Anything-V2-Small-hf",
+    "large": "Intel/dpt-large",
+}
+
+# Which backend model_loader loads, and optional local copies of each model
+DEPTH_BACKEND = os.getenv("DEPTH_BACKEND", "large").lower()
+DEPTH_MODEL_PATHS = {
+    "small": os.getenv("DEPTH_MODEL_PATH_SMALL"),
+    "large": os.getenv("DEPTH_MODEL_PATH_LARGE"),
+}
+
+
+class DepthBackend:
+    """Monocular depth model behind a batched interface.
+
+    ``estimate`` returns one uint8 depth array per image, at exactly that image's
+    size (the pipeline's working size when given bucket-fitted images), scaled so
+    the nearest point is 255 like the transformers depth-estimation pipeline.
+    """
+
+    def __init__(self, name: str, model_path: Optional[str] = None, device: str = "cpu"):
+        if name not in DEPTH_MODELS:
+            raise ValueError(f"Unknown depth backend {name!r}; choose from {', '.join(DEPTH_MODELS)}")
+        self.name = name
+        self.model_id = model_path or DEPTH_MODEL_PATHS.get(name) or DEPTH_MODELS[name]
+        self.device = device
+        self.dtype = torch.float16 if device == "cuda" else torch.float32
+
+        started = time.perf_counter()
+        self.processor = AutoImageProcessor.from_pretrained(self.model_id)
+        self.model = AutoModelForDepthEstimation.from_pretrained(self.model_id, torch_dtype=self.dtype)
+        self.model.to(device).eval()
+        self.load_seconds = time.perf_counter() - started
+        print(f"Depth backend {name} ({self.model_id}) loaded in {self.load_seconds:.1f}s")
+
+    @torch.no_grad()
+    def estimate(self, images: List[Image.Image]) -> List[np.ndarray]:
+        """Depth for each image, batched over images of the same size"""
+        results: List[Optional[np.ndarray]] = [None] * len(images)
+        by_size: Dict[Tuple[int, int], List[int]] = {}
+        for index, image in enumerate(images):
+            by_size.setdefault(image.size, []).append(index)
+
+        for (width, height), indices in by_size.items():
+            batch = [images[i].convert("RGB") for i in indices]
+            inputs = self.processor(images=batch, return_tensors="pt").to(self.device)
+            inputs["pixel_values"] = inputs["pixel_values"].to(self.dtype)
+            predicted = self.model(**inputs).predicted_depth
+            predicted = F.interpolate(
+                predicted.unsqueeze(1).float(), size=(height, width), mode="bicubic", align_corners=False
+            ).squeeze(1)
+            for index, depth in zip(indices, predicted.cpu().numpy()):
+                depth = np.clip(depth, 0, None)
+                results[index] = (depth * 255 / max(float(depth.max()), 1e-6)).astype(np.uint8)
+        return results
+
+    def __call__(self, image: Image.Image) -> Dict[str, Any]:
+        """Single-image call in the shape of the transformers depth-estimation pipeline"""
+        return {"depth": Image.fromarray(self.estimate([image])[0])}
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            "backend": self.name,
+            "model": self.model_id,
+            "device": self.device,
+            "load_seconds": round(self.load_seconds, 2),
+        }
+
+
+def load_depth_backend(name: str = DEPTH_BACKEND, device: str = "cpu") -> DepthBackend:
+    return DepthBackend(name, device=device)
@@ -3,33 +3,37 @@ from io import BytesIO
 import numpy as np
 import torch
 import cv2
+import gc
+import random
+from contextlib import contextmanager
 from typing import Optional, Tuple, Dict, Any
 
-def calculate_optimal_size(width, height, max_size=512):
-    """Calculate optimal size for processing while maintaining aspect ratio"""
-    if width <= max_size and height <= max_size:
-        return width, height
-    
-    aspect_ratio = width / height
-    
-    if width > height:
-        new_width = max_size
-        new_height = int(max_size / aspect_ratio)
-    else:
-        new_height = max_size
-        new_width = int(max_size * aspect_ratio)
-    
-    # Ensure dimensions are multiples of 8
-    new_width = (new_width // 8) * 8
-    new_height = (new_height // 8) * 8
-    
-    return new_width, new_height
+from stages import stage, STAGE_PREPROCESS, STAGE_DEPTH, STAGE_DENOISE, STAGE_DECODE, STAGE_POSTPROCESS
+from jobs import GenerationCancelled
+from metrics import metrics
+from buckets import fit_to_bucket, crop_to_content, bucket_sizes, BucketPlacement
+from guidance import guidance_params, chain_step_callbacks
+from deep_cache import deep_cache, cache_interval
+from inference_executor import adapter_gate
+from latent_cache import (
+    latent_cache, cacheable, prefix_key, late_boundaries, snapshot_steps, snapshot_callback, resume_denoising
+)
 
-def preprocess_image(image: Image.Image, target_size=(512, 512)):
-    """Enhanced image preprocessing with noise reduction"""
-    original_width, original_height = image.size
-    optimal_width, optimal_height = calculate_optimal_size(original_width, original_height)
-    
+# Draft tier: a rough preview for iterating over styles before a final render
+DRAFT_SETTINGS = {
+    'steps': 8,              # few-step UniPC schedule on the base pipeline
+    'adapterSteps': 4,       # consistency LoRA + LCMScheduler (see model_loader.get_draft_pipe)
+    'adapterGuidance': 1.0,  # consistency models expect no classifier-free guidance
+    'maxSize': 384           # lower working resolution
+}
+
+def preprocess_image(image: Image.Image, target_size=(512, 512), max_size=512) -> Tuple[Image.Image, BucketPlacement]:
+    """Enhanced image preprocessing with noise reduction.
+
+    The image is fitted into the nearest aspect-ratio bucket (see buckets.py) so only a
+    fixed set of working shapes reaches the models; the returned placement maps results
+    back to the original geometry.
+    """
     # Convert to RGB
     image = image.convert("RGB")
     
@@ -38,23 +42,72 @@ def preprocess_image(image: Image.Image, target_size=(512, 512)):
     image_array = cv2.bilateralFilter(image_array, 9, 75, 75)
     image = Image.fromarray(image_array)
     
-    # Resize for processing
-    image_resized = image.resize((optimal_width, optimal_height), Image.Resampling.LANCZOS)
-    
-    return image_resized, (original_width, original_height)
+    # Resize and pad into the working bucket
+    return fit_to_bucket(image, max_size)
 
-def generate_depth_map(image, depth_estimator, target_size=(512, 512)):
+def generate_depth_map(image, depth_estimator, target_size=(512, 512), max_size=512,
+                       timings: Optional[Dict[str, float]] = None):
     """Enhanced depth map generation with edge preservation"""
-    image_resized, original_dims = preprocess_image(image, target_size)
-    depth = depth_estimator(image_resized)["depth"]
-    depth = depth.resize((image_resized.size[0], image_resized.size[1]))
+    with stage(timings, STAGE_PREPROCESS):
+        image_resized, placement = preprocess_image(image, target_size, max_size)
     
-    # Enhance depth map contrast
-    depth_array = np.array(depth)
-    depth_array = cv2.equalizeHist(depth_array.astype(np.uint8))
-    depth = Image.fromarray(depth_array)
+    with stage(timings, STAGE_DEPTH):
+        # The backend returns depth at exactly the working size (see depth_backends.py)
+        depth_array = depth_estimator.estimate([image_resized])[0]
+        
+        # Enhance depth map contrast (not for edge, line or segmentation maps from model_pool.py)
+        if getattr(depth_estimator, 'equalize', True):
+            depth_array = cv2.equalizeHist(depth_array)
     
-    return depth, original_dims
+    return Image.fromarray(depth_array), placement
+
+def working_max_size(settings: Dict[str, Any]) -> int:
+    """Longest side of the working resolution for a request"""
+    if is_draft(settings):
+        return DRAFT_SETTINGS['maxSize']
+    return int(settings.get('maxSize', 512))
+
+def decode_latents(pipe, latents) -> list:
+    """Decode pipeline latents to PIL images (kept out of the pipeline call so it is timed separately)"""
+    with torch.no_grad():
+        images = pipe.vae.decode(latents / pipe.vae.config.scaling_factor, return_dict=False)[0]
+    return pipe.image_processor.postprocess(images, output_type="pil")
+
+def release_pipeline_resources(pipe):
+    """Free what an interrupted pipeline call left behind"""
+    if hasattr(pipe, 'maybe_free_model_hooks'):
+        pipe.maybe_free_model_hooks()
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+def is_draft(settings: Dict[str, Any]) -> bool:
+    """Whether the request asks for the fast draft quality tier"""
+    return str(settings.get('quality', 'final')).lower() == 'draft'
+
+def resolve_seed(settings: Dict[str, Any]) -> int:
+    """Return the request seed, drawing a concrete one when unset so the render can be repeated"""
+    seed = int(settings.get('seed', 0) or 0)
+    if seed > 0:
+        return seed
+    return random.randint(1, 2**31 - 1)
+
+@contextmanager
+def _draft_adapter(pipe):
+    """Enable the draft LoRA adapter (if the pipeline carries one) for the duration of a call"""
+    adapter = getattr(pipe, 'draft_adapter', None)
+    if adapter is None:
+        with adapter_gate.shared():
+            yield
+        return
+    # The UNet is shared with every other pipeline, so nothing else may run while the adapter is on
+    with adapter_gate.exclusive():
+        pipe.enable_lora()
+        pipe.set_adapters([adapter])
+        try:
+            yield
+        finally:
+            pipe.disable_lora()
 
 def enhance_prompt_advanced(prompt: str, settings: Dict[str, Any]) -> str:
     """Advanced prompt enhancement based on settings"""
@@ -127,12 +180,15 @@ def post_process_image_advanced(image: Image.Image, settings: Dict[str, Any]) ->
     # Apply color correction
     image = apply_color_correction(image, settings.get('preserveColors', False))
     
+    # Drafts skip the sharpening and upscaling passes
+    draft = is_draft(settings)
+    
     # Apply sharpening filter
-    if not settings.get('preserveColors', False):
+    if not settings.get('preserveColors', False) and not draft:
         image = image.filter(ImageFilter.UnsharpMask(radius=1, percent=120, threshold=3))
     
     # Apply upscaling if requested
-    if settings.get('enableUpscaling', False):
+    if settings.get('enableUpscaling', False) and not draft:
         image = upscale_image(image, 2)
     
     return image
@@ -142,12 +198,23 @@ def generate_image_advanced(
     image: Image.Image, 
     pipe, 
     depth_estimator, 
-    settings: Dict[str, Any]
+    settings: Dict[str, Any],
+    timings: Optional[Dict[str, float]] = None,
+    job=None
 ):
-    """Advanced image generation with customizable settings"""
+    """Advanced image generation with customizable settings
+
+    If ``timings`` is given it is filled with seconds spent per stage (see stages.py).
+    If ``job`` is given (see jobs.py) it is checked between stages and after every
+    denoising step, raising GenerationCancelled once the job is cancelled.
+    """
+    
+    if job is not None:
+        job.check()
     
-    # Get depth map and original dimensions
-    depth_map, original_dims = generate_depth_map(image, depth_estimator)
+    draft = is_draft(settings)
+    if draft and settings.get('seed', 0) <= 0:
+        settings = {**settings, 'seed': resolve_seed(settings)}
     
     # Enhance the prompt
     enhanced_prompt = enhance_prompt_advanced(prompt, settings)
@@ -155,7 +222,6 @@ def generate_image_advanced(
     # Prepare generation parameters
     generation_params = {
         "prompt": enhanced_prompt,
-        "image": depth_map,
         "num_inference_steps": settings.get('steps', 20),
         "guidance_scale": settings.get('guidanceScale', 7.5),
         "strength": settings.get('strength', 0.8),
@@ -163,34 +229,157 @@ def generate_image_advanced(
         "negative_prompt": "dark, dim, poorly lit, low quality, blurry, dark lighting, shadows, dark atmosphere, distorted, deformed"
     }
     
+    if draft:
+        if getattr(pipe, 'draft_adapter', None) is not None:
+            generation_params["num_inference_steps"] = DRAFT_SETTINGS['adapterSteps']
+            generation_params["guidance_scale"] = DRAFT_SETTINGS['adapterGuidance']
+        else:
+            generation_params["num_inference_steps"] = DRAFT_SETTINGS['steps']
+        if 'draftSteps' in settings:
+            generation_params["num_inference_steps"] = min(max(4, int(settings['draftSteps'])), 8)
+    
     # Set seed for reproducibility
     if settings.get('seed', 0) > 0:
         torch.manual_seed(settings['seed'])
         generation_params["generator"] = torch.Generator().manual_seed(settings['seed'])
     
-    # Generate image
-    print(f"Generating with settings: steps={generation_params['num_inference_steps']}, "
-          f"guidance={generation_params['guidance_scale']}, strength={generation_params['strength']}")
-    
-    output = pipe(**generation_params).images[0]
-    
-    # Post-process the image
-    output = post_process_image_advanced(output, settings)
-    
-    # Resize output back to original dimensions (unless upscaling is enabled)
-    if not settings.get('enableUpscaling', False):
-        original_width, original_height = original_dims
-        output = output.resize((original_width, original_height), Image.Resampling.LANCZOS)
+    num_steps = generation_params["num_inference_steps"]
+    guidance_scale = generation_params["guidance_scale"]
+    interval = cache_interval(settings)
+    late = late_boundaries(num_steps, guidance_scale, settings.get('cfgCutoff'), settings.get('controlEnd'))
+    
+    # Seeded renders can branch from cached work of an earlier render with the same prefix
+    entry = None
+    if cacheable(settings, draft):
+        entry = latent_cache.entry(prefix_key(image, {
+            "prompt": enhanced_prompt,
+            "negative_prompt": generation_params["negative_prompt"],
+            "steps": num_steps,
+            "guidance": guidance_scale,
+            "seed": settings['seed'],
+            "maxSize": working_max_size(settings),
+            "cacheInterval": interval,
+            "controlnet": getattr(pipe.controlnet.config, '_name_or_path', ''),
+        }))
+    
+    output = entry.finals.get(late) if entry is not None else None
+    if output is not None:
+        # Only post-processing changed: skip diffusion entirely
+        print("Reusing cached diffusion result, running post-processing only")
+        metrics.incr("latent_cache_final_hits")
+        placement = entry.placement
+        if job is not None:
+            job.cache_reused = True
+    else:
+        # Get depth map and bucket placement
+        if entry is not None and entry.depth_map is not None:
+            depth_map, placement = entry.depth_map, entry.placement
+            if job is not None:
+                job.cache_reused = True
+        else:
+            depth_map, placement = generate_depth_map(
+                image, depth_estimator, max_size=working_max_size(settings), timings=timings
+            )
+            if entry is not None:
+                entry.depth_map, entry.placement = depth_map, placement
+        metrics.incr(f"bucket_{placement.bucket[0]}x{placement.bucket[1]}")
+        generation_params["image"] = depth_map
+        
+        if job is not None:
+            job.check()
+            job.total_steps = num_steps
+        
+        snapshot = entry.best_snapshot(late) if entry is not None else None
+        step_callback = job.step_callback if job is not None else None
+        if entry is not None and snapshot is None:
+            steps = snapshot_steps(settings, num_steps, interval)
+            if steps:
+                step_callback = chain_step_callbacks(step_callback, snapshot_callback(entry, steps, late))
+        
+        # Optionally drop guidance late in the schedule and narrow the ControlNet window
+        generation_params.update(guidance_params(
+            pipe,
+            num_steps,
+            guidance_scale,
+            cfg_cutoff=settings.get('cfgCutoff'),
+            control_end=settings.get('controlEnd'),
+            step_callback=step_callback
+        ))
+        
+        # Generate image
+        print(f"Generating with settings: steps={num_steps}, "
+              f"guidance={guidance_scale}, strength={generation_params['strength']}, "
+              f"cfgCutoff={settings.get('cfgCutoff')}, controlEnd={settings.get('controlEnd')}, "
+              f"cacheInterval={interval}")
+        
+        try:
+            with stage(timings, STAGE_DENOISE), _draft_adapter(pipe), deep_cache(pipe, interval) as cache_state:
+                if snapshot is not None:
+                    print(f"Resuming from cached latents after step {snapshot.step}/{num_steps}")
+                    metrics.incr("latent_cache_resumes")
+                    if job is not None:
+                        job.cache_reused = True
+                    latents = resume_denoising(
+                        pipe, snapshot, enhanced_prompt, generation_params["negative_prompt"], depth_map,
+                        guidance_scale, late, job=job, deep_cache_state=cache_state
+                    )
+                else:
+                    latents = pipe(**generation_params, output_type="latent").images
+        except GenerationCancelled:
+            release_pipeline_resources(pipe)
+            raise
+        
+        with stage(timings, STAGE_DECODE):
+            output = decode_latents(pipe, latents)[0]
+        if entry is not None:
+            latent_cache.add_final(entry, late, output)
+    
+    with stage(timings, STAGE_POSTPROCESS):
+        # Drop the bucket padding before post-processing
+        output = crop_to_content(output, placement)
+        
+        # Post-process the image
+        output = post_process_image_advanced(output, settings)
+        
+        # Resize output back to original dimensions (unless upscaling is enabled)
+        if not settings.get('enableUpscaling', False) or draft:
+            output = output.resize(placement.original_size, Image.Resampling.LANCZOS)
     
     return output
 
+def warmup_sizes() -> Dict[Tuple[int, int], int]:
+    """Every working shape a request can end up with (the buckets at the default, draft and
+    deadline-planner resolutions), mapped to a max size that produces it"""
+    from cost_model import RESOLUTION_CANDIDATES
+    sizes = {}
+    for max_size in sorted({512, DRAFT_SETTINGS['maxSize'], *RESOLUTION_CANDIDATES}, reverse=True):
+        for size in bucket_sizes(max_size):
+            sizes.setdefault(size, max_size)
+    return sizes
+
+def warm_up_buckets(pipe, depth_estimator):
+    """Run every working shape once through depth estimation, a denoising step and VAE decode,
+    so first requests don't pay the per-shape warm-up cost"""
+    for (width, height), max_size in warmup_sizes().items():
+        print(f"Warming up bucket {width}x{height}")
+        image = Image.new('RGB', (width, height), (128, 128, 128))
+        depth_map, _ = generate_depth_map(image, depth_estimator, max_size=max_size)
+        latents = pipe(
+            prompt="interior design",
+            image=depth_map,
+            num_inference_steps=2,
+            output_type="latent"
+        ).images
+        decode_latents(pipe, latents)
+
 def generate_multiple_variations(
     prompt: str,
     image: Image.Image,
     pipe,
     depth_estimator,
     settings: Dict[str, Any],
-    num_variations: int = 3
+    num_variations: int = 3,
+    job=None
 ) -> list:
     """Generate multiple variations of the same design"""
     variations = []
@@ -204,7 +393,7 @@ def generate_multiple_variations(
         # Clamp guidance scale to reasonable range
         variation_settings['guidance_scale'] = max(1, min(20, variation_settings['guidance_scale']))
         
-        variation = generate_image_advanced(prompt, image, pipe, depth_estimator, variation_settings)
+        variation = generate_image_advanced(prompt, image, pipe, depth_estimator, variation_settings, job=job)
         variations.append(variation)
     
     return variations
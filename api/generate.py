@@ -3,50 +3,25 @@ from io import BytesIO
 import numpy as np
 import torch
 
-def calculate_optimal_size(width, height, max_size=512):
-    """Calculate optimal size for processing while maintaining aspect ratio"""
-    if width <= max_size and height <= max_size:
-        return width, height
-    
-    # Calculate aspect ratio
-    aspect_ratio = width / height
-    
-    if width > height:
-        # Landscape image
-        new_width = max_size
-        new_height = int(max_size / aspect_ratio)
-    else:
-        # Portrait or square image
-        new_height = max_size
-        new_width = int(max_size * aspect_ratio)
-    
-    # Ensure dimensions are multiples of 8 (better for AI models)
-    new_width = (new_width // 8) * 8
-    new_height = (new_height // 8) * 8
-    
-    return new_width, new_height
+from jobs import GenerationCancelled
+from buckets import fit_to_bucket, restore_from_bucket
+from guidance import guidance_params
+from inference_executor import adapter_gate
+from metrics import metrics
 
 def preprocess_image(image: Image.Image, target_size=(512, 512)):
-    """Resize image for processing while preserving aspect ratio"""
-    # Store original dimensions
-    original_width, original_height = image.size
-    
-    # Calculate optimal processing size
-    optimal_width, optimal_height = calculate_optimal_size(original_width, original_height)
-    
+    """Fit image into its aspect-ratio bucket for processing (see buckets.py)"""
     # Convert to RGB
     image = image.convert("RGB")
     
-    # Resize for processing (AI models work better with standard sizes)
-    image_resized = image.resize((optimal_width, optimal_height), Image.Resampling.LANCZOS)
-    
-    return image_resized, (original_width, original_height)
+    # Resize and pad to a standard working shape; the placement maps the result back
+    return fit_to_bucket(image)
 
 def generate_depth_map(image, depth_estimator, target_size=(512, 512)):
-    image_resized, original_dims = preprocess_image(image, target_size)
-    depth = depth_estimator(image_resized)["depth"]
-    depth = depth.resize((image_resized.size[0], image_resized.size[1]))
-    return depth, original_dims
+    image_resized, placement = preprocess_image(image, target_size)
+    # The backend returns depth at exactly the working size (see depth_backends.py)
+    depth = Image.fromarray(depth_estimator.estimate([image_resized])[0])
+    return depth, placement
 
 def enhance_prompt(prompt: str) -> str:
     """Enhance the prompt for better lighting and vibrancy"""
@@ -81,9 +56,14 @@ def post_process_image(image: Image.Image) -> Image.Image:
     
     return image
 
-def generate_image(prompt: str, image: Image.Image, pipe, depth_estimator):
+def generate_image(prompt: str, image: Image.Image, pipe, depth_estimator, job=None,
+                   cfg_cutoff=None, control_end=None):
+    if job is not None:
+        job.check()
+    
     # Get depth map and original dimensions
-    depth_map, original_dims = generate_depth_map(image, depth_estimator)
+    depth_map, placement = generate_depth_map(image, depth_estimator)
+    metrics.incr(f"bucket_{placement.bucket[0]}x{placement.bucket[1]}")
     
     # Debug: Check depth map
     print(f"Depth map size: {depth_map.size}")
@@ -97,18 +77,26 @@ def generate_image(prompt: str, image: Image.Image, pipe, depth_estimator):
     enhanced_prompt = enhance_prompt(prompt)
     print(f"Enhanced prompt: {enhanced_prompt}")
     
+    # Optional CFG truncation / ControlNet window (see guidance.py)
+    extra_params = guidance_params(
+        pipe, 20, 7.5, cfg_cutoff=cfg_cutoff, control_end=control_end,
+        step_callback=job.step_callback if job is not None else None
+    )
+    
     # Fixed parameters to prevent black images
     try:
-        output = pipe(
-            prompt=enhanced_prompt,
-            image=depth_map,
-            num_inference_steps=20,  # Increased for better quality
-            guidance_scale=7.5,      # Standard value that works well
-            controlnet_conditioning_scale=1.0,  # Important: ControlNet strength
-            num_images_per_prompt=1,
-            negative_prompt="dark, dim, poorly lit, low quality, blurry, distorted, deformed, ugly",
-            generator=torch.Generator().manual_seed(42)  # Fixed seed for consistency
-        ).images[0]
+        with adapter_gate.shared():
+            output = pipe(
+                prompt=enhanced_prompt,
+                image=depth_map,
+                num_inference_steps=20,  # Increased for better quality
+                guidance_scale=7.5,      # Standard value that works well
+                controlnet_conditioning_scale=1.0,  # Important: ControlNet strength
+                num_images_per_prompt=1,
+                negative_prompt="dark, dim, poorly lit, low quality, blurry, distorted, deformed, ugly",
+                generator=torch.Generator().manual_seed(42),  # Fixed seed for consistency
+                **extra_params
+            ).images[0]
         
         print(f"Generated image size: {output.size}")
         print(f"Generated image mode: {output.mode}")
@@ -128,6 +116,8 @@ def generate_image(prompt: str, image: Image.Image, pipe, depth_estimator):
             enhancer = ImageEnhance.Contrast(output)
             output = enhancer.enhance(1.5)
             
+    except GenerationCancelled:
+        raise
     except Exception as e:
         print(f"Generation error: {e}")
         # Fallback: create a test image instead of black
@@ -144,8 +134,5 @@ def generate_image(prompt: str, image: Image.Image, pipe, depth_estimator):
     # Post-process to enhance brightness if needed
     output = post_process_image(output)
     
-    # Resize output back to original dimensions
-    original_width, original_height = original_dims
-    output_resized = output.resize((original_width, original_height), Image.Resampling.LANCZOS)
-    
-    return output_resized
+    # Map output back to original dimensions
+    return restore_from_bucket(output, placement)
@@ -0,0 +1,116 @@
+import torch
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Tensors the CFG truncation callback rewrites when it drops the unconditional batch
+CFG_TENSOR_INPUTS = ["prompt_embeds", "image"]
+
+def chain_step_callbacks(*callbacks: Optional[Callable]) -> Optional[Callable]:
+    """Combine several callback_on_step_end functions into one, run in order"""
+    callbacks = [callback for callback in callbacks if callback is not None]
+    if not callbacks:
+        return None
+    if len(callbacks) == 1:
+        return callbacks[0]
+
+    def chained(pipe, step, timestep, callback_kwargs):
+        for callback in callbacks:
+            callback_kwargs = callback(pipe, step, timestep, callback_kwargs)
+        return callback_kwargs
+    return chained
+
+def cfg_cutoff_step(cfg_cutoff: Optional[float], num_steps: int) -> Optional[int]:
+    """Step index from which guidance is dropped, or None to keep it for the whole schedule"""
+    if cfg_cutoff is None:
+        return None
+    cutoff = min(max(float(cfg_cutoff), 0.0), 1.0)
+    step = int(round(cutoff * num_steps))
+    if step <= 0 or step >= num_steps:
+        return None
+    return step
+
+def supports_cfg_truncation(pipe) -> bool:
+    """Whether the pipeline hands the tensors we need to rewrite to step callbacks"""
+    allowed = getattr(pipe, '_callback_tensor_inputs', [])
+    return all(name in allowed for name in CFG_TENSOR_INPUTS)
+
+def cfg_truncation_callback(cutoff_step: int) -> Callable:
+    """Step callback that switches classifier-free guidance off from ``cutoff_step`` on.
+
+    The pipeline batches [unconditional, conditional] prompt embeddings and control
+    images; keeping only the conditional half and zeroing the guidance scale makes
+    the remaining steps run the UNet and ControlNet on half the batch.
+    """
+    def truncate(pipe, step, timestep, callback_kwargs):
+        if step + 1 == cutoff_step and pipe.do_classifier_free_guidance:
+            callback_kwargs["prompt_embeds"] = callback_kwargs["prompt_embeds"].chunk(2)[1]
+            callback_kwargs["image"] = callback_kwargs["image"].chunk(2)[1]
+            pipe._guidance_scale = 0.0
+        return callback_kwargs
+    return truncate
+
+def guidance_params(
+    pipe,
+    num_steps: int,
+    guidance_scale: float,
+    cfg_cutoff: Optional[float] = None,
+    control_end: Optional[float] = None,
+    step_callback: Optional[Callable] = None
+) -> Dict[str, Any]:
+    """Pipeline call arguments for CFG truncation and the ControlNet window.
+
+    ``step_callback`` (e.g. a job's cancellation callback) is chained with the
+    truncation callback, so pass the result as the only callback_on_step_end.
+    """
+    params: Dict[str, Any] = {}
+    callbacks: List[Callable] = [step_callback] if step_callback is not None else []
+    tensor_inputs = ["latents"]
+
+    cutoff_step = cfg_cutoff_step(cfg_cutoff, num_steps) if guidance_scale > 1 else None
+    if cutoff_step is not None:
+        if supports_cfg_truncation(pipe):
+            callbacks.append(cfg_truncation_callback(cutoff_step))
+            tensor_inputs += CFG_TENSOR_INPUTS
+        else:
+            print("CFG truncation is not supported by this diffusers version, keeping full guidance")
+
+    if control_end is not None and float(control_end) < 1.0:
+        params["control_guidance_end"] = min(max(float(control_end), 0.0), 1.0)
+        install_controlnet_skip(pipe.controlnet)
+
+    callback = chain_step_callbacks(*callbacks)
+    if callback is not None:
+        params["callback_on_step_end"] = callback
+        params["callback_on_step_end_tensor_inputs"] = tensor_inputs
+    return params
+
+def install_controlnet_skip(controlnet):
+    """Skip ControlNet forward passes outside its conditioning window.
+
+    After control_guidance_end the pipeline still runs the ControlNet, just with
+    conditioning_scale=0, so its residuals are all zeros. Return zeros of the
+    shapes seen on a real pass at the same latent size instead of computing
+    them. Installed once; passes with a non-zero scale are untouched.
+    """
+    if getattr(controlnet, '_skips_inactive', False):
+        return
+    original_forward = controlnet.forward
+    shapes: Dict[Tuple[int, ...], Tuple[list, Any]] = {}
+
+    def forward(sample, timestep, *args, conditioning_scale=1.0, return_dict=True, **kwargs):
+        size = tuple(sample.shape[2:])
+        if conditioning_scale == 0 and not return_dict and size in shapes:
+            return _zero_residuals(sample, *shapes[size])
+        output = original_forward(
+            sample, timestep, *args, conditioning_scale=conditioning_scale, return_dict=return_dict, **kwargs
+        )
+        down, mid = output if not return_dict else (output.down_block_res_samples, output.mid_block_res_sample)
+        shapes[size] = ([residual.shape[1:] for residual in down], mid.shape[1:])
+        return output
+
+    controlnet.forward = forward
+    controlnet._skips_inactive = True
+
+def _zero_residuals(sample, down_shapes, mid_shape) -> Tuple[List[torch.Tensor], torch.Tensor]:
+    batch = sample.shape[0]
+    zeros = lambda shape: torch.zeros((batch, *shape), dtype=sample.dtype, device=sample.device)
+    return [zeros(shape) for shape in down_shapes], zeros(mid_shape)
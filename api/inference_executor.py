@@ -0,0 +1,251 @@
+import asyncio
+import os
+import queue
+import threading
+import time
+import weakref
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+import torch
+from diffusers import DiffusionPipeline
+
+# Generations run at once on this node. CPU cores are split evenly between the slots, so two
+# requests each get half the cores instead of fighting over all of them. CUDA always uses one.
+INFERENCE_SLOTS = int(os.getenv("INFERENCE_SLOTS", "1"))
+
+# Pin each slot's threads to its own cores (Linux only; ignored with a single slot)
+PIN_SLOT_CPUS = os.getenv("PIN_SLOT_CPUS", "1") == "1"
+
+# Attributes set on pipelines after construction that slot copies must carry over
+CLONED_ATTRIBUTES = ("draft_adapter",)
+
+_local = threading.local()
+
+
+class SharedExclusiveLock:
+    """Any number of shared holders, or one exclusive holder. Waiting exclusive
+    holders block new shared ones so they aren't starved."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._shared = 0
+        self._exclusive = False
+        self._exclusive_waiting = 0
+
+    @contextmanager
+    def shared(self):
+        with self._cond:
+            self._cond.wait_for(lambda: not self._exclusive and not self._exclusive_waiting)
+            self._shared += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._shared -= 1
+                self._cond.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        with self._cond:
+            self._exclusive_waiting += 1
+            try:
+                self._cond.wait_for(lambda: not self._exclusive and self._shared == 0)
+            finally:
+                self._exclusive_waiting -= 1
+            self._exclusive = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._exclusive = False
+                self._cond.notify_all()
+
+
+# Held exclusively while the draft LoRA is enabled on the UNet every pipeline shares, and
+# shared by every other pipeline call, so concurrent slots never render with the wrong weights
+adapter_gate = SharedExclusiveLock()
+
+
+def available_cpus() -> List[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def partition_cpus(cpus: List[int], slots: int) -> List[List[int]]:
+    """Split cores into ``slots`` contiguous groups of equal size (leftover cores stay idle)"""
+    per_slot = max(1, len(cpus) // slots)
+    return [cpus[i * per_slot:(i + 1) * per_slot] for i in range(slots)]
+
+
+def slot_pipeline(pipe):
+    """The calling slot's own copy of a pipeline.
+
+    Pipelines keep per-call state on the object (scheduler timesteps, guidance scale,
+    step counters), so concurrent slots can't share one. The copy shares every model
+    component and has its own scheduler. With a single slot the pipeline is returned
+    unchanged.
+    """
+    copies = getattr(_local, "pipelines", None)
+    if copies is None:
+        return pipe
+    copy = copies.get(pipe)
+    if copy is None:
+        components = dict(pipe.components)
+        components["scheduler"] = type(pipe.scheduler).from_config(pipe.scheduler.config)
+        copy = type(pipe)(**components)
+        for name in CLONED_ATTRIBUTES:
+            if hasattr(pipe, name):
+                setattr(copy, name, getattr(pipe, name))
+        copies[pipe] = copy
+    return copy
+
+
+def _localize(value):
+    return slot_pipeline(value) if isinstance(value, DiffusionPipeline) else value
+
+
+class Slot:
+    def __init__(self, index: int, cpus: List[int], threads: Optional[int]):
+        self.index = index
+        self.cpus = cpus
+        self.threads = threads
+        self.busy_since: Optional[float] = None
+        self.jobs = 0
+        self.busy_seconds = 0.0
+
+    def describe(self, uptime: float) -> Dict[str, Any]:
+        busy_seconds = self.busy_seconds
+        if self.busy_since is not None:
+            busy_seconds += time.perf_counter() - self.busy_since
+        return {
+            "index": self.index,
+            "cpus": self.cpus,
+            "threads": self.threads,
+            "busy": self.busy_since is not None,
+            "jobs": self.jobs,
+            "busy_seconds": round(busy_seconds, 1),
+            "utilization": round(busy_seconds / uptime, 3) if uptime > 0 else 0.0,
+        }
+
+
+class InferenceExecutor:
+    """Runs blocking generation calls on a fixed set of slots.
+
+    Each slot is one worker thread with its own intra-op thread budget and,
+    optionally, CPU affinity. Calls wait in one FIFO queue and the next free slot
+    takes the oldest. Pipeline arguments are swapped for the slot's own copy (see
+    slot_pipeline) when more than one slot runs.
+    """
+
+    def __init__(self, device: str, slots: int = INFERENCE_SLOTS, pin: bool = PIN_SLOT_CPUS):
+        if device == "cuda" and slots > 1:
+            print(f"INFERENCE_SLOTS={slots} ignored on CUDA; generations run one at a time")
+            slots = 1
+        cpus = available_cpus()
+        slots = max(1, min(slots, len(cpus)))
+        self.partitioned = slots > 1
+        # Intra-op threads before any slot set its own (the autotuned value, if any)
+        self.tuned_threads = torch.get_num_threads()
+        self.pinned = self.partitioned and pin and hasattr(os, "sched_setaffinity")
+
+        groups = partition_cpus(cpus, slots) if self.partitioned else [cpus]
+        self.slots = [
+            Slot(i, group, len(group) if self.partitioned else None) for i, group in enumerate(groups)
+        ]
+
+        self._queue: "queue.Queue" = queue.Queue()
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+        self._waiting = 0
+        self._submitted = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._dispatched = 0
+
+        for slot in self.slots:
+            threading.Thread(
+                target=self._worker, args=(slot,), name=f"inference-slot-{slot.index}", daemon=True
+            ).start()
+        if self.partitioned:
+            print(f"Inference: {slots} slots x {len(groups[0])} cores"
+                  f"{' (pinned)' if self.pinned else ''}")
+
+    def _worker(self, slot: Slot):
+        if self.partitioned:
+            _local.pipelines = weakref.WeakKeyDictionary()
+            # torch's intra-op pool is process-wide, so this also applies outside the slots; every
+            # slot has the same budget, so they agree (reported in snapshot() and /models/info)
+            torch.set_num_threads(slot.threads)
+            if self.pinned:
+                # pid 0 = this thread; torch's worker threads created from it inherit the mask
+                try:
+                    os.sched_setaffinity(0, slot.cpus)
+                except OSError as e:
+                    print(f"Inference slot {slot.index}: CPU affinity not applied ({e})")
+
+        while True:
+            future, fn, args, kwargs, enqueued = self._queue.get()
+            with self._lock:
+                self._waiting -= 1
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            started = time.perf_counter()
+            with self._lock:
+                wait = started - enqueued
+                self._wait_total += wait
+                self._wait_max = max(self._wait_max, wait)
+                self._dispatched += 1
+                slot.busy_since = started
+            try:
+                result = fn(*[_localize(a) for a in args], **{k: _localize(v) for k, v in kwargs.items()})
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            finally:
+                with self._lock:
+                    slot.busy_since = None
+                    slot.jobs += 1
+                    slot.busy_seconds += time.perf_counter() - started
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        future: Future = Future()
+        with self._lock:
+            self._waiting += 1
+            self._submitted += 1
+        self._queue.put((future, fn, args, kwargs, time.perf_counter()))
+        return future
+
+    async def run(self, fn, *args, **kwargs):
+        """Run a blocking call on the next free slot and wait for its result"""
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def queue_depth(self) -> int:
+        """Calls waiting for a slot plus calls running"""
+        with self._lock:
+            return self._waiting + sum(1 for slot in self.slots if slot.busy_since is not None)
+
+    def jobs_ahead(self) -> float:
+        """Queue depth per slot: how many jobs' worth of time a new call waits behind"""
+        return self.queue_depth() / len(self.slots)
+
+    def snapshot(self) -> Dict[str, Any]:
+        uptime = time.perf_counter() - self._started
+        with self._lock:
+            return {
+                "slots": len(self.slots),
+                "partitioned": self.partitioned,
+                "pinned": self.pinned,
+                "tuned_threads": self.tuned_threads,
+                "threads_per_slot": self.slots[0].threads,
+                "waiting": self._waiting,
+                "running": sum(1 for slot in self.slots if slot.busy_since is not None),
+                "submitted": self._submitted,
+                "mean_wait_ms": round(self._wait_total / self._dispatched * 1000) if self._dispatched else 0,
+                "max_wait_ms": round(self._wait_max * 1000),
+                "per_slot": [slot.describe(uptime) for slot in self.slots],
+            }
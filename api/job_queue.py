@@ -0,0 +1,184 @@
+import json
+from abc import ABC, abstractmethod
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Dict, Any, Optional
+
+class JobQueue(ABC):
+    """Shared work queue between API nodes (enqueue) and worker nodes (lease, render, complete).
+
+    A leased job belongs to one worker until its lease expires; workers extend it with
+    heartbeat(). Jobs whose lease expired are handed out again. Backends implement the
+    methods below; see open_queue() for selecting one by URL.
+    """
+
+    @abstractmethod
+    def enqueue(self, prompt: str, settings: Dict[str, Any], image_bytes: bytes) -> str:
+        """Add a job and return its id"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def lease(self, worker_id: str) -> Optional[Dict[str, Any]]:
+        """Take the oldest queued job (re-queueing expired leases first), or None if idle.
+
+        The returned dict has id, prompt, settings, image (bytes) and attempts.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def heartbeat(self, job_id: str, worker_id: str) -> bool:
+        """Extend a lease; False if the worker no longer holds it"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def complete(self, job_id: str, worker_id: str, result: Dict[str, Any]) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def fail(self, job_id: str, worker_id: str, error: str) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Status and result of a job (without its input image)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def stats(self) -> Dict[str, int]:
+        """Job counts by status"""
+        raise NotImplementedError
+
+class SQLiteJobQueue(JobQueue):
+    """JobQueue on a SQLite file, for local testing or nodes sharing a filesystem"""
+
+    def __init__(self, path: str, lease_seconds: float = 60, max_attempts: int = 3):
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                prompt TEXT NOT NULL,
+                settings TEXT NOT NULL,
+                image BLOB,
+                result TEXT,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                worker TEXT,
+                lease_expires REAL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs(status, created_at)")
+
+    def enqueue(self, prompt: str, settings: Dict[str, Any], image_bytes: bytes) -> str:
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, status, prompt, settings, image, created_at, updated_at) "
+                "VALUES (?, 'queued', ?, ?, ?, ?, ?)",
+                (job_id, prompt, json.dumps(settings), image_bytes, now, now)
+            )
+        return job_id
+
+    def lease(self, worker_id: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Expired leases go back to the queue, or fail after too many attempts
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'failed', error = 'lease expired too many times', "
+                    "worker = NULL, updated_at = ? "
+                    "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                    (now, now, self.max_attempts)
+                )
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'queued', worker = NULL, updated_at = ? "
+                    "WHERE status = 'leased' AND lease_expires < ?",
+                    (now, now)
+                )
+                row = self._conn.execute(
+                    "SELECT id, prompt, settings, image, attempts FROM jobs "
+                    "WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+                ).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        "UPDATE jobs SET status = 'leased', worker = ?, lease_expires = ?, "
+                        "attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                        (worker_id, now + self.lease_seconds, now, row["id"])
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        if row is None:
+            return None
+        return {
+            "id": row["id"],
+            "prompt": row["prompt"],
+            "settings": json.loads(row["settings"]),
+            "image": row["image"],
+            "attempts": row["attempts"] + 1,
+        }
+
+    def heartbeat(self, job_id: str, worker_id: str) -> bool:
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET lease_expires = ?, updated_at = ? "
+                "WHERE id = ? AND worker = ? AND status = 'leased'",
+                (now + self.lease_seconds, now, job_id, worker_id)
+            )
+        return cursor.rowcount == 1
+
+    def complete(self, job_id: str, worker_id: str, result: Dict[str, Any]) -> bool:
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = 'done', result = ?, image = NULL, worker = NULL, updated_at = ? "
+                "WHERE id = ? AND worker = ? AND status = 'leased'",
+                (json.dumps(result), time.time(), job_id, worker_id)
+            )
+        return cursor.rowcount == 1
+
+    def fail(self, job_id: str, worker_id: str, error: str) -> bool:
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, image = NULL, worker = NULL, updated_at = ? "
+                "WHERE id = ? AND worker = ? AND status = 'leased'",
+                (error, time.time(), job_id, worker_id)
+            )
+        return cursor.rowcount == 1
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, status, result, error, attempts, worker, created_at, updated_at "
+                "FROM jobs WHERE id = ?",
+                (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        return {row["status"]: row["n"] for row in rows}
+
+def open_queue(url: str, lease_seconds: float = 60) -> JobQueue:
+    """Open a queue backend by URL, e.g. sqlite:///shared/queue.db"""
+    if url.startswith("sqlite:///"):
+        return SQLiteJobQueue(url[len("sqlite:///"):], lease_seconds=lease_seconds)
+    raise ValueError(f"Unsupported job queue URL: {url}")
@@ -0,0 +1,102 @@
+import threading
+import time
+import uuid
+from typing import Dict, Any, Optional
+
+class GenerationCancelled(Exception):
+    """Raised from inside a generation when its job has been cancelled"""
+
+class DuplicateJobId(Exception):
+    """A client-supplied job id is already used by a running job"""
+
+class Job:
+    """An in-flight generation: cancellation flag, denoising progress and how many
+    requests are waiting on it.
+
+    ``step_callback`` is passed to the pipeline as ``callback_on_step_end`` so a
+    cancel request stops denoising within one step.
+    """
+
+    def __init__(self, job_id: Optional[str] = None):
+        self.job_id = job_id or str(uuid.uuid4())
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.status = "running"
+        self.step = 0
+        self.total_steps = 0
+        self.subscribers = 1
+        # Set when the render reused cached work (latents, decoded image or depth map)
+        self.cache_reused = False
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def check(self):
+        """Raise GenerationCancelled if the job has been cancelled"""
+        if self._cancelled.is_set():
+            raise GenerationCancelled(self.job_id)
+
+    def step_callback(self, pipe, step: int, timestep, callback_kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        self.step = step + 1
+        self.total_steps = getattr(pipe, 'num_timesteps', self.total_steps)
+        self.check()
+        return callback_kwargs
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "step": self.step,
+            "total_steps": self.total_steps,
+            "cancelled": self.cancelled,
+            "subscribers": self.subscribers,
+            "created_at": self.created_at,
+        }
+
+class JobRegistry:
+    """Jobs by id, kept for a short while after they finish so status can still be read"""
+
+    def __init__(self, retain_seconds: float = 300, max_age_seconds: float = 3600):
+        self._jobs: Dict[str, Job] = {}
+        self._retain_seconds = retain_seconds
+        self._max_age_seconds = max_age_seconds
+        self._lock = threading.Lock()
+
+    def create(self, job_id: Optional[str] = None) -> Job:
+        """Register a new job; raises DuplicateJobId if job_id belongs to a running job"""
+        job = Job(job_id)
+        with self._lock:
+            self._prune()
+            existing = self._jobs.get(job.job_id)
+            if existing is not None and existing.status == "running":
+                raise DuplicateJobId(job.job_id)
+            self._jobs[job.job_id] = job
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> bool:
+        """Flag a job as cancelled; returns False if it is unknown or already finished"""
+        job = self.get(job_id)
+        if job is None or job.status != "running":
+            return False
+        job.cancel()
+        return True
+
+    def finish(self, job: Job, status: str):
+        job.status = status
+        job.finished_at = time.time()
+
+    def _prune(self):
+        now = time.time()
+        for job_id in [j for j, job in self._jobs.items()
+                       if (job.finished_at is not None and job.finished_at < now - self._retain_seconds)
+                       or job.created_at < now - self._max_age_seconds]:
+            del self._jobs[job_id]
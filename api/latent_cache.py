@@ -0,0 +1,224 @@
+import copy
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+from PIL import Image
+
+from guidance import cfg_cutoff_step
+from metrics import metrics
+
+# Prefix entries (one per input image + early-affecting settings) kept in memory
+LATENT_CACHE_SIZE = int(os.getenv("LATENT_CACHE_SIZE", "16"))
+
+# Default snapshot points for every cacheable request, e.g. "0.5,0.75" (fractions of the
+# schedule) or "10,15" (step indices); requests can set their own with snapshotSteps
+LATENT_SNAPSHOT_STEPS = os.getenv("LATENT_SNAPSHOT_STEPS", "")
+
+# Decoded results kept per prefix entry (one per combination of late-stage settings)
+FINALS_PER_ENTRY = 4
+
+
+class Snapshot:
+    """Latents and scheduler state after ``step`` denoising steps"""
+
+    def __init__(self, step: int, latents: torch.Tensor, scheduler, late: Tuple[int, int]):
+        self.step = step
+        self.latents = latents
+        self.scheduler = scheduler
+        self.late = late
+
+    def compatible(self, late: Tuple[int, int]) -> bool:
+        """Whether a run with these late boundaries took the same first ``step`` steps"""
+        return all(min(old, self.step) == min(new, self.step) for old, new in zip(self.late, late))
+
+
+class PrefixEntry:
+    """Everything cached for one diffusion prefix: the depth map, snapshots and final decodes"""
+
+    def __init__(self):
+        self.depth_map: Optional[Image.Image] = None
+        self.placement = None
+        self.snapshots: Dict[Tuple[int, Tuple[int, int]], Snapshot] = {}
+        self.finals: "OrderedDict[Tuple[int, int], Image.Image]" = OrderedDict()
+
+    def best_snapshot(self, late: Tuple[int, int]) -> Optional[Snapshot]:
+        """The furthest-along snapshot a run with these late boundaries can resume from"""
+        usable = [snapshot for snapshot in self.snapshots.values() if snapshot.compatible(late)]
+        return max(usable, key=lambda snapshot: snapshot.step, default=None)
+
+
+class LatentCache:
+    """Bounded LRU of prefix entries keyed by a hash of everything that shapes the early steps.
+
+    Late-stage settings (CFG cutoff, ControlNet window end) are excluded from the key and
+    stored with each snapshot instead, so a request that only changes them can resume from
+    the furthest snapshot taken before they start to matter. A request that only changes
+    post-processing reuses the decoded image of an identical diffusion.
+    """
+
+    def __init__(self, max_entries: int = LATENT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, PrefixEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def entry(self, key: str) -> PrefixEntry:
+        """Entry for a prefix key, created (and the oldest evicted) if missing"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = PrefixEntry()
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            else:
+                self._entries.move_to_end(key)
+            return entry
+
+    def add_snapshot(self, entry: PrefixEntry, snapshot: Snapshot):
+        with self._lock:
+            entry.snapshots[(snapshot.step, snapshot.late)] = snapshot
+
+    def add_final(self, entry: PrefixEntry, late: Tuple[int, int], image: Image.Image):
+        with self._lock:
+            entry.finals[late] = image
+            while len(entry.finals) > FINALS_PER_ENTRY:
+                entry.finals.popitem(last=False)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "snapshots": sum(len(entry.snapshots) for entry in self._entries.values()),
+                "finals": sum(len(entry.finals) for entry in self._entries.values()),
+            }
+
+
+latent_cache = LatentCache()
+
+
+def cacheable(settings: Dict[str, Any], draft: bool) -> bool:
+    """Only deterministic (seeded) final-quality renders can be branched from"""
+    return (
+        latent_cache.enabled
+        and not draft
+        and int(settings.get('seed', 0) or 0) > 0
+        and settings.get('latentCache', True) is not False
+    )
+
+
+def prefix_key(image: Image.Image, params: Dict[str, Any]) -> str:
+    """Hash of the input image and the settings that affect every denoising step"""
+    digest = hashlib.sha256()
+    digest.update(f"{image.mode}:{image.width}x{image.height}:".encode())
+    digest.update(image.tobytes())
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+def late_boundaries(num_steps: int, guidance_scale: float, cfg_cutoff=None, control_end=None) -> Tuple[int, int]:
+    """First step without guidance and first step without ControlNet (num_steps = never)"""
+    cutoff = cfg_cutoff_step(cfg_cutoff, num_steps) if guidance_scale > 1 else None
+    control_off = num_steps
+    if control_end is not None and float(control_end) < 1.0:
+        end = min(max(float(control_end), 0.0), 1.0)
+        control_off = next((i for i in range(num_steps) if (i + 1) / num_steps > end), num_steps)
+    return (cutoff if cutoff is not None else num_steps), control_off
+
+
+def snapshot_steps(settings: Dict[str, Any], num_steps: int, interval: int = 1) -> List[int]:
+    """Steps after which to snapshot: values below 1 are fractions of the schedule.
+
+    With step caching only full-UNet steps are used, so a resumed run starts the same way.
+    """
+    values = settings.get('snapshotSteps')
+    if values is None:
+        values = [v for v in LATENT_SNAPSHOT_STEPS.split(",") if v.strip()]
+    steps = set()
+    for value in values:
+        value = float(value)
+        step = int(round(value * num_steps)) if value < 1 else int(value)
+        if 0 < step < num_steps and step % interval == 0:
+            steps.add(step)
+    return sorted(steps)
+
+
+def snapshot_callback(entry: PrefixEntry, steps: List[int], late: Tuple[int, int]):
+    """Step callback storing latents and a scheduler copy after each listed step"""
+    wanted = set(steps)
+
+    def take(pipe, step, timestep, callback_kwargs):
+        completed = step + 1
+        if completed in wanted:
+            latent_cache.add_snapshot(entry, Snapshot(
+                completed, callback_kwargs["latents"].detach().clone(), copy.deepcopy(pipe.scheduler), late
+            ))
+        return callback_kwargs
+    return take
+
+
+@torch.no_grad()
+def resume_denoising(
+    pipe,
+    snapshot: Snapshot,
+    prompt: str,
+    negative_prompt: str,
+    depth_map: Image.Image,
+    guidance_scale: float,
+    late: Tuple[int, int],
+    job=None,
+    deep_cache_state=None
+) -> torch.Tensor:
+    """Finish a denoising run from a snapshot, mirroring the ControlNet pipeline's loop"""
+    device = pipe._execution_device
+    scheduler = copy.deepcopy(snapshot.scheduler)
+    timesteps = scheduler.timesteps
+    cutoff, control_off = late
+
+    guided = guidance_scale > 1 and snapshot.step < cutoff
+    prompt_embeds, negative_embeds = pipe.encode_prompt(prompt, device, 1, guided, negative_prompt)
+    if guided:
+        prompt_embeds = torch.cat([negative_embeds, prompt_embeds])
+    image = pipe.prepare_image(
+        image=depth_map, width=depth_map.width, height=depth_map.height, batch_size=1,
+        num_images_per_prompt=1, device=device, dtype=pipe.controlnet.dtype,
+        do_classifier_free_guidance=guided, guess_mode=False
+    )
+
+    if deep_cache_state is not None:
+        deep_cache_state.step = snapshot.step
+    latents = snapshot.latents.to(device)
+    for i in range(snapshot.step, len(timesteps)):
+        t = timesteps[i]
+        if guided and i >= cutoff:
+            prompt_embeds, image, guided = prompt_embeds.chunk(2)[1], image.chunk(2)[1], False
+
+        model_input = torch.cat([latents] * 2) if guided else latents
+        model_input = scheduler.scale_model_input(model_input, t)
+        down, mid = pipe.controlnet(
+            model_input, t, encoder_hidden_states=prompt_embeds, controlnet_cond=image,
+            conditioning_scale=1.0 if i < control_off else 0.0, guess_mode=False, return_dict=False
+        )
+        noise_pred = pipe.unet(
+            model_input, t, encoder_hidden_states=prompt_embeds,
+            down_block_additional_residuals=down, mid_block_additional_residual=mid, return_dict=False
+        )[0]
+        if guided:
+            noise_uncond, noise_text = noise_pred.chunk(2)
+            noise_pred = noise_uncond + guidance_scale * (noise_text - noise_uncond)
+        latents = scheduler.step(noise_pred, t, latents, return_dict=False)[0]
+
+        if job is not None:
+            job.step = i + 1
+            job.check()
+
+    metrics.incr("latent_cache_steps_skipped", snapshot.step)
+    return latents
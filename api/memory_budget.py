@@ -0,0 +1,342 @@
+import os
+import threading
+from contextlib import contextmanager, nullcontext
+from typing import Any, Dict, Optional, Tuple
+
+import torch
+
+from buckets import select_bucket
+from metrics import metrics
+
+# Peak memory per request in MB (process RSS on CPU, allocator peak on CUDA); unset = no limit.
+# Requests may lower it further with the memoryBudgetMb setting.
+MEMORY_BUDGET_MB = float(os.getenv("MEMORY_BUDGET_MB", "0")) or None
+
+# Activation memory in MB per megapixel before anything has been measured on this node:
+# preprocess -> input MP, denoise -> working MP per batch item (x2 with CFG),
+# decode -> working MP per decoded image (or per tile), postprocess -> output MP
+_PRIORS = {
+    "cpu": {"preprocess": 40.0, "denoise": 3000.0, "decode": 5000.0, "postprocess": 60.0},
+    "cuda": {"preprocess": 40.0, "denoise": 1500.0, "decode": 2500.0, "postprocess": 60.0},
+}
+
+# Ways to lower the peak, cheapest first; sequential offload only helps GPU memory
+OPTION_SETS = [(), ("vae_slicing",), ("vae_slicing", "vae_tiling")]
+CUDA_OPTION_SETS = OPTION_SETS + [("vae_slicing", "vae_tiling", "sequential_offload")]
+
+MB = 1024 * 1024
+
+
+class MemoryBudgetExceeded(Exception):
+    """A request can't run within its memory budget (507) or the memory free right now (503)"""
+
+    def __init__(self, message: str, needed_mb: float, limit_mb: float, status_code: int = 507):
+        super().__init__(message)
+        self.needed_mb = needed_mb
+        self.limit_mb = limit_mb
+        self.status_code = status_code
+
+
+def current_rss_mb() -> float:
+    """Resident set size of this process"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def available_mb(device: str) -> Optional[float]:
+    """Memory that can still be allocated on the device, if known"""
+    if device == "cuda":
+        free, _ = torch.cuda.mem_get_info()
+        return free / MB
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+class PeakTracker:
+    """Peak memory while the block runs: sampled RSS on CPU, allocator stats on CUDA"""
+
+    def __init__(self, device: str, interval: float = 0.02):
+        self.device = device
+        self.interval = interval
+        self.start_mb = 0.0
+        self.peak_mb = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak_mb = max(self.peak_mb, current_rss_mb())
+
+    def __enter__(self):
+        if self.device == "cuda":
+            torch.cuda.reset_peak_memory_stats()
+            self.start_mb = torch.cuda.memory_allocated() / MB
+        else:
+            self.start_mb = current_rss_mb()
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        self.peak_mb = self.start_mb
+        return self
+
+    def __exit__(self, *exc):
+        if self.device == "cuda":
+            self.peak_mb = torch.cuda.max_memory_allocated() / MB
+        else:
+            self._stop.set()
+            self._thread.join()
+            self.peak_mb = max(self.peak_mb, current_rss_mb())
+        return False
+
+
+class MemoryPlan:
+    """Memory-saving options chosen for one request and what they are expected to cost"""
+
+    def __init__(self, options: Tuple[str, ...], batch: int, predicted_mb: float,
+                 baseline_mb: float, budget_mb: Optional[float]):
+        self.options = options
+        self.batch = batch
+        self.predicted_mb = predicted_mb
+        self.baseline_mb = baseline_mb
+        self.budget_mb = budget_mb
+        self.peak_mb: Optional[float] = None
+
+    @property
+    def activation_mb(self) -> float:
+        return self.predicted_mb - self.baseline_mb
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "budget_mb": self.budget_mb,
+            "options": list(self.options),
+            "batch": self.batch,
+            "predicted_peak_mb": round(self.predicted_mb),
+            "peak_mb": round(self.peak_mb) if self.peak_mb is not None else None,
+        }
+
+
+class MemoryPlanner:
+    """Chooses VAE slicing/tiling, sequential offload and batch limits so a request's
+    peak stays under its budget, and learns from the peaks measured while running.
+
+    Estimates are the memory in use when the request is planned plus the largest
+    per-stage activation estimate, scaled by an exponentially weighted ratio of
+    measured to predicted activation memory.
+
+    With several inference slots, requests already running hold a reservation of
+    their predicted activation memory. Planning and admission count those
+    reservations on top of the memory in use while nothing was running, and a run
+    waits in apply() until its own reservation fits. Peaks measured while another
+    run overlapped are not learned from, since RSS can't be split between them.
+    """
+
+    def __init__(self, pipe, budget_mb: Optional[float] = MEMORY_BUDGET_MB, alpha: float = 0.3):
+        self.device = pipe.device.type if pipe.device.type == "cuda" else "cpu"
+        self.budget_mb = budget_mb
+        self._rates = dict(_PRIORS[self.device])
+        self._scale = 1.0
+        self._samples = 0
+        self._alpha = alpha
+        self._lock = threading.Lock()
+        self._apply_lock = threading.Lock()
+        # Runs in progress (id -> [activation reservation MB, overlapped]) and the memory in use
+        # the last time none was
+        self._admission = threading.Condition()
+        self._running: Dict[int, list] = {}
+        self._idle_mb: Optional[float] = None
+        self._skipped = 0
+
+        tile = getattr(pipe.vae, "tile_sample_min_size", 512)
+        self._tile_mp = tile * tile / 1e6
+        self._denoiser_mb = sum(
+            p.numel() * p.element_size() for model in (pipe.unet, pipe.controlnet) for p in model.parameters()
+        ) / MB
+
+    def budget_for(self, settings: Dict[str, Any]) -> Optional[float]:
+        requested = float(settings.get('memoryBudgetMb') or 0) or None
+        if self.budget_mb is None:
+            return requested
+        return min(self.budget_mb, requested) if requested else self.budget_mb
+
+    def _baseline_mb(self, options: Tuple[str, ...]) -> float:
+        """Memory in use before the request's own allocations, counting the reservations of runs
+        in progress rather than whatever part of them has been allocated so far"""
+        if self.device != "cuda":
+            with self._admission:
+                if self._running:
+                    idle = self._idle_mb if self._idle_mb is not None else current_rss_mb()
+                    return idle + sum(reserved for reserved, _ in self._running.values())
+                self._idle_mb = current_rss_mb()
+                return self._idle_mb
+        resident = torch.cuda.memory_allocated() / MB
+        # Model offload brings the UNet and ControlNet onto the GPU for denoising
+        return resident if "sequential_offload" in options else resident + self._denoiser_mb
+
+    def activation_mb(self, input_size: Tuple[int, int], settings: Dict[str, Any],
+                      options: Tuple[str, ...] = (), batch: int = 1) -> float:
+        """Predicted peak memory on top of the baseline"""
+        width, height = input_size
+        working_width, working_height = select_bucket(width, height, int(settings.get('maxSize', 512)))
+        working_mp = working_width * working_height / 1e6
+        input_mp = width * height / 1e6
+        output_mp = working_mp * 4 if settings.get('enableUpscaling', False) else input_mp
+        guided = 2 if float(settings.get('guidanceScale', 7.5)) > 1 else 1
+
+        decode_mp = min(working_mp, self._tile_mp) if "vae_tiling" in options else working_mp
+        decoded = 1 if "vae_slicing" in options else batch
+        with self._lock:
+            rates, scale = dict(self._rates), self._scale
+        stages = [
+            rates["preprocess"] * input_mp,
+            rates["denoise"] * working_mp * guided * batch,
+            rates["decode"] * decode_mp * decoded,
+            rates["postprocess"] * output_mp * batch,
+        ]
+        return max(stages) * scale
+
+    def plan(self, input_size: Tuple[int, int], settings: Dict[str, Any], batch: int = 1) -> MemoryPlan:
+        """Cheapest options (and largest batch up to ``batch``) that fit the budget.
+
+        Raises MemoryBudgetExceeded when nothing fits the budget, or the memory
+        available right now.
+        """
+        budget = self.budget_for(settings)
+        option_sets = CUDA_OPTION_SETS if self.device == "cuda" else OPTION_SETS
+
+        best: Optional[MemoryPlan] = None
+        for options in option_sets:
+            baseline = self._baseline_mb(options)
+            for size in range(batch, 0, -1):
+                predicted = baseline + self.activation_mb(input_size, settings, options, size)
+                if budget is None or predicted <= budget:
+                    if best is None or size > best.batch:
+                        best = MemoryPlan(options, size, predicted, baseline, budget)
+                    break
+            if best is not None and best.batch == batch:
+                break
+
+        if best is None:
+            cheapest = option_sets[-1]
+            needed = self._baseline_mb(cheapest) + self.activation_mb(input_size, settings, cheapest, 1)
+            metrics.incr("memory_rejected")
+            raise MemoryBudgetExceeded(
+                f"Request needs about {needed:.0f} MB, over the {budget:.0f} MB memory budget; "
+                "lower maxSize or disable upscaling", needed, budget
+            )
+
+        available = available_mb(self.device)
+        needed_now = best.predicted_mb - best.baseline_mb
+        if budget is not None and available is not None and needed_now > available:
+            metrics.incr("memory_rejected")
+            raise MemoryBudgetExceeded(
+                f"Not enough free memory right now ({available:.0f} MB free, about {needed_now:.0f} MB needed); "
+                "retry shortly", needed_now, available, status_code=503
+            )
+        return best
+
+    def max_batch(self, input_size: Tuple[int, int], settings: Dict[str, Any], limit: int) -> int:
+        """Largest batch up to ``limit`` that fits the budget"""
+        return self.plan(input_size, settings, batch=limit).batch
+
+    def observe(self, plan: MemoryPlan, start_mb: float, peak_mb: float, input_size, settings):
+        """Update the estimate scale from a measured peak"""
+        predicted = self.activation_mb(input_size, settings, plan.options, plan.batch)
+        if predicted <= 0:
+            return
+        ratio = max(0.25, min(4.0, max(peak_mb - start_mb, 0.0) / predicted * self._scale))
+        with self._lock:
+            if self._samples == 0:
+                self._scale = ratio
+            else:
+                self._scale += self._alpha * (ratio - self._scale)
+            self._samples += 1
+        metrics.set_gauge("memory_last_peak_mb", round(peak_mb))
+
+    def _fits(self, plan: MemoryPlan) -> bool:
+        # CUDA runs one request at a time, so only CPU slots ever overlap
+        if not self._running or plan.budget_mb is None or self.device == "cuda":
+            return True
+        idle = self._idle_mb if self._idle_mb is not None else current_rss_mb()
+        reserved = sum(reserved for reserved, _ in self._running.values())
+        return idle + reserved + plan.activation_mb <= plan.budget_mb
+
+    @contextmanager
+    def _reserved(self, plan: MemoryPlan):
+        """Hold the plan's activation reservation for the block, waiting until it fits next to
+        the runs already in progress; yields the run's [reservation, overlapped] state"""
+        with self._admission:
+            self._admission.wait_for(lambda: self._fits(plan))
+            state = [plan.activation_mb, bool(self._running)]
+            for other in self._running.values():
+                other[1] = True
+            self._running[id(state)] = state
+        try:
+            yield state
+        finally:
+            with self._admission:
+                del self._running[id(state)]
+                if not self._running and self.device != "cuda":
+                    self._idle_mb = current_rss_mb()
+                self._admission.notify_all()
+
+    @contextmanager
+    def apply(self, pipe, plan: MemoryPlan, input_size: Tuple[int, int], settings: Dict[str, Any]):
+        """Run the block with the plan's options switched on, tracking its peak"""
+        # The options change shared pipeline state, so runs that need them go one at a time.
+        # Runs without options may overlap one that has them and get them too (a lower peak).
+        with self._reserved(plan) as state, self._apply_lock if plan.options else nullcontext():
+            vae = pipe.vae
+            if "vae_slicing" in plan.options:
+                vae.enable_slicing()
+            if "vae_tiling" in plan.options:
+                vae.enable_tiling()
+            if "sequential_offload" in plan.options:
+                pipe.remove_all_hooks()
+                pipe.enable_sequential_cpu_offload()
+
+            tracker = PeakTracker(self.device)
+            try:
+                with tracker:
+                    yield plan
+            finally:
+                if "vae_slicing" in plan.options:
+                    vae.disable_slicing()
+                if "vae_tiling" in plan.options:
+                    vae.disable_tiling()
+                if "sequential_offload" in plan.options:
+                    pipe.remove_all_hooks()
+                    pipe.enable_model_cpu_offload()
+                plan.peak_mb = tracker.peak_mb
+                if state[1]:
+                    # Another run shared the process (and maybe the options) while this one ran
+                    self._skipped += 1
+                else:
+                    self.observe(plan, tracker.start_mb, tracker.peak_mb, input_size, settings)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._admission:
+            running = len(self._running)
+            reserved = sum(reserved for reserved, _ in self._running.values())
+        with self._lock:
+            return {
+                "budget_mb": self.budget_mb,
+                "device": self.device,
+                "rates_mb_per_mp": dict(self._rates),
+                "scale": self._scale,
+                "samples": self._samples,
+                "overlapped_skipped": self._skipped,
+                "running": running,
+                "reserved_mb": round(reserved),
+            }
@@ -0,0 +1,242 @@
+import hashlib
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+from metrics import metrics
+
+# SQLite file for generation records (empty = don't record)
+METADATA_DB_PATH = os.getenv("METADATA_DB_PATH", "generations.db")
+
+# The writer commits up to this many records per transaction, at least every flush interval
+METADATA_BATCH_SIZE = int(os.getenv("METADATA_BATCH_SIZE", "64"))
+METADATA_FLUSH_SECONDS = float(os.getenv("METADATA_FLUSH_SECONDS", "1.0"))
+
+# Records waiting for the writer beyond this are dropped (and counted) rather than blocking requests
+MAX_PENDING_RECORDS = 10000
+
+# Settings that don't change the rendered output, left out of the request hash
+UNHASHED_SETTINGS = ("reuseExisting", "profile")
+
+_COLUMNS = (
+    "id", "job_id", "endpoint", "input_hash", "request_hash", "user_id", "prompt", "settings", "seed",
+    "outputs", "input_width", "input_height", "timings", "stage_ms", "created_at",
+)
+_JSON_COLUMNS = ("settings", "outputs", "timings")
+
+
+def input_hash(image_bytes: bytes) -> str:
+    """sha256 of the uploaded image bytes"""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def hashed_settings(settings: Dict[str, Any]) -> Dict[str, Any]:
+    return {key: value for key, value in settings.items() if key not in UNHASHED_SETTINGS}
+
+
+class MetadataStore:
+    """Append-only record of completed generations in SQLite (WAL mode).
+
+    record() only queues the row; a background thread writes queued rows in
+    batched transactions, so requests never wait on the disk. Reads use their
+    own connection and see rows once the writer has committed them (within
+    about METADATA_FLUSH_SECONDS).
+    """
+
+    def __init__(self, path: str, batch_size: int = METADATA_BATCH_SIZE,
+                 flush_seconds: float = METADATA_FLUSH_SECONDS):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self._pending: "queue.Queue" = queue.Queue(maxsize=MAX_PENDING_RECORDS)
+        self._read_lock = threading.Lock()
+        self._written = 0
+        self._dropped = 0
+
+        self._reader = self._connect()
+        self._reader.execute("PRAGMA journal_mode=WAL")
+        self._reader.execute("""
+            CREATE TABLE IF NOT EXISTS generations (
+                id TEXT PRIMARY KEY,
+                job_id TEXT,
+                endpoint TEXT NOT NULL,
+                input_hash TEXT NOT NULL,
+                request_hash TEXT,
+                user_id TEXT,
+                prompt TEXT,
+                settings TEXT,
+                seed INTEGER,
+                outputs TEXT NOT NULL,
+                input_width INTEGER,
+                input_height INTEGER,
+                timings TEXT,
+                stage_ms INTEGER,
+                created_at REAL NOT NULL
+            )
+        """)
+        self._reader.execute("CREATE INDEX IF NOT EXISTS generations_job ON generations(job_id, created_at)")
+        self._reader.execute(
+            "CREATE INDEX IF NOT EXISTS generations_input ON generations(input_hash, created_at)"
+        )
+        self._reader.execute(
+            "CREATE INDEX IF NOT EXISTS generations_user ON generations(user_id, created_at)"
+        )
+        self._reader.execute("CREATE INDEX IF NOT EXISTS generations_created ON generations(created_at)")
+        self._reader.execute(
+            "CREATE INDEX IF NOT EXISTS generations_request ON generations(request_hash, created_at)"
+        )
+
+        self._writer = threading.Thread(target=self._write_loop, name="metadata-writer", daemon=True)
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def record(self, **fields) -> str:
+        """Queue one generation record; returns its new id.
+
+        Ids are always generated here: ``job_id`` may come from the client, so two
+        records can share one and neither replaces the other.
+        """
+        row = {column: fields.get(column) for column in _COLUMNS}
+        row["id"] = str(uuid.uuid4())
+        row["created_at"] = row["created_at"] or time.time()
+        for column in _JSON_COLUMNS:
+            if row[column] is not None:
+                row[column] = json.dumps(row[column], separators=(",", ":"))
+        try:
+            self._pending.put_nowait(row)
+        except queue.Full:
+            self._dropped += 1
+            metrics.incr("metadata_records_dropped")
+        return row["id"]
+
+    def _write_loop(self):
+        conn = self._connect()
+        placeholders = ", ".join("?" for _ in _COLUMNS)
+        insert = f"INSERT INTO generations ({', '.join(_COLUMNS)}) VALUES ({placeholders})"
+        while True:
+            batch = [self._pending.get()]
+            deadline = time.monotonic() + self.flush_seconds
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            rows = [row for row in batch if row is not None]
+            if rows:
+                try:
+                    conn.execute("BEGIN")
+                    conn.executemany(insert, [tuple(row[column] for column in _COLUMNS) for row in rows])
+                    conn.execute("COMMIT")
+                    self._written += len(rows)
+                except Exception as e:
+                    # Drop the batch but keep the writer alive for the next one
+                    self._rollback(conn)
+                    self._dropped += len(rows)
+                    metrics.incr("metadata_records_dropped", len(rows))
+                    print(f"Metadata store: failed to write {len(rows)} records ({e})")
+            for _ in batch:
+                self._pending.task_done()
+            if None in batch:
+                conn.close()
+                return
+
+    @staticmethod
+    def _rollback(conn: sqlite3.Connection):
+        if not conn.in_transaction:
+            return
+        try:
+            conn.execute("ROLLBACK")
+        except sqlite3.Error as e:
+            print(f"Metadata store: rollback failed ({e})")
+
+    def flush(self):
+        """Block until every record queued so far is written"""
+        self._pending.join()
+
+    def close(self, timeout: float = 10):
+        """Write what is queued and stop the writer (gives up after ``timeout`` seconds)"""
+        try:
+            self._pending.put(None, timeout=timeout)
+        except queue.Full:
+            print("Metadata store: writer backlog full, closing without flushing")
+            return
+        self._writer.join(timeout=timeout)
+
+    def _rows(self, sql: str, params: tuple) -> List[Dict[str, Any]]:
+        with self._read_lock:
+            rows = self._reader.execute(sql, params).fetchall()
+        records = []
+        for row in rows:
+            record = dict(row)
+            for column in _JSON_COLUMNS:
+                if record[column] is not None:
+                    record[column] = json.loads(record[column])
+            records.append(record)
+        return records
+
+    def get(self, generation_id: str) -> Optional[Dict[str, Any]]:
+        rows = self._rows("SELECT * FROM generations WHERE id = ?", (generation_id,))
+        return rows[0] if rows else None
+
+    def find(
+        self,
+        input_hash: Optional[str] = None,
+        user_id: Optional[str] = None,
+        request_hash: Optional[str] = None,
+        job_id: Optional[str] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        limit: int = 50
+    ) -> List[Dict[str, Any]]:
+        """Records matching every given filter, newest first"""
+        conditions, params = [], []
+        filters = (("input_hash", input_hash), ("user_id", user_id), ("request_hash", request_hash), ("job_id", job_id))
+        for column, value in filters:
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if since is not None:
+            conditions.append("created_at >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("created_at < ?")
+            params.append(until)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        params.append(max(1, min(int(limit), 500)))
+        return self._rows(f"SELECT * FROM generations {where} ORDER BY created_at DESC LIMIT ?", tuple(params))
+
+    def latest(self, request_hash: str) -> Optional[Dict[str, Any]]:
+        """Most recent render of an identical request, if any"""
+        rows = self.find(request_hash=request_hash, limit=1)
+        return rows[0] if rows else None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._read_lock:
+            stored = self._reader.execute("SELECT COUNT(*) FROM generations").fetchone()[0]
+        return {
+            "path": self.path,
+            "stored": stored,
+            "pending": self._pending.qsize(),
+            "written": self._written,
+            "dropped": self._dropped,
+        }
+
+
+def open_metadata_store(path: Optional[str] = METADATA_DB_PATH) -> Optional[MetadataStore]:
+    """The store at ``path``, or None when recording is disabled"""
+    if not path:
+        return None
+    return MetadataStore(path)
@@ -0,0 +1,26 @@
+import threading
+from collections import defaultdict
+from typing import Dict, Any
+
+class Metrics:
+    """Thread-safe in-process counters and gauges reported by the /metrics endpoint"""
+
+    def __init__(self):
+        self._counters: Dict[str, float] = defaultdict(float)
+        self._gauges: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name: str, amount: float = 1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def set_gauge(self, name: str, value: float):
+        with self._lock:
+            self._gauges[name] = value
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"counters": dict(self._counters), "gauges": dict(self._gauges)}
+
+# Process-wide metrics
+metrics = Metrics()
@@ -1,16 +1,31 @@
+import os
+import time
 import torch
-from diffusers import StableDiffusionControlNetPipeline, ControlNetModel, UniPCMultistepScheduler
-from transformers import pipeline as transformers_pipeline
+from diffusers import (
+    StableDiffusionControlNetPipeline, StableDiffusionControlNetInpaintPipeline, ControlNetModel,
+    UniPCMultistepScheduler, LCMScheduler
+)
+
+from autotune import load_config, apply_threads, ensure_tuned
+from depth_backends import load_depth_backend
+from model_pool import ModelPool, CONTROLNET_MODELS, CONTROLNET_PATHS
 
 # Check if CUDA is available
 device = "cuda" if torch.cuda.is_available() else "cpu"
 print(f"Using device: {device}")
 
+# Thread pools from a previous autotune run must be set before the models do any work
+tuned_config = load_config(device)
+if tuned_config is not None:
+    apply_threads(tuned_config)
+
 # Load ControlNet (depth)
+_controlnet_started = time.perf_counter()
 controlnet = ControlNetModel.from_pretrained(
-    "lllyasviel/sd-controlnet-depth", 
+    CONTROLNET_PATHS["depth"] or CONTROLNET_MODELS["depth"],
     torch_dtype=torch.float16 if device == "cuda" else torch.float32
 )
+controlnet_load_seconds = time.perf_counter() - _controlnet_started
 
 pipe = StableDiffusionControlNetPipeline.from_pretrained(
     "runwayml/stable-diffusion-v1-5",
@@ -33,20 +48,61 @@ if hasattr(pipe, 'text_encoder'):
 if device == "cuda":
     pipe.enable_model_cpu_offload()
 else:
-    # For CPU, move the model to CPU and use optimizations
     pipe = pipe.to(device)
-    # Use memory efficient attention for CPU
-    pipe.enable_attention_slicing()
-    # Use memory efficient xformers if available
-    try:
-        pipe.enable_xformers_memory_efficient_attention()
-        print("Using xformers memory efficient attention")
-    except:
-        print("xformers not available, using standard attention")
-    print("Running on CPU - optimized for speed")
-
-# Depth Estimator
-depth_estimator = transformers_pipeline("depth-estimation", device=device)
+    print("Running on CPU")
+
+# Attention implementation and thread counts measured on this host (see autotune.py)
+tuned_config = ensure_tuned(pipe, device, tuned_config)
+
+# Depth Estimator (DEPTH_BACKEND=small|large, see depth_backends.py)
+depth_estimator = load_depth_backend(device=device)
+
+# Other ControlNets (canny, mlsd, seg) load on demand next to the pinned depth one (see model_pool.py)
+model_pool = ModelPool(
+    pipe, depth_estimator, device,
+    attention=tuned_config["attention"] if tuned_config else None,
+    base_load_seconds=controlnet_load_seconds
+)
+
+# Draft tier: optional consistency LoRA (e.g. a local copy of latent-consistency/lcm-lora-sdv1-5)
+DRAFT_LORA_PATH = os.getenv("DRAFT_LORA_PATH")
+DRAFT_ADAPTER = "draft"
+_draft_pipe = None
+_inpaint_pipe = None
 
 def get_models():
     return pipe, depth_estimator
+
+def get_draft_pipe():
+    """Return the pipeline used for draft renders, building it on first use.
+
+    With DRAFT_LORA_PATH set, this is a second pipeline object sharing the base UNet, VAE and
+    text encoder, paired with LCMScheduler and the LoRA loaded as a disabled adapter (it is
+    switched on only for the duration of a draft call). Otherwise drafts run on the base
+    pipeline with a shorter UniPC schedule.
+    """
+    global _draft_pipe
+    if _draft_pipe is not None:
+        return _draft_pipe
+
+    if DRAFT_LORA_PATH and os.path.exists(DRAFT_LORA_PATH):
+        draft_pipe = StableDiffusionControlNetPipeline(**pipe.components)
+        draft_pipe.scheduler = LCMScheduler.from_config(pipe.scheduler.config)
+        draft_pipe.load_lora_weights(DRAFT_LORA_PATH, adapter_name=DRAFT_ADAPTER)
+        draft_pipe.disable_lora()
+        draft_pipe.draft_adapter = DRAFT_ADAPTER
+        print(f"Draft tier using consistency LoRA from {DRAFT_LORA_PATH}")
+    else:
+        draft_pipe = pipe
+        print("Draft tier using few-step UniPC schedule")
+
+    _draft_pipe = draft_pipe
+    return _draft_pipe
+
+def get_inpaint_pipe():
+    """Return the depth-conditioned inpainting pipeline used for masked regional redesign,
+    building it on first use. It shares every component with the base pipeline."""
+    global _inpaint_pipe
+    if _inpaint_pipe is None:
+        _inpaint_pipe = StableDiffusionControlNetInpaintPipeline(**pipe.components)
+    return _inpaint_pipe
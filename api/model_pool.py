@@ -0,0 +1,325 @@
+import gc
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+from diffusers import StableDiffusionControlNetPipeline, ControlNetModel
+
+from ade_palette import ADE_PALETTE
+
+# SD1.5 ControlNet per conditioning type; CONTROLNET_PATH_<TYPE> points at a local copy
+CONTROLNET_MODELS = {
+    "depth": "lllyasviel/sd-controlnet-depth",
+    "canny": "lllyasviel/sd-controlnet-canny",
+    "mlsd": "lllyasviel/sd-controlnet-mlsd",
+    "seg": "lllyasviel/sd-controlnet-seg",
+}
+CONTROLNET_PATHS = {name: os.getenv(f"CONTROLNET_PATH_{name.upper()}") for name in CONTROLNET_MODELS}
+DEFAULT_CONDITIONING = "depth"
+
+# Annotator weights: MLSD line detector and the UperNet ADE20K segmenter
+ANNOTATORS_PATH = os.getenv("ANNOTATORS_PATH", "lllyasviel/Annotators")
+SEG_MODEL_PATH = os.getenv("SEG_MODEL_PATH", "openmmlab/upernet-convnext-small")
+
+# Memory for resident ControlNets plus their annotators, depth included (0 = no cap).
+# Least recently used variants are evicted to stay under it; depth is never evicted.
+CONTROLNET_POOL_MB = float(os.getenv("CONTROLNET_POOL_MB", "4000"))
+
+MB = 1024 * 1024
+
+
+def module_mb(module) -> float:
+    """Parameter and buffer memory of a torch module"""
+    if module is None:
+        return 0.0
+    tensors = list(module.parameters()) + list(module.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors) / MB
+
+
+def conditioning_for(settings: Dict[str, Any]) -> str:
+    """Conditioning type requested by ``conditioning``; raises ValueError if unknown"""
+    name = str(settings.get('conditioning') or DEFAULT_CONDITIONING).lower()
+    if name not in CONTROLNET_MODELS:
+        raise ValueError(f"Unknown conditioning {name!r}; choose from {', '.join(CONTROLNET_MODELS)}")
+    return name
+
+
+def _resized(image, size, resample=Image.Resampling.NEAREST) -> np.ndarray:
+    """Annotator output as a uint8 array at exactly ``size``"""
+    if not isinstance(image, Image.Image):
+        image = Image.fromarray(np.asarray(image).astype(np.uint8))
+    if image.size != size:
+        image = image.resize(size, resample)
+    return np.array(image)
+
+
+class CannyAnnotator:
+    """Canny edge map (what controlnet_aux's CannyDetector computes), no weights to load.
+
+    Annotators share the depth backend's interface: ``estimate`` returns one uint8
+    array per image at that image's size. ``equalize = False`` tells
+    generate_depth_map not to histogram-equalize the result.
+    """
+    equalize = False
+
+    def __init__(self, device: str, dtype, low_threshold: int = 100, high_threshold: int = 200):
+        self.low_threshold = low_threshold
+        self.high_threshold = high_threshold
+
+    def estimate(self, images: List[Image.Image]) -> List[np.ndarray]:
+        return [
+            cv2.Canny(np.array(image.convert("RGB")), self.low_threshold, self.high_threshold)
+            for image in images
+        ]
+
+    def size_mb(self) -> float:
+        return 0.0
+
+
+class MLSDAnnotator:
+    """Straight-line map from controlnet_aux's M-LSD detector (good for walls, windows, furniture edges)"""
+    equalize = False
+
+    def __init__(self, device: str, dtype):
+        from controlnet_aux import MLSDdetector
+        self.detector = MLSDdetector.from_pretrained(ANNOTATORS_PATH)
+        if hasattr(self.detector, "to"):
+            self.detector.to(device)
+
+    def estimate(self, images: List[Image.Image]) -> List[np.ndarray]:
+        results = []
+        for image in images:
+            lines = self.detector(
+                image.convert("RGB"), thr_v=0.1, thr_d=0.1,
+                detect_resolution=max(image.size), image_resolution=max(image.size)
+            )
+            results.append(_resized(lines, image.size))
+        return results
+
+    def size_mb(self) -> float:
+        return module_mb(getattr(self.detector, "model", None))
+
+
+class SegAnnotator:
+    """ADE20K semantic segmentation (UperNet) drawn in the palette sd-controlnet-seg was trained on"""
+    equalize = False
+
+    def __init__(self, device: str, dtype):
+        from transformers import AutoImageProcessor, UperNetForSemanticSegmentation
+        self.device = device
+        self.dtype = dtype
+        self.processor = AutoImageProcessor.from_pretrained(SEG_MODEL_PATH)
+        self.model = UperNetForSemanticSegmentation.from_pretrained(SEG_MODEL_PATH, torch_dtype=dtype)
+        self.model.to(device).eval()
+        self.palette = np.array(ADE_PALETTE, dtype=np.uint8)
+
+    @torch.no_grad()
+    def estimate(self, images: List[Image.Image]) -> List[np.ndarray]:
+        # The processor resizes every image to the same input size, so one batch covers all
+        inputs = self.processor(images=[image.convert("RGB") for image in images], return_tensors="pt")
+        outputs = self.model(pixel_values=inputs["pixel_values"].to(self.device, self.dtype))
+        labels = self.processor.post_process_semantic_segmentation(
+            outputs, target_sizes=[(image.height, image.width) for image in images]
+        )
+        return [self.palette[label.cpu().numpy()] for label in labels]
+
+    def size_mb(self) -> float:
+        return module_mb(self.model)
+
+
+ANNOTATORS = {
+    "canny": CannyAnnotator,
+    "mlsd": MLSDAnnotator,
+    "seg": SegAnnotator,
+}
+
+
+class ControlNetVariant:
+    """One conditioning type: its ControlNet, a pipeline sharing the base UNet/VAE/text
+    encoder, and the annotator that turns a photo into its conditioning image"""
+
+    def __init__(self, name: str, pipe, annotator, load_seconds: float, size_mb: float, pinned: bool = False):
+        self.name = name
+        self.pipe = pipe
+        self.annotator = annotator
+        self.load_seconds = load_seconds
+        self.size_mb = size_mb
+        self.pinned = pinned
+        self.loaded_at = time.time()
+        self.last_used = self.loaded_at
+        self.uses = 0
+        self.active = 0
+        self._draft_pipe = None
+
+    def draft_pipe(self, draft):
+        """This variant's pipeline with the draft tier's scheduler and LoRA adapter (see
+        model_loader.get_draft_pipe), built on first use. The LoRA lives in the shared UNet,
+        so the copy only needs the adapter name."""
+        if self._draft_pipe is None:
+            pipe = type(self.pipe)(**self.pipe.components)
+            pipe.scheduler = type(draft.scheduler).from_config(draft.scheduler.config)
+            pipe.draft_adapter = draft.draft_adapter
+            self._draft_pipe = pipe
+        return self._draft_pipe
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            "resident": True,
+            "pinned": self.pinned,
+            "size_mb": round(self.size_mb),
+            "load_seconds": round(self.load_seconds, 2),
+            "uses": self.uses,
+            "active": self.active,
+            "idle_seconds": round(time.time() - self.last_used, 1),
+        }
+
+
+class ModelPool:
+    """ControlNet variants loaded on demand around one shared base pipeline.
+
+    The depth variant is the base pipeline itself and stays pinned. Other variants
+    are loaded the first time a request asks for them and evicted least recently
+    used first once the pool exceeds ``cap_mb``; a variant serving a request is
+    never evicted under it.
+    """
+
+    def __init__(self, base_pipe, depth_estimator, device: str, attention: Optional[str] = None,
+                 base_load_seconds: float = 0.0, cap_mb: float = CONTROLNET_POOL_MB):
+        self.base_pipe = base_pipe
+        self.device = device
+        self.dtype = torch.float16 if device == "cuda" else torch.float32
+        self.attention = attention
+        self.cap_mb = cap_mb or None
+        self._variants: "OrderedDict[str, ControlNetVariant]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        # Per type: loads, evictions and the last measured load time and size, kept across evictions
+        self._history: Dict[str, Dict[str, Any]] = {name: {"loads": 0, "evictions": 0} for name in CONTROLNET_MODELS}
+
+        depth = ControlNetVariant(
+            DEFAULT_CONDITIONING, base_pipe, depth_estimator,
+            load_seconds=base_load_seconds + getattr(depth_estimator, "load_seconds", 0.0),
+            size_mb=module_mb(base_pipe.controlnet) + module_mb(getattr(depth_estimator, "model", None)),
+            pinned=True
+        )
+        self._variants[DEFAULT_CONDITIONING] = depth
+        self._remember(depth)
+
+    def _remember(self, variant: ControlNetVariant):
+        history = self._history[variant.name]
+        history["loads"] += 1
+        history["load_seconds"] = round(variant.load_seconds, 2)
+        history["size_mb"] = round(variant.size_mb)
+
+    def resident_mb(self) -> float:
+        return sum(variant.size_mb for variant in self._variants.values())
+
+    def _claim(self, variant: ControlNetVariant) -> ControlNetVariant:
+        self._variants.move_to_end(variant.name)
+        variant.last_used = time.time()
+        variant.uses += 1
+        variant.active += 1
+        return variant
+
+    def _evict(self, incoming_mb: float = 0.0):
+        """Drop idle, unpinned variants, least recently used first, until incoming_mb fits under the cap"""
+        if self.cap_mb is None:
+            return
+        for name in list(self._variants):
+            if self.resident_mb() + incoming_mb <= self.cap_mb:
+                return
+            variant = self._variants[name]
+            if variant.pinned or variant.active:
+                continue
+            del self._variants[name]
+            self._history[name]["evictions"] += 1
+            print(f"ControlNet pool: evicted {name} ({variant.size_mb:.0f} MB, idle "
+                  f"{time.time() - variant.last_used:.0f}s)")
+        if self.resident_mb() + incoming_mb > self.cap_mb:
+            print(f"ControlNet pool: {self.resident_mb() + incoming_mb:.0f} MB in use, over the "
+                  f"{self.cap_mb:.0f} MB cap (remaining variants are pinned or busy)")
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def _load(self, name: str) -> ControlNetVariant:
+        started = time.perf_counter()
+        model_id = CONTROLNET_PATHS[name] or CONTROLNET_MODELS[name]
+        controlnet = ControlNetModel.from_pretrained(model_id, torch_dtype=self.dtype)
+        controlnet.to(self.device).eval()
+
+        # Same UNet, VAE and text encoder as the base pipeline; own scheduler instance
+        components = {**self.base_pipe.components, "controlnet": controlnet}
+        components["scheduler"] = type(self.base_pipe.scheduler).from_config(self.base_pipe.scheduler.config)
+        pipe = StableDiffusionControlNetPipeline(**components)
+        if self.attention:
+            from autotune import apply_attention
+            apply_attention(pipe, self.attention)
+
+        annotator = ANNOTATORS[name](self.device, self.dtype)
+        load_seconds = time.perf_counter() - started
+        size_mb = module_mb(controlnet) + annotator.size_mb()
+        print(f"ControlNet pool: loaded {name} ({model_id}, {size_mb:.0f} MB) in {load_seconds:.1f}s")
+        return ControlNetVariant(name, pipe, annotator, load_seconds, size_mb)
+
+    def _get(self, name: str) -> ControlNetVariant:
+        with self._lock:
+            if name in self._variants:
+                return self._claim(self._variants[name])
+
+        # One load at a time; requests for resident variants don't wait on it
+        with self._load_lock:
+            with self._lock:
+                if name in self._variants:
+                    return self._claim(self._variants[name])
+                self._evict(self._history[name].get("size_mb", 0.0))
+            variant = self._load(name)
+            with self._lock:
+                self._variants[name] = variant
+                self._remember(variant)
+                self._claim(variant)
+                self._evict()
+            return variant
+
+    @contextmanager
+    def acquire(self, name: str):
+        """The variant for a conditioning type, loaded if needed and held resident for the block"""
+        if name not in CONTROLNET_MODELS:
+            raise ValueError(f"Unknown conditioning {name!r}; choose from {', '.join(CONTROLNET_MODELS)}")
+        variant = self._get(name)
+        try:
+            yield variant
+        finally:
+            with self._lock:
+                variant.active -= 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            variants = {}
+            for name, model_id in CONTROLNET_MODELS.items():
+                history = self._history[name]
+                variant = self._variants.get(name)
+                entry = variant.describe() if variant is not None else {
+                    "resident": False,
+                    "size_mb": history.get("size_mb"),
+                    "load_seconds": history.get("load_seconds"),
+                }
+                variants[name] = {
+                    "model": CONTROLNET_PATHS[name] or model_id,
+                    **entry,
+                    "loads": history["loads"],
+                    "evictions": history["evictions"],
+                }
+            return {
+                "cap_mb": self.cap_mb,
+                "resident_mb": round(self.resident_mb()),
+                "lru_order": list(self._variants),
+                "variants": variants,
+            }
@@ -0,0 +1,100 @@
+import os
+import re
+import threading
+import time
+from typing import Dict, Any, Optional
+
+import torch
+from torch.profiler import profile, ProfilerActivity
+
+from stages import annotate_stages
+
+# Chrome-trace files are written here, one per profiled job
+PROFILE_DIR = os.getenv("PROFILE_DIR", "traces")
+
+# Profiling is expensive; at most this many profiled requests per minute
+PROFILE_RATE_PER_MINUTE = float(os.getenv("PROFILE_RATE_PER_MINUTE", "2"))
+
+# Oldest traces are deleted once the directory holds more than this many (0 = keep all)
+PROFILE_MAX_TRACES = int(os.getenv("PROFILE_MAX_TRACES", "50"))
+
+# Record Python call stacks in traces
+PROFILE_WITH_STACK = os.getenv("PROFILE_WITH_STACK", "1") == "1"
+
+_JOB_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$")
+
+class RateLimiter:
+    """Token bucket allowing rate_per_minute events with bursts of up to burst"""
+
+    def __init__(self, rate_per_minute: float, burst: int = 1):
+        self._rate = rate_per_minute / 60.0
+        self._burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+_limiter = RateLimiter(PROFILE_RATE_PER_MINUTE)
+
+def profiling_requested(headers, settings: Dict[str, Any]) -> bool:
+    """Whether a request opted in via the X-Profile header or the 'profile' setting"""
+    return headers.get("x-profile", "").lower() in ("1", "true", "yes") or bool(settings.get('profile', False))
+
+def acquire_profile_slot() -> bool:
+    """Take a slot from the profiling rate limit"""
+    return _limiter.allow()
+
+def trace_path(job_id: str) -> Optional[str]:
+    """Path of a job's trace file (None for ids that aren't safe file names)"""
+    if not _JOB_ID_PATTERN.match(job_id):
+        return None
+    return os.path.join(PROFILE_DIR, f"{job_id}.json")
+
+def trace_written(job_id: str) -> bool:
+    """Whether a trace file exists for job_id"""
+    path = trace_path(job_id)
+    return path is not None and os.path.isfile(path)
+
+def prune_traces(keep: int = PROFILE_MAX_TRACES):
+    """Delete the oldest trace files beyond the newest ``keep``"""
+    if keep <= 0:
+        return
+    try:
+        traces = [entry for entry in os.scandir(PROFILE_DIR) if entry.name.endswith(".json")]
+        traces.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    except OSError:
+        return
+    for entry in traces[keep:]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+
+def run_profiled(job_id: str, fn, *args, **kwargs):
+    """Run fn under the torch profiler and write a Chrome trace for job_id.
+
+    Pipeline stages (see stages.py) show up as "stage:<name>" ranges in the trace.
+    """
+    activities = [ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    annotate_stages(True)
+    try:
+        with profile(activities=activities, with_stack=PROFILE_WITH_STACK) as prof:
+            result = fn(*args, **kwargs)
+    finally:
+        annotate_stages(False)
+    prof.export_chrome_trace(trace_path(job_id))
+    prune_traces()
+    return result
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Worker node for distributed mode.
+
+Leases jobs from the shared queue, renders them and writes results back. Leases
+are kept alive from a heartbeat thread; if one is lost (the job was handed to
+another worker) the render is cancelled at the next denoising step. A job is only
+leased once the previous render is done, so no lease sits idle behind a busy
+worker; finished images are uploaded in background threads while the next job
+renders.
+
+Usage:
+
+    python queue_worker.py --queue sqlite:///shared/queue.db --worker-id node-a
+"""
+
+import argparse
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import Dict, Any, Optional
+
+from PIL import Image
+
+from job_queue import open_queue, JobQueue
+from jobs import Job, GenerationCancelled
+from stages import stage, STAGE_UPLOAD
+
+class QueueWorker:
+    def __init__(self, queue: JobQueue, worker_id: str, pipe, depth_estimator, poll_seconds: float = 1.0,
+                 model_pool=None):
+        self.queue = queue
+        self.worker_id = worker_id
+        self.pipe = pipe
+        self.depth_estimator = depth_estimator
+        self.model_pool = model_pool
+        self.poll_seconds = poll_seconds
+        self._held: Dict[str, Job] = {}
+        self._held_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._uploader = ThreadPoolExecutor(max_workers=2)
+
+    def _lease_next(self) -> Optional[Dict[str, Any]]:
+        """Lease a job and decode its input"""
+        leased = self.queue.lease(self.worker_id)
+        if leased is None:
+            return None
+        job = Job(leased["id"])
+        with self._held_lock:
+            self._held[job.job_id] = job
+        leased["job"] = job
+        try:
+            leased["input_image"] = Image.open(BytesIO(leased.pop("image"))).convert("RGB")
+        except Exception as e:
+            self._release(job)
+            self._fail(job, f"Invalid input image: {e}")
+            return None
+        return leased
+
+    def _release(self, job: Job):
+        with self._held_lock:
+            self._held.pop(job.job_id, None)
+
+    def _fail(self, job: Job, error: str):
+        """Mark a job failed; if the queue can't be reached the lease expires and the job is retried"""
+        try:
+            self.queue.fail(job.job_id, self.worker_id, error)
+        except Exception as e:
+            print(f"Could not mark {job.job_id} failed ({e}); it will be retried when its lease expires")
+
+    def _heartbeat_loop(self):
+        interval = max(1.0, self.queue.lease_seconds / 3)
+        while not self._stop.wait(interval):
+            with self._held_lock:
+                held = list(self._held.values())
+            for job in held:
+                try:
+                    held_lease = self.queue.heartbeat(job.job_id, self.worker_id)
+                except Exception as e:
+                    # Try again next interval; the lease may still be valid
+                    print(f"Heartbeat for {job.job_id} failed ({e})")
+                    continue
+                if not held_lease:
+                    print(f"Lost lease on {job.job_id}, cancelling")
+                    job.cancel()
+
+    def _finish(self, leased: Dict[str, Any], output: Image.Image, timings: Dict[str, float]):
+        """Upload a result and mark the job done (runs on an upload thread)"""
+        from storage import upload_image_return_url
+
+        job = leased["job"]
+        try:
+            with stage(timings, STAGE_UPLOAD):
+                url = upload_image_return_url(output, f"{job.job_id}.png")
+            self.queue.complete(job.job_id, self.worker_id, {
+                "output": [url, url],
+                "settings_used": leased["settings"],
+                "timings": timings
+            })
+        except Exception as e:
+            self._fail(job, str(e))
+        finally:
+            self._release(job)
+
+    def _pipe_for(self, settings: Dict[str, Any], variant=None):
+        """Pipeline for the job's quality tier (as app._pipe_for) on its ControlNet variant"""
+        from enhanced_generate import is_draft
+        from model_loader import get_draft_pipe
+
+        target = get_draft_pipe() if is_draft(settings) else self.pipe
+        if variant is None or variant.pipe is self.pipe:
+            return target
+        if getattr(target, 'draft_adapter', None) is not None:
+            return variant.draft_pipe(target)
+        return variant.pipe
+
+    def _render(self, leased: Dict[str, Any]):
+        from enhanced_generate import generate_image_advanced
+        from model_pool import conditioning_for
+
+        job = leased["job"]
+        settings = leased["settings"]
+        timings: Dict[str, float] = {}
+        started = time.perf_counter()
+        try:
+            if self.model_pool is not None:
+                # Non-depth conditioning runs on its ControlNet variant, loaded on demand
+                with self.model_pool.acquire(conditioning_for(settings)) as variant:
+                    output = generate_image_advanced(
+                        leased["prompt"], leased["input_image"], self._pipe_for(settings, variant),
+                        variant.annotator, settings, timings=timings, job=job
+                    )
+            else:
+                output = generate_image_advanced(
+                    leased["prompt"], leased["input_image"], self._pipe_for(settings), self.depth_estimator,
+                    settings, timings=timings, job=job
+                )
+        except GenerationCancelled:
+            # Lease lost: another worker owns the job now
+            self._release(job)
+            return
+        except Exception as e:
+            self._fail(job, str(e))
+            self._release(job)
+            return
+        print(f"Rendered {job.job_id} in {time.perf_counter() - started:.1f}s")
+        self._uploader.submit(self._finish, leased, output, timings)
+
+    def run(self):
+        heartbeat = threading.Thread(target=self._heartbeat_loop, daemon=True)
+        heartbeat.start()
+        print(f"Worker {self.worker_id} polling for jobs")
+        try:
+            while not self._stop.is_set():
+                try:
+                    leased = self._lease_next()
+                except Exception as e:
+                    # Queue unreachable or locked: keep polling rather than taking the worker down
+                    print(f"Lease failed ({e}), retrying in {self.poll_seconds:.0f}s")
+                    leased = None
+                if leased is None:
+                    self._stop.wait(self.poll_seconds)
+                    continue
+                self._render(leased)
+        finally:
+            self._stop.set()
+            self._uploader.shutdown(wait=True)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render jobs from the shared queue")
+    parser.add_argument("--queue", required=True, help="queue URL, e.g. sqlite:///shared/queue.db")
+    parser.add_argument("--worker-id", default=f"{socket.gethostname()}-{uuid.uuid4().hex[:6]}")
+    parser.add_argument("--lease-seconds", type=float, default=60)
+    parser.add_argument("--poll-seconds", type=float, default=1.0)
+    args = parser.parse_args(argv)
+
+    from model_loader import get_models, model_pool
+    pipe, depth_estimator = get_models()
+
+    queue = open_queue(args.queue, lease_seconds=args.lease_seconds)
+    QueueWorker(queue, args.worker_id, pipe, depth_estimator, args.poll_seconds, model_pool=model_pool).run()
+
+if __name__ == "__main__":
+    main()
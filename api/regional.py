@@ -0,0 +1,188 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+import torch
+from PIL import Image, ImageFilter
+
+from buckets import fit_to_bucket, crop_to_content
+from stages import stage, STAGE_PREPROCESS, STAGE_DENOISE, STAGE_DECODE, STAGE_POSTPROCESS
+from jobs import GenerationCancelled
+from metrics import metrics
+from inference_executor import adapter_gate
+from enhanced_generate import (
+    generate_depth_map, enhance_prompt_advanced, decode_latents, release_pipeline_resources, working_max_size
+)
+
+# Full-frame depth maps by input image hash, so repeated edits of one photo skip depth estimation
+DEPTH_CACHE_SIZE = int(os.getenv("DEPTH_CACHE_SIZE", "16"))
+
+# Smallest longest side a region is rendered at; below this SD1.5 loses too much detail
+MIN_REGION_SIZE = 256
+
+NEGATIVE_PROMPT = "dark, dim, poorly lit, low quality, blurry, distorted, deformed, seams, visible border"
+
+
+class EmptyMaskError(ValueError):
+    """The mask selects no pixels, so there is no region to render"""
+
+
+_depth_cache: "OrderedDict[str, Image.Image]" = OrderedDict()
+_depth_lock = threading.Lock()
+
+
+def image_hash(image: Image.Image) -> str:
+    digest = hashlib.sha256(f"{image.mode}:{image.width}x{image.height}:".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def full_frame_depth(image: Image.Image, depth_estimator, max_size: int,
+                     timings: Optional[Dict[str, float]] = None) -> Image.Image:
+    """Depth of the whole photo at working resolution (without bucket padding), cached by image"""
+    key = f"{image_hash(image)}:{max_size}"
+    with _depth_lock:
+        depth = _depth_cache.get(key)
+        if depth is not None:
+            _depth_cache.move_to_end(key)
+            metrics.incr("depth_cache_hits")
+            return depth
+
+    depth, placement = generate_depth_map(image, depth_estimator, max_size=max_size, timings=timings)
+    depth = crop_to_content(depth, placement)
+    with _depth_lock:
+        _depth_cache[key] = depth
+        while len(_depth_cache) > DEPTH_CACHE_SIZE:
+            _depth_cache.popitem(last=False)
+    return depth
+
+
+def binarize_mask(mask: Image.Image, size: Tuple[int, int]) -> Image.Image:
+    """Mask as L-mode 0/255 at the image size (white = region to redesign)"""
+    mask = mask.convert("L")
+    if mask.size != size:
+        mask = mask.resize(size, Image.Resampling.NEAREST)
+    return mask.point(lambda value: 255 if value > 127 else 0)
+
+
+def region_box(mask: Image.Image, margin: float = 0.15) -> Optional[Tuple[int, int, int, int]]:
+    """Bounding box of the mask grown by ``margin`` of its longest side (at least 16 px), or None if empty"""
+    bbox = mask.getbbox()
+    if bbox is None:
+        return None
+    left, top, right, bottom = bbox
+    pad = max(16, int(max(right - left, bottom - top) * margin))
+    return (
+        max(0, left - pad), max(0, top - pad),
+        min(mask.width, right + pad), min(mask.height, bottom + pad)
+    )
+
+
+def region_working_size(box: Tuple[int, int, int, int], image_size: Tuple[int, int], max_size: int) -> int:
+    """Longest working side for a region: the same pixel density a full-frame render would use"""
+    crop_long = max(box[2] - box[0], box[3] - box[1])
+    scaled = round(max_size * crop_long / max(image_size))
+    return min(max_size, max(MIN_REGION_SIZE, (scaled // 8) * 8))
+
+
+def generate_masked_region(
+    prompt: str,
+    image: Image.Image,
+    mask: Image.Image,
+    pipe,
+    depth_estimator,
+    settings: Dict[str, Any],
+    timings: Optional[Dict[str, float]] = None,
+    job=None
+) -> Tuple[Image.Image, Dict[str, Any]]:
+    """Redesign only the masked region of a photo.
+
+    ``pipe`` is the ControlNet inpainting pipeline (model_loader.get_inpaint_pipe). The
+    crop around the mask is rendered at the pixel density of a full-frame render, so
+    cost follows the edited area, and blended back into the original with a feathered
+    mask; pixels outside the crop are returned unchanged. Returns the image and a
+    report of the region that was rendered.
+    """
+    if job is not None:
+        job.check()
+
+    image = image.convert("RGB")
+    max_size = working_max_size(settings)
+
+    with stage(timings, STAGE_PREPROCESS):
+        mask = binarize_mask(mask, image.size)
+        box = region_box(mask, float(settings.get('maskMargin', 0.15)))
+        if box is None:
+            raise EmptyMaskError("Mask is empty")
+        region_long = region_working_size(box, image.size, max_size)
+        crop = image.crop(box)
+        crop_mask = mask.crop(box)
+        crop_input, placement = fit_to_bucket(crop, region_long)
+        mask_input, _ = fit_to_bucket(crop_mask, region_long)
+
+    # Full-frame depth is computed once per photo; the region's depth is cut from it
+    depth = full_frame_depth(image, depth_estimator, max_size, timings)
+    with stage(timings, STAGE_PREPROCESS):
+        scale_x, scale_y = depth.width / image.width, depth.height / image.height
+        depth_box = (
+            round(box[0] * scale_x), round(box[1] * scale_y),
+            max(round(box[2] * scale_x), round(box[0] * scale_x) + 1),
+            max(round(box[3] * scale_y), round(box[1] * scale_y) + 1),
+        )
+        depth_crop = depth.crop(depth_box).resize(crop.size, Image.Resampling.BICUBIC)
+        depth_input, _ = fit_to_bucket(depth_crop, region_long)
+        depth_input = depth_input.convert("RGB")
+
+    width, height = placement.bucket
+    metrics.incr(f"region_{width}x{height}")
+
+    generation_params = {
+        "prompt": enhance_prompt_advanced(prompt, settings),
+        "negative_prompt": NEGATIVE_PROMPT,
+        "image": crop_input,
+        "mask_image": mask_input,
+        "control_image": depth_input,
+        "width": width,
+        "height": height,
+        "num_inference_steps": settings.get('steps', 20),
+        "guidance_scale": settings.get('guidanceScale', 7.5),
+        "strength": settings.get('strength', 1.0),
+        "num_images_per_prompt": 1,
+    }
+    if settings.get('seed', 0) > 0:
+        generation_params["generator"] = torch.Generator().manual_seed(settings['seed'])
+    if job is not None:
+        job.check()
+        job.total_steps = generation_params["num_inference_steps"]
+        generation_params["callback_on_step_end"] = job.step_callback
+
+    print(f"Redesigning region {box} of {image.size} at {width}x{height}")
+    try:
+        with stage(timings, STAGE_DENOISE), adapter_gate.shared():
+            latents = pipe(**generation_params, output_type="latent").images
+    except GenerationCancelled:
+        release_pipeline_resources(pipe)
+        raise
+
+    with stage(timings, STAGE_DECODE):
+        rendered = decode_latents(pipe, latents)[0]
+
+    with stage(timings, STAGE_POSTPROCESS):
+        # Back to crop geometry, then blend through a feathered mask into the original
+        rendered = crop_to_content(rendered, placement).resize(crop.size, Image.Resampling.LANCZOS)
+        feather = max(2, (box[2] - box[0] + box[3] - box[1]) // 100)
+        alpha = crop_mask.filter(ImageFilter.MaxFilter(3)).filter(ImageFilter.GaussianBlur(feather))
+        output = image.copy()
+        output.paste(Image.composite(rendered, crop, alpha), box[:2])
+
+    region_area = (box[2] - box[0]) * (box[3] - box[1])
+    report = {
+        "box": list(box),
+        "working_size": [width, height],
+        "mask_fraction": round(float(np.count_nonzero(np.array(crop_mask))) / (image.width * image.height), 4),
+        "region_fraction": round(region_area / (image.width * image.height), 4),
+    }
+    return output, report
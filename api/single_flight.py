@@ -0,0 +1,65 @@
+import asyncio
+import hashlib
+import json
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from jobs import Job
+from metrics import metrics
+
+def canonical_request_hash(endpoint: str, image_bytes: bytes, prompt: str, settings: Dict[str, Any]) -> str:
+    """Hash identifying a request by endpoint, input image bytes, prompt and settings"""
+    digest = hashlib.sha256()
+    digest.update(endpoint.encode("utf-8"))
+    digest.update(hashlib.sha256(image_bytes).digest())
+    digest.update(prompt.encode("utf-8"))
+    digest.update(json.dumps(settings, sort_keys=True, separators=(",", ":")).encode("utf-8"))
+    return digest.hexdigest()
+
+def _consume_exception(task: asyncio.Task):
+    # A flight whose subscribers all left still finishes; don't warn about its unread error
+    if not task.cancelled():
+        task.exception()
+
+class SingleFlight:
+    """Coalesces identical concurrent requests onto one in-flight job.
+
+    The first request for a key starts the job; duplicates arriving while it runs
+    attach to it as extra subscribers and receive the same result (and share its
+    progress through the job). Only used from the event loop thread.
+    """
+
+    def __init__(self):
+        self._flights: Dict[str, Tuple[Job, asyncio.Task]] = {}
+
+    def join(
+        self,
+        key: Optional[str],
+        start: Callable[[], Tuple[Job, asyncio.Task]]
+    ) -> Tuple[Job, asyncio.Task, bool]:
+        """Attach to the in-flight job for key, or start one. Returns (job, task, coalesced)."""
+        if key is not None and key in self._flights:
+            job, task = self._flights[key]
+            if not task.done() and not job.cancelled:
+                job.subscribers += 1
+                metrics.incr("requests_coalesced")
+                return job, task, True
+
+        job, task = start()
+        task.add_done_callback(_consume_exception)
+        if key is not None:
+            self._flights[key] = (job, task)
+            task.add_done_callback(lambda _: self._forget(key, task))
+        return job, task, False
+
+    def leave(self, job: Job) -> bool:
+        """Detach one subscriber; returns True if it was the last one"""
+        job.subscribers -= 1
+        return job.subscribers <= 0
+
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    def _forget(self, key: str, task: asyncio.Task):
+        flight = self._flights.get(key)
+        if flight is not None and flight[1] is task:
+            del self._flights[key]
@@ -0,0 +1,38 @@
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Optional
+
+# Stage names used for per-request timings across the API
+STAGE_PREPROCESS = "preprocess"
+STAGE_DEPTH = "depth"
+STAGE_DENOISE = "denoise"
+STAGE_DECODE = "decode"
+STAGE_POSTPROCESS = "postprocess"
+STAGE_UPLOAD = "upload"
+
+STAGES = [STAGE_PREPROCESS, STAGE_DEPTH, STAGE_DENOISE, STAGE_DECODE, STAGE_POSTPROCESS, STAGE_UPLOAD]
+
+# Per-thread switch for profiler annotations (see profiling.py)
+_annotations = threading.local()
+
+def annotate_stages(enabled: bool):
+    """Mark stages run on this thread as torch profiler ranges"""
+    _annotations.enabled = enabled
+
+def _annotation(name: str):
+    if not getattr(_annotations, 'enabled', False):
+        return nullcontext()
+    from torch.profiler import record_function
+    return record_function(f"stage:{name}")
+
+@contextmanager
+def stage(timings: Optional[Dict[str, float]], name: str):
+    """Time a block and add its duration in seconds to timings[name] (no-op if timings is None)"""
+    start = time.perf_counter()
+    try:
+        with _annotation(name):
+            yield
+    finally:
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
@@ -0,0 +1,72 @@
+import os
+from io import BytesIO
+
+import boto3
+from botocore.client import Config
+from PIL import Image
+
+# --- Cloudflare R2 configuration ---
+R2_ACCOUNT_ID = os.getenv("R2_ACCOUNT_ID")
+R2_ACCESS_KEY_ID = os.getenv("R2_ACCESS_KEY_ID")
+R2_SECRET_ACCESS_KEY = os.getenv("R2_SECRET_ACCESS_KEY")
+R2_BUCKET_NAME = os.getenv("R2_BUCKET_NAME")
+R2_PUBLIC_BASE_URL = os.getenv("R2_PUBLIC_BASE_URL")  # e.g. https://pub-xxxx.r2.dev
+
+r2_enabled = all([R2_ACCOUNT_ID, R2_ACCESS_KEY_ID, R2_SECRET_ACCESS_KEY, R2_BUCKET_NAME])
+if r2_enabled:
+    r2_endpoint = f"https://{R2_ACCOUNT_ID}.r2.cloudflarestorage.com"
+    s3_client = boto3.client(
+        "s3",
+        endpoint_url=r2_endpoint,
+        aws_access_key_id=R2_ACCESS_KEY_ID,
+        aws_secret_access_key=R2_SECRET_ACCESS_KEY,
+        config=Config(signature_version="s3v4"),
+        region_name="auto",
+    )
+else:
+    s3_client = None
+
+# Local fallback storage, relative to the API's working directory
+LOCAL_IMAGE_DIR = "images"
+
+
+def upload_image_return_url(image: Image.Image, key: str) -> str:
+    """Upload an image to R2 (if configured) and return a URL to access it.
+
+    Fallback: saves locally under images/ and returns the local file-serving endpoint.
+    """
+    if r2_enabled and s3_client is not None:
+        buffer = BytesIO()
+        image.save(buffer, format="PNG")
+        buffer.seek(0)
+        s3_client.put_object(
+            Bucket=R2_BUCKET_NAME,
+            Key=key,
+            Body=buffer,
+            ContentType="image/png",
+        )
+        if R2_PUBLIC_BASE_URL:
+            return f"{R2_PUBLIC_BASE_URL.rstrip('/')}/{key}"
+        # Presigned fallback if no public base URL configured
+        return s3_client.generate_presigned_url(
+            ClientMethod="get_object",
+            Params={"Bucket": R2_BUCKET_NAME, "Key": key},
+            ExpiresIn=3600,
+        )
+
+    # Local fallback (keys may contain a prefix such as "bulk/")
+    local_path = local_image_path(key)
+    if local_path is None:
+        raise ValueError(f"Invalid image key: {key}")
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+    image.save(local_path)
+    return f"/images/{key}"
+
+
+def local_image_path(key: str):
+    """Path of a key in local fallback storage, or None if it would escape the images directory"""
+    root = os.path.realpath(LOCAL_IMAGE_DIR)
+    path = os.path.realpath(os.path.join(root, key))
+    if not path.startswith(root + os.sep):
+        return None
+    return path
@@ -0,0 +1,133 @@
+import math
+import os
+from typing import Any, Dict, List, Optional
+
+import torch
+from PIL import Image, ImageDraw
+
+from stages import stage, STAGE_DENOISE, STAGE_DECODE, STAGE_POSTPROCESS
+from jobs import GenerationCancelled
+from guidance import guidance_params
+from deep_cache import deep_cache, cache_interval
+from inference_executor import adapter_gate
+from enhanced_generate import (
+    generate_depth_map, enhance_prompt_advanced, post_process_image_advanced, decode_latents,
+    release_pipeline_resources, working_max_size
+)
+from buckets import crop_to_content
+
+NEGATIVE_PROMPT = "dark, dim, poorly lit, low quality, blurry, dark lighting, shadows, dark atmosphere, distorted, deformed"
+
+# Most combinations per sweep, and per batched pipeline call (the memory budget may lower it)
+MAX_SWEEP_COMBINATIONS = 12
+SWEEP_MAX_BATCH = int(os.getenv("SWEEP_MAX_BATCH", "4"))
+
+# Grid tiles are scaled to this longest side
+GRID_TILE_SIZE = 384
+
+
+def sweep_prompts(combinations: List[Dict[str, str]], settings: Dict[str, Any]) -> List[str]:
+    """Enhanced prompt per theme/room combination (same wording as a single render)"""
+    prompts = []
+    for combination in combinations:
+        theme, room = combination["theme"], combination["room"]
+        prompts.append(enhance_prompt_advanced(
+            f"{theme} style {room} interior design", {**settings, 'style': theme, 'roomType': room}
+        ))
+    return prompts
+
+
+def generate_style_sweep(
+    image: Image.Image,
+    combinations: List[Dict[str, str]],
+    pipe,
+    depth_estimator,
+    settings: Dict[str, Any],
+    batch_size: int = 1,
+    timings: Optional[Dict[str, float]] = None,
+    job=None
+) -> List[Image.Image]:
+    """Render one photo in several theme/room combinations.
+
+    Depth estimation and preprocessing run once, all prompts go through the text
+    encoder as one batch, and denoising runs ``batch_size`` combinations per
+    pipeline call. Combination i gets its own generator seeded with seed + i, so a
+    single render with that seed starts from the same noise and looks the same; it is
+    not bit-identical, since batched UNet calls round differently.
+    """
+    if job is not None:
+        job.check()
+
+    depth_map, placement = generate_depth_map(
+        image, depth_estimator, max_size=working_max_size(settings), timings=timings
+    )
+
+    num_steps = settings.get('steps', 20)
+    guidance_scale = settings.get('guidanceScale', 7.5)
+    guided = guidance_scale > 1
+    prompts = sweep_prompts(combinations, settings)
+    with stage(timings, STAGE_DENOISE), torch.no_grad():
+        prompt_embeds, negative_embeds = pipe.encode_prompt(
+            prompts, pipe._execution_device, 1, guided, [NEGATIVE_PROMPT] * len(prompts)
+        )
+
+    seed = int(settings.get('seed', 0) or 0)
+    if job is not None:
+        job.total_steps = num_steps
+
+    latents = []
+    for start in range(0, len(prompts), batch_size):
+        end = min(start + batch_size, len(prompts))
+        generation_params = {
+            "prompt_embeds": prompt_embeds[start:end],
+            "negative_prompt_embeds": negative_embeds[start:end] if guided else None,
+            "image": depth_map,
+            "num_inference_steps": num_steps,
+            "guidance_scale": guidance_scale,
+        }
+        if seed > 0:
+            generation_params["generator"] = [torch.Generator().manual_seed(seed + i) for i in range(start, end)]
+        generation_params.update(guidance_params(
+            pipe, num_steps, guidance_scale,
+            cfg_cutoff=settings.get('cfgCutoff'),
+            control_end=settings.get('controlEnd'),
+            step_callback=job.step_callback if job is not None else None
+        ))
+
+        print(f"Sweep batch {start // batch_size + 1}: combinations {start + 1}-{end} of {len(prompts)}")
+        try:
+            with stage(timings, STAGE_DENOISE), adapter_gate.shared(), deep_cache(pipe, cache_interval(settings)):
+                latents.append(pipe(**generation_params, output_type="latent").images)
+        except GenerationCancelled:
+            release_pipeline_resources(pipe)
+            raise
+
+    outputs = []
+    for batch in latents:
+        with stage(timings, STAGE_DECODE):
+            decoded = decode_latents(pipe, batch)
+        with stage(timings, STAGE_POSTPROCESS):
+            for output in decoded:
+                output = post_process_image_advanced(crop_to_content(output, placement), settings)
+                if not settings.get('enableUpscaling', False):
+                    output = output.resize(placement.original_size, Image.Resampling.LANCZOS)
+                outputs.append(output)
+    return outputs
+
+
+def make_grid(images: List[Image.Image], labels: List[str], tile_size: int = GRID_TILE_SIZE) -> Image.Image:
+    """Labelled contact sheet of the sweep results"""
+    columns = math.ceil(math.sqrt(len(images)))
+    rows = math.ceil(len(images) / columns)
+    scale = tile_size / max(images[0].size)
+    tile_width, tile_height = round(images[0].width * scale), round(images[0].height * scale)
+    label_height = 24
+
+    grid = Image.new("RGB", (columns * tile_width, rows * (tile_height + label_height)), (255, 255, 255))
+    draw = ImageDraw.Draw(grid)
+    for i, (image, label) in enumerate(zip(images, labels)):
+        x = (i % columns) * tile_width
+        y = (i // columns) * (tile_height + label_height)
+        grid.paste(image.resize((tile_width, tile_height), Image.Resampling.LANCZOS), (x, y))
+        draw.text((x + 6, y + tile_height + 5), label, fill=(0, 0, 0))
+    return grid
@@ -0,0 +1,62 @@
+"""
+Tests for aspect-ratio buckets: fitting an image in and mapping the result back
+"""
+
+import pytest
+from PIL import Image
+
+from buckets import BUCKETS, fit_to_bucket, crop_to_content, restore_from_bucket, select_bucket
+
+SIZES = [
+    (1200, 800),   # landscape
+    (800, 1200),   # portrait
+    (512, 512),    # square
+    (1001, 667),   # odd landscape
+    (333, 517),    # odd portrait
+    (1920, 817),   # wider than any bucket
+]
+
+
+def _image(width, height):
+    # Left half red, right half blue, so a shifted or stretched result shows up in the pixels
+    image = Image.new("RGB", (width, height), (255, 0, 0))
+    image.paste((0, 0, 255), (width // 2, 0, width, height))
+    return image
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_fit_uses_bucket_shape(size):
+    padded, placement = fit_to_bucket(_image(*size))
+    assert padded.size == placement.bucket == select_bucket(*size)
+    assert placement.original_size == size
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_round_trip_restores_size_and_aspect(size):
+    width, height = size
+    padded, placement = fit_to_bucket(_image(width, height))
+
+    left, top, right, bottom = placement.content_box
+    content_width, content_height = right - left, bottom - top
+    # Content keeps the input's aspect ratio up to one pixel of rounding
+    assert abs(content_width * height - content_height * width) <= max(width, height)
+
+    restored = restore_from_bucket(padded, placement)
+    assert restored.size == size
+    assert restored.getpixel((width // 4, height // 2)) == pytest.approx((255, 0, 0), abs=8)
+    assert restored.getpixel((width * 3 // 4, height // 2)) == pytest.approx((0, 0, 255), abs=8)
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_round_trip_from_upscaled_result(size):
+    padded, placement = fit_to_bucket(_image(*size))
+    upscaled = padded.resize((padded.width * 4, padded.height * 4), Image.Resampling.LANCZOS)
+
+    content = crop_to_content(upscaled, placement)
+    left, top, right, bottom = placement.content_box
+    assert content.size == ((right - left) * 4, (bottom - top) * 4)
+    assert restore_from_bucket(upscaled, placement).size == size
+
+
+def test_buckets_are_multiples_of_8():
+    assert all(width % 8 == 0 and height % 8 == 0 for width, height in BUCKETS)
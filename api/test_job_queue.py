@@ -0,0 +1,94 @@
+"""
+Tests for the SQLite job queue: leasing, heartbeats, expiry and re-leasing
+"""
+
+import time
+
+import pytest
+
+from job_queue import JobQueue, SQLiteJobQueue, open_queue
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return SQLiteJobQueue(str(tmp_path / "queue.db"), lease_seconds=60, max_attempts=2)
+
+
+def test_lease_returns_oldest_job_once(queue):
+    first = queue.enqueue("first", {"steps": 20}, b"one")
+    queue.enqueue("second", {}, b"two")
+
+    leased = queue.lease("worker-a")
+    assert leased["id"] == first
+    assert leased["prompt"] == "first"
+    assert leased["settings"] == {"steps": 20}
+    assert leased["image"] == b"one"
+    assert leased["attempts"] == 1
+
+    assert queue.lease("worker-b")["prompt"] == "second"
+    assert queue.lease("worker-c") is None
+    assert queue.stats() == {"leased": 2}
+
+
+def test_complete_and_fail_need_the_lease(queue):
+    job_id = queue.enqueue("prompt", {}, b"image")
+    queue.lease("worker-a")
+
+    assert not queue.complete(job_id, "worker-b", {"output": []})
+    assert queue.complete(job_id, "worker-a", {"output": ["url"]})
+    assert not queue.fail(job_id, "worker-a", "too late")
+
+    job = queue.get(job_id)
+    assert job["status"] == "done"
+    assert job["result"] == {"output": ["url"]}
+    assert job["worker"] is None
+
+
+def test_heartbeat_only_extends_own_lease(queue):
+    job_id = queue.enqueue("prompt", {}, b"image")
+    queue.lease("worker-a")
+
+    assert queue.heartbeat(job_id, "worker-a")
+    assert not queue.heartbeat(job_id, "worker-b")
+
+
+def test_expired_lease_is_leased_again(tmp_path):
+    queue = SQLiteJobQueue(str(tmp_path / "queue.db"), lease_seconds=0.05, max_attempts=2)
+    job_id = queue.enqueue("prompt", {}, b"image")
+
+    assert queue.lease("worker-a")["id"] == job_id
+    assert queue.lease("worker-b") is None
+    time.sleep(0.1)
+
+    # worker-a's lease expired: worker-b gets the job and worker-a can no longer finish it
+    leased = queue.lease("worker-b")
+    assert leased["id"] == job_id
+    assert leased["attempts"] == 2
+    assert not queue.heartbeat(job_id, "worker-a")
+    assert not queue.complete(job_id, "worker-a", {"output": []})
+    assert queue.complete(job_id, "worker-b", {"output": ["url"]})
+
+
+def test_job_fails_after_max_attempts(tmp_path):
+    queue = SQLiteJobQueue(str(tmp_path / "queue.db"), lease_seconds=0.05, max_attempts=2)
+    job_id = queue.enqueue("prompt", {}, b"image")
+
+    for worker_id in ("worker-a", "worker-b"):
+        assert queue.lease(worker_id)["id"] == job_id
+        time.sleep(0.1)
+
+    assert queue.lease("worker-c") is None
+    job = queue.get(job_id)
+    assert job["status"] == "failed"
+    assert job["error"] == "lease expired too many times"
+
+
+def test_open_queue_by_url(tmp_path):
+    assert isinstance(open_queue(f"sqlite:///{tmp_path / 'queue.db'}"), SQLiteJobQueue)
+    with pytest.raises(ValueError):
+        open_queue("redis://localhost")
+
+
+def test_job_queue_is_abstract():
+    with pytest.raises(TypeError):
+        JobQueue()
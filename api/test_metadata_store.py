@@ -0,0 +1,91 @@
+"""
+Tests for the SQLite generation metadata store: record, flush and read back
+"""
+
+import pytest
+
+from metadata_store import MetadataStore, open_metadata_store, hashed_settings
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = MetadataStore(str(tmp_path / "generations.db"), batch_size=8, flush_seconds=0.01)
+    yield store
+    store.close()
+
+
+def _record(store, **fields):
+    defaults = {
+        "job_id": "job-1",
+        "endpoint": "/generate/advanced",
+        "input_hash": "abc",
+        "outputs": ["https://example.com/out.png"],
+    }
+    return store.record(**{**defaults, **fields})
+
+
+def test_record_round_trip(store):
+    generation_id = _record(
+        store, prompt="cozy loft", settings={"steps": 20, "seed": 7}, seed=7,
+        input_width=640, input_height=480, timings={"denoise": 1.5}, stage_ms=1500, user_id="u1"
+    )
+    store.flush()
+
+    record = store.get(generation_id)
+    assert record["id"] == generation_id
+    assert record["job_id"] == "job-1"
+    assert record["prompt"] == "cozy loft"
+    assert record["settings"] == {"steps": 20, "seed": 7}
+    assert record["outputs"] == ["https://example.com/out.png"]
+    assert record["timings"] == {"denoise": 1.5}
+    assert (record["input_width"], record["input_height"]) == (640, 480)
+    assert store.stats()["written"] == 1
+
+
+def test_reused_job_id_keeps_both_records(store):
+    first = _record(store, outputs=["first"])
+    second = _record(store, outputs=["second"])
+    store.flush()
+
+    assert first != second
+    records = store.find(job_id="job-1")
+    assert {tuple(record["outputs"]) for record in records} == {("first",), ("second",)}
+
+
+def test_find_filters_newest_first(store):
+    _record(store, input_hash="a", user_id="u1", created_at=100.0)
+    _record(store, input_hash="a", user_id="u2", created_at=200.0)
+    _record(store, input_hash="b", user_id="u1", created_at=300.0)
+    store.flush()
+
+    assert [record["created_at"] for record in store.find(input_hash="a")] == [200.0, 100.0]
+    assert [record["created_at"] for record in store.find(user_id="u1", since=150.0)] == [300.0]
+    assert len(store.find(limit=2)) == 2
+
+
+def test_latest_by_request_hash(store):
+    _record(store, request_hash="r", outputs=["old"], created_at=1.0)
+    _record(store, request_hash="r", outputs=["new"], created_at=2.0)
+    store.flush()
+
+    assert store.latest("r")["outputs"] == ["new"]
+    assert store.latest("missing") is None
+
+
+def test_writer_survives_a_failed_batch(store):
+    # endpoint is NOT NULL, so this batch fails; the writer must keep going
+    _record(store, endpoint=None)
+    store.flush()
+    generation_id = _record(store)
+    store.flush()
+
+    assert store.get(generation_id) is not None
+    assert store.stats()["dropped"] == 1
+
+
+def test_hashed_settings_drops_non_render_keys():
+    assert hashed_settings({"steps": 20, "reuseExisting": True, "profile": True}) == {"steps": 20}
+
+
+def test_open_metadata_store_disabled():
+    assert open_metadata_store("") is None
@@ -43,6 +43,11 @@ export async function POST(request: Request) {
       formData.append('settings', JSON.stringify(parsedSettings));
     }
 
+    // Lets the API index its generation records by user
+    if (userId) {
+      formData.append('user_id', String(userId));
+    }
+
     console.log('Sending request to Python API...');
 
     // Determine which endpoint to use based on available settings